@@ -4,6 +4,8 @@ import argparse
 import logging
 
 from . import execfile
+from .hooks import LoggingHook
+from .pyvm2 import ENGINES, VirtualMachine
 
 parser = argparse.ArgumentParser(
     prog="byterun",
@@ -17,6 +19,18 @@ parser.add_argument(
     '-v', '--verbose', dest='verbose', action='store_true',
     help="trace the execution of the bytecode.",
 )
+parser.add_argument(
+    '--engine', dest='engine', choices=ENGINES, default='classic',
+    help="how the VM runs frames.",
+)
+parser.add_argument(
+    '--optimize', dest='optimize', action='store_true',
+    help="run code through the peephole optimizer first.",
+)
+parser.add_argument(
+    '--quicken', dest='quicken', action='store_true',
+    help="specialize operators for the types they see.",
+)
 parser.add_argument(
     'prog',
     help="The program to run.",
@@ -35,5 +49,11 @@ else:
 level = logging.DEBUG if args.verbose else logging.WARNING
 logging.basicConfig(level=level)
 
+vm = VirtualMachine(
+    engine=args.engine, optimize=args.optimize, quicken=args.quicken,
+)
+if args.verbose:
+    vm.add_hook(LoggingHook())
+
 argv = [args.prog] + args.args
-run_fn(args.prog, argv)
+run_fn(args.prog, argv, vm=vm)
@@ -20,8 +20,9 @@ except:
 NoSource = Exception
 
 
-def exec_code_object(code, env):
-    vm = VirtualMachine()
+def exec_code_object(code, env, vm=None):
+    if vm is None:
+        vm = VirtualMachine()
     return vm.run_code(code, f_globals=env)
 
 
@@ -41,12 +42,13 @@ def rsplit1(s, sep):
     return sep.join(parts[:-1]), parts[-1]
 
 
-def run_python_module(modulename, args):
+def run_python_module(modulename, args, vm=None):
     """Run a python module, as though with ``python -m name args...``.
 
     `modulename` is the name of the module, possibly a dot-separated name.
     `args` is the argument array to present as sys.argv, including the first
-    element naming the module being executed.
+    element naming the module being executed.  `vm` is the VirtualMachine to
+    run it in, a new one if None.
 
     """
     openfile = None
@@ -87,16 +89,17 @@ def run_python_module(modulename, args):
 
     # Finally, hand the file off to run_python_file for execution.
     args[0] = pathname
-    run_python_file(pathname, args, package=packagename)
+    return run_python_file(pathname, args, package=packagename, vm=vm)
 
 
-def run_python_file(filename, args, package=None):
+def run_python_file(filename, args, package=None, vm=None):
     """Run a python file as if it were the main program on the command line.
 
     `filename` is the path to the file to execute, it need not be a .py file.
     `args` is the argument array to present as sys.argv, including the first
     element naming the file being executed.  `package` is the name of the
-    enclosing package, if any.
+    enclosing package, if any.  `vm` is the VirtualMachine to run it in, a
+    new one if None.
 
     """
     # Create a module to serve as __main__
@@ -136,7 +139,7 @@ def run_python_file(filename, args, package=None):
         code = compile(source, filename, "exec")
 
         # Execute the source file.
-        return exec_code_object(code, main_mod.__dict__)
+        return exec_code_object(code, main_mod.__dict__, vm)
 
     finally:
         # Restore the old __main__
@@ -0,0 +1,191 @@
+"""Hooks that watch a Byterun VM run code.
+
+A hook is any object with methods for the events it wants to see::
+
+    on_call(vm, frame)
+    on_line(vm, frame, line)
+    on_instruction(vm, frame, offset, byteName, arguments)
+    on_return(vm, frame, value)
+    on_exception(vm, frame, exc_info)
+
+`VirtualMachine.add_hook` registers one.  The VM only delivers an event to
+the hooks with a method for it, and only runs the instrumented version of
+its loop while some hook wants some event, so a VM without hooks pays
+nothing for them.
+
+`TraceHook` turns the events into calls of a `sys.settrace` trace function,
+so tools written for CPython's tracing, like coverage measurement, can
+watch code the VM runs.
+
+"""
+
+import collections
+import logging
+
+from six.moves import reprlib
+
+# The events a hook can have methods for, in the order a frame sees them.
+EVENTS = ('call', 'line', 'instruction', 'return', 'exception')
+
+log = logging.getLogger(__name__)
+
+# Create a repr that won't overflow.
+repr_obj = reprlib.Repr()
+repr_obj.maxother = 120
+repper = repr_obj.repr
+
+
+def subscriptions(hooks):
+    """Get the bound methods of `hooks` for each event, keyed by event."""
+    subscribed = {}
+    for event in EVENTS:
+        subscribed[event] = [
+            getattr(hook, 'on_' + event) for hook in hooks
+            if getattr(hook, 'on_' + event, None) is not None
+        ]
+    return subscribed
+
+
+class LoggingHook(object):
+    """Log what the main function does, the way ``byterun -v`` shows it.
+
+    Each instruction of the main function is logged with the data and
+    block stacks it runs with, each call with the locals it starts with,
+    and each exception an instruction raises.
+
+    """
+
+    def on_call(self, vm, frame):
+        log.info("call: code=%r, locals=%s" % (
+            frame.f_code, repper(frame.f_locals),
+        ))
+
+    def on_instruction(self, vm, frame, offset, byteName, arguments):
+        # The second frame is the main function.
+        if len(vm.frames) != 2:
+            return
+        op = "%d: %s" % (offset, byteName)
+        if arguments:
+            op += " %r" % (arguments[0],)
+        indent = "    " * (len(vm.frames) - 1)
+        log.info("  %sdata: %s" % (indent, repper(frame.stack)))
+        log.info("  %sblks: %s" % (indent, repper(frame.block_stack)))
+        log.info("%s%s" % (indent, op))
+
+    def on_exception(self, vm, frame, exc_info):
+        log.info("Caught exception during execution", exc_info=exc_info)
+
+
+# What a FrameProxy keeps of a VM frame that has returned.
+_FrameState = collections.namedtuple(
+    '_FrameState', 'f_code, f_globals, f_locals, f_lasti',
+)
+
+
+class FrameProxy(object):
+    """What a trace function sees of a VM frame.
+
+    It has the attributes of a real frame that tracers use.  A VM frame is
+    reused for a later call once it returns, so tracers get a proxy, which
+    they can keep.  While the frame runs, the proxy reads through to it;
+    when it returns or yields, `detach` keeps what it had then, so the
+    proxy never shows a later call.  As in CPython, `f_lineno` is the line
+    of the last line event while the frame is traced.
+
+    """
+    __slots__ = ['_frame', 'f_back', 'f_trace', 'f_lineno']
+
+    def __init__(self, frame, f_back):
+        self._frame = frame
+        self.f_back = f_back
+        # The local trace function, set from what the trace function returns.
+        self.f_trace = None
+        self.f_lineno = frame.line_number()
+
+    def detach(self):
+        """Stop reading the VM frame, keeping what it has now."""
+        frame = self._frame
+        if not isinstance(frame, _FrameState):
+            self._frame = _FrameState(
+                frame.f_code, frame.f_globals, frame.f_locals, frame.f_lasti,
+            )
+
+    @property
+    def f_code(self):
+        return self._frame.f_code
+
+    @property
+    def f_globals(self):
+        return self._frame.f_globals
+
+    @property
+    def f_locals(self):
+        return self._frame.f_locals
+
+    @property
+    def f_lasti(self):
+        return self._frame.f_lasti
+
+
+class TraceHook(object):
+    """Call a `sys.settrace` trace function for the events of a VM.
+
+    The trace function is called with a `FrameProxy`, an event name and an
+    argument, as `sys.settrace` describes: it gets each 'call', and what it
+    returns is the frame's local trace function, which gets the frame's
+    'line', 'return' and 'exception' events.  A local trace function that
+    returns None stays in place, as in CPython.  The exception's traceback
+    is None: the VM doesn't make them.
+
+    If the trace function raises an exception, tracing stops, and the
+    exception is raised in the traced code.
+
+    """
+
+    def __init__(self, tracefunc):
+        self.tracefunc = tracefunc
+        # The proxies for the frames that are running, by VM frame.
+        self.proxies = {}
+
+    def proxy(self, frame):
+        """Get the proxy for the running VM frame `frame`."""
+        proxy = self.proxies.get(frame)
+        if proxy is None:
+            f_back = self.proxy(frame.f_back) if frame.f_back else None
+            proxy = self.proxies[frame] = FrameProxy(frame, f_back)
+        return proxy
+
+    def trace(self, vm, callback, proxy, event, arg):
+        try:
+            result = callback(proxy, event, arg)
+        except:
+            vm.remove_hook(self)
+            self.tracefunc = None
+            for proxy in self.proxies.values():
+                proxy.detach()
+            self.proxies.clear()
+            raise
+        if result is not None:
+            proxy.f_trace = result
+
+    def local_trace(self, vm, frame, event, arg):
+        proxy = self.proxies.get(frame)
+        if proxy is not None and proxy.f_trace is not None:
+            self.trace(vm, proxy.f_trace, proxy, event, arg)
+
+    def on_call(self, vm, frame):
+        if self.tracefunc is not None:
+            self.trace(vm, self.tracefunc, self.proxy(frame), 'call', None)
+
+    def on_line(self, vm, frame, line):
+        self.proxy(frame).f_lineno = line
+        self.local_trace(vm, frame, 'line', None)
+
+    def on_return(self, vm, frame, value):
+        self.local_trace(vm, frame, 'return', value)
+        proxy = self.proxies.pop(frame, None)
+        if proxy is not None:
+            proxy.detach()
+
+    def on_exception(self, vm, frame, exc_info):
+        self.local_trace(vm, frame, 'exception', exc_info)
@@ -0,0 +1,151 @@
+"""Count the pairs of opcodes a program executes under Byterun.
+
+Run a program the way ``python -m byterun`` does, and report which pairs of
+consecutive instructions it executed most often.  The most frequent pairs
+are the ones worth fusing into superinstructions, see
+`byterun.pycode.SUPERINSTRUCTIONS`::
+
+    python -m byterun.opstats [-n COUNT] [--optimize] [--quicken] prog.py [args...]
+
+After the pairs, the report shows how many frames the VM made, and how many
+calls ran in a frame reused from an earlier call.
+
+With ``--optimize``, the program runs through the peephole optimizer, and
+the report also shows how many instructions it removed from each code
+object.  With ``--quicken``, operators are specialized for the types they
+see, and the report shows how often each specialization's guard held.
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+
+from . import execfile
+from .pycode import OPNAMES, code_info, count_instructions
+from .pyvm2 import VirtualMachine, quickening_stats
+
+
+class PairCountingVirtualMachine(VirtualMachine):
+    """A VM that counts the pairs of opcodes it executes in each frame."""
+
+    def __init__(self, **kwargs):
+        super(PairCountingVirtualMachine, self).__init__(**kwargs)
+        self.pair_counts = collections.Counter()
+        self.prev_opcode = None
+
+    def run_frame(self, frame):
+        # Pairs don't span frames: the first instruction in a frame has no
+        # predecessor, and the caller picks up where it left off.
+        caller_prev_opcode = self.prev_opcode
+        self.prev_opcode = None
+        try:
+            return super(PairCountingVirtualMachine, self).run_frame(frame)
+        finally:
+            self.prev_opcode = caller_prev_opcode
+
+    def dispatch(self, byteCode, arguments):
+        if self.prev_opcode is not None:
+            self.pair_counts[self.prev_opcode, byteCode] += 1
+        self.prev_opcode = byteCode
+        why = super(PairCountingVirtualMachine, self).dispatch(
+            byteCode, arguments
+        )
+        self.prev_opcode = byteCode
+        return why
+
+
+def report(pair_counts, count, out=None):
+    """Print the `count` most frequent pairs in `pair_counts`."""
+    total = sum(pair_counts.values()) or 1
+    print("%10s %6s  %s" % ("count", "%", "pair"), file=out)
+    for (first, second), n in pair_counts.most_common(count):
+        print("%10d %6.2f  %s %s" % (
+            n, 100.0 * n / total, OPNAMES[first], OPNAMES[second],
+        ), file=out)
+
+
+def report_frames(vm, out=None):
+    """Print how many frames `vm` made, and how many it reused."""
+    print("frames: %d made, %d reused" % (
+        vm.frames_made, vm.frames_reused,
+    ), file=out)
+
+
+def report_removed(removed_instructions, out=None):
+    """Print how many instructions the optimizer removed from each code."""
+    print("%10s %10s  %s" % ("removed", "of", "code"), file=out)
+    for code, removed in sorted(
+        removed_instructions.items(), key=lambda item: -item[1]
+    ):
+        print("%10d %10d  %s (%s:%d)" % (
+            removed, count_instructions(code_info(code).instructions),
+            code.co_name, code.co_filename, code.co_firstlineno,
+        ), file=out)
+
+
+def report_quickened(stats, out=None):
+    """Print the hits and misses of each quickened operator in `stats`."""
+    print("%10s %10s  %s" % ("hits", "misses", "operator"), file=out)
+    for name, (hits, misses) in sorted(
+        stats.items(), key=lambda item: -sum(item[1])
+    ):
+        print("%10d %10d  %s" % (hits, misses, name), file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="byterun.opstats",
+        description="Count the opcode pairs a program executes in Byterun.",
+    )
+    parser.add_argument(
+        '-m', dest='module', action='store_true',
+        help="prog is a module name, not a file name.",
+    )
+    parser.add_argument(
+        '-n', dest='count', type=int, default=20,
+        help="how many of the most frequent pairs to show.",
+    )
+    parser.add_argument(
+        '--optimize', dest='optimize', action='store_true',
+        help="run the peephole optimizer, and report what it removed.",
+    )
+    parser.add_argument(
+        '--quicken', dest='quicken', action='store_true',
+        help="quicken operators, and report how often their guards held.",
+    )
+    parser.add_argument(
+        'prog',
+        help="The program to run.",
+    )
+    parser.add_argument(
+        'args', nargs=argparse.REMAINDER,
+        help="Arguments to pass to the program.",
+    )
+    args = parser.parse_args(argv)
+
+    if args.module:
+        run_fn = execfile.run_python_module
+    else:
+        run_fn = execfile.run_python_file
+
+    vm = PairCountingVirtualMachine(
+        optimize=args.optimize, quicken=args.quicken,
+    )
+    try:
+        run_fn(args.prog, [args.prog] + args.args, vm=vm)
+    finally:
+        report(vm.pair_counts, args.count)
+        print()
+        report_frames(vm)
+        if args.optimize:
+            print()
+            report_removed(vm.removed_instructions)
+        if args.quicken:
+            print()
+            report_quickened(quickening_stats)
+
+
+if __name__ == '__main__':
+    main()
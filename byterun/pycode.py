@@ -0,0 +1,674 @@
+"""Decoded code objects for Byterun.
+
+Executing bytecode straight out of `co_code` means re-reading the bytes,
+looking up the opcode name and resolving the argument every time an
+instruction runs.  Instead, each code object is decoded once into a table of
+instructions, which is cached and shared by every frame and every VM.
+
+"""
+
+import dis
+import operator
+import weakref
+
+import six
+
+PY3, PY2 = six.PY3, not six.PY3
+
+if six.PY3:
+    byteint = lambda b: b
+else:
+    byteint = ord
+
+
+def decode_code(code):
+    """Decode the bytecode of `code` into an instruction table.
+
+    The table is a list indexed by byte offset.  Each offset that starts an
+    instruction holds a tuple::
+
+        (byteCode, byteName, arguments, next_offset)
+
+    `arguments` is a tuple of zero or one items, the argument resolved into
+    the form the VM's `byte_*` methods take: a constant, a name, or a jump
+    target.  The instructions for fast locals and cells get two, the name
+    and its index in the frame's fast locals or cells.  `next_offset` is the
+    offset of the following instruction.  The offsets in the middle of
+    instructions hold None.
+
+    """
+    co_code = code.co_code
+    code_len = len(co_code)
+    instructions = [None] * code_len
+    cellvars_len = len(code.co_cellvars)
+
+    offset = 0
+    extended_arg = 0
+    extended_start = None
+    while offset < code_len:
+        opoffset = offset
+        byteCode = byteint(co_code[offset])
+        offset += 1
+        byteName = dis.opname[byteCode]
+        arguments = ()
+        if byteCode >= dis.HAVE_ARGUMENT:
+            intArg = (
+                byteint(co_code[offset]) +
+                (byteint(co_code[offset+1]) << 8) +
+                extended_arg
+            )
+            offset += 2
+            extended_arg = 0
+            if byteCode == dis.EXTENDED_ARG:
+                # The real argument is for the next instruction: remember
+                # where this started, so that jumps here run both.
+                extended_arg = intArg << 16
+                if extended_start is None:
+                    extended_start = opoffset
+                continue
+            if byteCode in dis.hasconst:
+                arg = code.co_consts[intArg]
+            elif byteCode in dis.hasfree:
+                if intArg < cellvars_len:
+                    arg = code.co_cellvars[intArg]
+                else:
+                    arg = code.co_freevars[intArg - cellvars_len]
+            elif byteCode in dis.hasname:
+                arg = code.co_names[intArg]
+            elif byteCode in dis.hasjrel:
+                arg = offset + intArg
+            elif byteCode in dis.hasjabs:
+                arg = intArg
+            elif byteCode in dis.haslocal:
+                arg = code.co_varnames[intArg]
+            else:
+                arg = intArg
+            arguments = (arg,)
+            if byteCode in dis.haslocal or byteCode in dis.hasfree:
+                arguments += (intArg,)
+
+        instruction = (byteCode, byteName, arguments, offset)
+        instructions[opoffset] = instruction
+        if extended_start is not None:
+            instructions[extended_start] = instruction
+            extended_start = None
+
+    return instructions
+
+
+# Pairs of instructions that can be fused into one superinstruction, so that
+# the VM makes one trip round its loop instead of two.  They were chosen from
+# the pair counts reported by `python -m byterun.opstats` over our workloads.
+SUPERINSTRUCTIONS = [
+    ('LOAD_FAST', 'LOAD_FAST'),
+    ('LOAD_FAST', 'LOAD_ATTR'),
+    ('LOAD_FAST', 'LOAD_CONST'),
+    ('LOAD_FAST', 'STORE_FAST'),
+    ('STORE_FAST', 'JUMP_ABSOLUTE'),
+    ('COMPARE_OP', 'POP_JUMP_IF_FALSE'),
+    ('BINARY_ADD', 'STORE_FAST'),
+    ('LOAD_CONST', 'BINARY_ADD'),
+]
+
+# Superinstructions get opcodes after the real ones, and names made from the
+# names of the pair, so that the VM handles them with `byte_*` methods like
+# any other instruction.
+SUPERINSTRUCTION_NAMES = ['%s__%s' % pair for pair in SUPERINSTRUCTIONS]
+SUPERINSTRUCTION_OPCODES = dict(
+    (pair, len(dis.opname) + i) for i, pair in enumerate(SUPERINSTRUCTIONS)
+)
+
+# Pseudo-instructions for quickening, see `add_adaptive_operators`.
+QUICKENING_NAMES = [
+    'ADAPTIVE_OPERATOR', 'QUICKENED_OPERATOR', 'QUICKENED_SUBSCR',
+]
+
+# Pseudo-instructions for calling methods, see `_load_methods`.
+METHOD_CALL_NAMES = ['LOAD_METHOD', 'CALL_METHOD']
+
+OPNAMES = (
+    list(dis.opname) + SUPERINSTRUCTION_NAMES + QUICKENING_NAMES +
+    METHOD_CALL_NAMES
+)
+ADAPTIVE_OPERATOR = len(dis.opname) + len(SUPERINSTRUCTION_NAMES)
+QUICKENED_OPERATOR = ADAPTIVE_OPERATOR + 1
+QUICKENED_SUBSCR = QUICKENED_OPERATOR + 1
+LOAD_METHOD = QUICKENED_SUBSCR + 1
+CALL_METHOD = LOAD_METHOD + 1
+
+
+def line_numbers(code):
+    """Get the line number of each byte offset in `code`'s bytecode.
+
+    The list is indexed like an instruction table, and every offset in an
+    instruction has the instruction's line, so a frame can find the line it
+    is running from any offset in O(1).
+
+    """
+    starts = dict(dis.findlinestarts(code))
+    line = code.co_firstlineno
+    lines = []
+    for offset in range(len(code.co_code)):
+        line = starts.get(offset, line)
+        lines.append(line)
+    return lines
+
+
+def jump_targets(instructions):
+    """Get the set of offsets that are jumped to in `instructions`."""
+    targets = set()
+    for instruction in instructions:
+        if instruction is None:
+            continue
+        byteCode, byteName, arguments, next_offset = instruction
+        if byteCode in dis.hasjrel or byteCode in dis.hasjabs:
+            targets.add(arguments[0])
+    return targets
+
+
+def loop_heads(code):
+    """Get the offsets where the loops in `code` start each iteration.
+
+    A loop's head is where the jump at the end of its body goes back to,
+    just before the POP_BLOCK that ends the loop: a FOR_ITER, or the test
+    of a while loop.  The set is worked out once per code object.
+
+    """
+    info = code_info(code)
+    if info.loop_heads is None:
+        heads = set()
+        # The SETUP_ instructions whose POP_BLOCKs are still to come.
+        setups = []
+        previous = None
+        for instruction in info.instructions:
+            if instruction is None:
+                continue
+            byteName = instruction[1]
+            if byteName.startswith('SETUP_'):
+                setups.append(byteName)
+            elif byteName == 'POP_BLOCK' and setups:
+                if (setups.pop() == 'SETUP_LOOP' and previous is not None
+                        and previous[1] == 'JUMP_ABSOLUTE'):
+                    heads.add(previous[2][0])
+            previous = instruction
+        info.loop_heads = frozenset(heads)
+    return info.loop_heads
+
+
+def fuse_superinstructions(instructions, line_starts):
+    """Fuse the pairs in SUPERINSTRUCTIONS in an instruction table.
+
+    Returns a new table.  A pair is fused only if nothing jumps to its
+    second instruction and the second doesn't start a new line, so that
+    execution can't enter the pair in the middle, and anything watching line
+    changes sees the same lines.  The second instruction keeps its own entry.
+
+    """
+    fused = list(instructions)
+    no_fusing = jump_targets(instructions) | set(line_starts)
+    offset = 0
+    while offset < len(fused):
+        first = fused[offset]
+        next_offset = first[3]
+        if next_offset < len(fused) and next_offset not in no_fusing:
+            second = fused[next_offset]
+            opcode = SUPERINSTRUCTION_OPCODES.get((first[1], second[1]))
+            if opcode is not None:
+                fused[offset] = (
+                    opcode, OPNAMES[opcode], first[2] + second[2], second[3]
+                )
+                next_offset = second[3]
+        offset = next_offset
+    return fused
+
+
+# The instructions that jump, and so can be threaded through a jump they
+# land on.  The SETUP_* instructions are left alone: their targets are block
+# handlers.
+THREADABLE_JUMPS = set([
+    'JUMP_ABSOLUTE', 'JUMP_FORWARD', 'CONTINUE_LOOP', 'FOR_ITER',
+    'POP_JUMP_IF_FALSE', 'POP_JUMP_IF_TRUE',
+    'JUMP_IF_FALSE_OR_POP', 'JUMP_IF_TRUE_OR_POP',
+])
+UNCONDITIONAL_JUMPS = set(['JUMP_ABSOLUTE', 'JUMP_FORWARD'])
+# The instructions that never go on to the one after them.
+NO_FALLTHROUGH = UNCONDITIONAL_JUMPS | set([
+    'RETURN_VALUE', 'RAISE_VARARGS', 'BREAK_LOOP', 'CONTINUE_LOOP',
+])
+
+# Operators that can be folded when their operands are constants.  Classic
+# division is left out: its result depends on the -Q flag at run time.
+FOLDING_UNARY_OPERATORS = {
+    'UNARY_POSITIVE': operator.pos,
+    'UNARY_NEGATIVE': operator.neg,
+    'UNARY_INVERT': operator.invert,
+}
+FOLDING_BINARY_OPERATORS = {
+    'BINARY_POWER': pow,
+    'BINARY_MULTIPLY': operator.mul,
+    'BINARY_FLOOR_DIVIDE': operator.floordiv,
+    'BINARY_TRUE_DIVIDE': operator.truediv,
+    'BINARY_MODULO': operator.mod,
+    'BINARY_ADD': operator.add,
+    'BINARY_SUBTRACT': operator.sub,
+    'BINARY_SUBSCR': operator.getitem,
+    'BINARY_LSHIFT': operator.lshift,
+    'BINARY_RSHIFT': operator.rshift,
+    'BINARY_AND': operator.and_,
+    'BINARY_XOR': operator.xor,
+    'BINARY_OR': operator.or_,
+}
+# Folded sequences longer than this would bloat the constants, as in CPython.
+MAX_FOLDED_SIZE = 20
+
+LOAD_CONST = dis.opmap['LOAD_CONST']
+
+
+def count_instructions(instructions):
+    """Count the instructions that can run in an instruction table."""
+    count = 0
+    offset = 0
+    while offset < len(instructions):
+        count += 1
+        offset = instructions[offset][3]
+    return count
+
+
+def _relink(instructions):
+    """Point each instruction's next_offset past the removed instructions."""
+    following = [len(instructions)] * (len(instructions) + 1)
+    for offset in range(len(instructions) - 1, -1, -1):
+        if instructions[offset] is None:
+            following[offset] = following[offset + 1]
+        else:
+            following[offset] = offset
+    for offset, instruction in enumerate(instructions):
+        if instruction is not None:
+            byteCode, byteName, arguments, next_offset = instruction
+            if following[next_offset] != next_offset:
+                instructions[offset] = (
+                    byteCode, byteName, arguments, following[next_offset]
+                )
+
+
+def _thread_jumps(instructions):
+    """Retarget jumps that land on unconditional jumps to where those go."""
+    for offset, instruction in enumerate(instructions):
+        if instruction is None or instruction[1] not in THREADABLE_JUMPS:
+            continue
+        byteCode, byteName, arguments, next_offset = instruction
+        target = arguments[0]
+        seen = set()
+        while (instructions[target][1] in UNCONDITIONAL_JUMPS and
+               target not in seen):
+            seen.add(target)
+            target = instructions[target][2][0]
+        if target != arguments[0]:
+            instructions[offset] = (byteCode, byteName, (target,), next_offset)
+
+
+def _remove_dead_code(instructions):
+    """Remove the instructions that can't be reached from the start."""
+    live = set()
+    todo = [0]
+    while todo:
+        offset = todo.pop()
+        if offset in live or offset >= len(instructions):
+            continue
+        live.add(offset)
+        byteCode, byteName, arguments, next_offset = instructions[offset]
+        if byteCode in dis.hasjrel or byteCode in dis.hasjabs:
+            todo.append(arguments[0])
+        if byteName not in NO_FALLTHROUGH:
+            todo.append(next_offset)
+    for offset in range(len(instructions)):
+        if offset not in live:
+            instructions[offset] = None
+    _relink(instructions)
+
+
+def _folded(byteName, arguments, consts):
+    """Fold an instruction whose operands are the constants `consts`.
+
+    Returns how many of the constants it used and the constant it makes, or
+    None if it can't be folded.
+
+    """
+    try:
+        if byteName == 'BUILD_TUPLE':
+            count = arguments[0]
+            if count > len(consts):
+                return None
+            return count, tuple(consts[len(consts) - count:])
+        if byteName in FOLDING_UNARY_OPERATORS and consts:
+            count = 1
+            value = FOLDING_UNARY_OPERATORS[byteName](consts[-1])
+        elif byteName in FOLDING_BINARY_OPERATORS and len(consts) >= 2:
+            count = 2
+            value = FOLDING_BINARY_OPERATORS[byteName](consts[-2], consts[-1])
+        else:
+            return None
+    except Exception:
+        # Leave it to raise when it runs.
+        return None
+    if hasattr(value, '__len__') and len(value) > MAX_FOLDED_SIZE:
+        return None
+    return count, value
+
+
+def _fold_constants(instructions, no_folding):
+    """Replace operations on constants with a load of their result.
+
+    The instructions are never folded across the offsets in `no_folding`.
+
+    """
+    # The offsets of the constants loaded just before the current offset.
+    consts = []
+    offset = 0
+    while offset < len(instructions):
+        byteCode, byteName, arguments, next_offset = instructions[offset]
+        if offset in no_folding:
+            consts = []
+        folded = _folded(
+            byteName, arguments, [instructions[o][2][0] for o in consts]
+        )
+        if folded is not None:
+            count, value = folded
+            folded_offsets = consts[len(consts) - count:] + [offset]
+            consts = consts[:len(consts) - count]
+            for o in folded_offsets:
+                instructions[o] = None
+            first = folded_offsets[0]
+            instructions[first] = (
+                LOAD_CONST, 'LOAD_CONST', (value,), next_offset
+            )
+            consts.append(first)
+        elif byteName == 'LOAD_CONST':
+            consts.append(offset)
+        else:
+            consts = []
+        offset = next_offset
+    _relink(instructions)
+
+
+def _remove_jumps_to_next(instructions, keep):
+    """Remove unconditional jumps to the next instruction, except at `keep`."""
+    offset = 0
+    while offset < len(instructions):
+        byteCode, byteName, arguments, next_offset = instructions[offset]
+        if (byteName in UNCONDITIONAL_JUMPS and arguments[0] == next_offset
+                and offset not in keep):
+            instructions[offset] = None
+        offset = next_offset
+    _relink(instructions)
+
+
+# How many values the instructions that can come between loading a method
+# and calling it pop and push, for `_load_methods`.
+STACK_EFFECTS = {
+    'LOAD_FAST': (0, 1), 'LOAD_CONST': (0, 1), 'LOAD_GLOBAL': (0, 1),
+    'LOAD_NAME': (0, 1), 'LOAD_DEREF': (0, 1), 'LOAD_ATTR': (1, 1),
+    'BINARY_SUBSCR': (2, 1), 'COMPARE_OP': (2, 1), 'DUP_TOP': (1, 2),
+}
+for name in dis.opname:
+    if name.startswith('UNARY_'):
+        STACK_EFFECTS[name] = (1, 1)
+    elif name.startswith(('BINARY_', 'INPLACE_')):
+        STACK_EFFECTS.setdefault(name, (2, 1))
+del name
+
+
+def _stack_effect(byteName, arguments):
+    """How many values an instruction pops and pushes, or None if unknown."""
+    if byteName in STACK_EFFECTS:
+        return STACK_EFFECTS[byteName]
+    if byteName in ('BUILD_TUPLE', 'BUILD_LIST'):
+        return arguments[0], 1
+    if byteName == 'CALL_FUNCTION':
+        lenKw, lenPos = divmod(arguments[0], 256)
+        return 1 + lenPos + 2 * lenKw, 1
+    return None
+
+
+def _load_methods(instructions, targets):
+    """Make LOAD_ATTR and the CALL_FUNCTION that calls its value a pair.
+
+    Like CPython's LOAD_METHOD and CALL_METHOD, the pair calls a method
+    without making a bound method first.  The instructions between the two
+    must only push the call's arguments, and nothing can jump into them.
+
+    """
+    offset = 0
+    while offset < len(instructions):
+        byteCode, byteName, arguments, next_offset = instructions[offset]
+        if byteName == 'LOAD_ATTR':
+            # How many values are on the stack above the attribute.
+            depth = 0
+            call = next_offset
+            while call < len(instructions) and call not in targets:
+                _, name, args, after = instructions[call]
+                effect = _stack_effect(name, args)
+                if effect is None or effect[0] > depth + 1:
+                    break
+                if name == 'CALL_FUNCTION' and effect[0] == depth + 1:
+                    instructions[offset] = (
+                        LOAD_METHOD, 'LOAD_METHOD', arguments, next_offset
+                    )
+                    instructions[call] = (
+                        CALL_METHOD, 'CALL_METHOD', args, after
+                    )
+                    break
+                if effect[0] > depth:
+                    break
+                depth += effect[1] - effect[0]
+                call = after
+        offset = next_offset
+
+
+def optimize_instructions(instructions, line_starts):
+    """Peephole-optimize an instruction table.
+
+    Jumps to unconditional jumps go straight to their final targets,
+    unreachable instructions are removed, operations on constants are
+    folded into a load of their result, and jumps to the following
+    instruction are removed.  As with superinstructions, nothing is folded
+    or removed at a line start, so anything watching line changes sees the
+    same lines.  Then method calls are made with LOAD_METHOD and
+    CALL_METHOD.
+
+    Returns a new table, and the number of instructions removed.
+
+    """
+    optimized = list(instructions)
+    _thread_jumps(optimized)
+    _remove_dead_code(optimized)
+    line_starts = set(line_starts)
+    _fold_constants(optimized, jump_targets(optimized) | line_starts)
+    _remove_jumps_to_next(optimized, jump_targets(optimized) | line_starts)
+    _load_methods(optimized, jump_targets(optimized))
+    removed = (
+        count_instructions(instructions) - count_instructions(optimized)
+    )
+    return optimized, removed
+
+
+# The instructions that get an inline cache slot, see `add_inline_caches`,
+# and which of a frame's lists of slots they use: 0 for names, 1 for
+# attributes.
+INLINE_CACHED = {
+    'LOAD_GLOBAL': 0,
+    'LOAD_NAME': 0,
+    'LOAD_ATTR': 1,
+    'LOAD_METHOD': 1,
+    'STORE_ATTR': 1,
+}
+
+
+def add_inline_caches(instructions):
+    """Number the instructions in INLINE_CACHED in an instruction table.
+
+    Returns a new table, in which each of those instructions has the number
+    of its cache slot as an extra argument, and a list of how many slots
+    there are in each list.  The slots themselves belong to the VM: the
+    table is shared.
+
+    """
+    cached = list(instructions)
+    counts = [0, 0]
+    # An instruction after EXTENDED_ARG is in the table twice, and gets one
+    # slot.
+    slots = {}
+    for offset, instruction in enumerate(cached):
+        if instruction is None or instruction[1] not in INLINE_CACHED:
+            continue
+        byteCode, byteName, arguments, next_offset = instruction
+        slot = slots.get(id(instruction))
+        if slot is None:
+            which = INLINE_CACHED[byteName]
+            slot = slots[id(instruction)] = counts[which]
+            counts[which] += 1
+        cached[offset] = (byteCode, byteName, arguments + (slot,), next_offset)
+    return cached, counts
+
+
+# The instructions that are quickened, and how many times each runs before
+# the VM specializes it for the types of its operands.
+QUICKENED_NAMES = set([
+    'BINARY_ADD', 'BINARY_SUBTRACT', 'BINARY_MULTIPLY', 'BINARY_DIVIDE',
+    'BINARY_TRUE_DIVIDE', 'BINARY_FLOOR_DIVIDE', 'BINARY_MODULO',
+    'BINARY_SUBSCR', 'INPLACE_ADD', 'INPLACE_SUBTRACT', 'INPLACE_MULTIPLY',
+    'COMPARE_OP',
+])
+QUICKEN_AFTER = 8
+
+
+def add_adaptive_operators(instructions):
+    """Make the instructions in QUICKENED_NAMES adaptive.
+
+    Returns a new table, in which each of those instructions is replaced by
+    an ADAPTIVE_OPERATOR, whose arguments are the instruction's opcode, name
+    and arguments, its offset, and a one-item list counting down the runs
+    left before the VM quickens it.  The VM rewrites the table in place as
+    it quickens instructions.
+
+    """
+    adaptive = list(instructions)
+    for offset, instruction in enumerate(adaptive):
+        if instruction is None or instruction[1] not in QUICKENED_NAMES:
+            continue
+        byteCode, byteName, arguments, next_offset = instruction
+        adaptive[offset] = (
+            ADAPTIVE_OPERATOR, 'ADAPTIVE_OPERATOR',
+            (byteCode, byteName, arguments, offset, [QUICKEN_AFTER]),
+            next_offset,
+        )
+    return adaptive
+
+
+class CodeInfo(object):
+    """What Byterun knows about a code object, worked out once.
+
+    This must not refer to the code object itself: it lives as long as the
+    code object does, and a reference back to it would keep every code
+    object alive forever.
+
+    """
+    __slots__ = [
+        'instructions', 'line_starts', 'line_numbers',
+        'removed_instructions', 'inline_caches', 'tables', 'function',
+        'loop_heads',
+    ]
+
+    def __init__(self, code):
+        self.instructions = decode_code(code)
+        self.line_starts = frozenset(
+            offset for offset, _ in dis.findlinestarts(code)
+        )
+        self.line_numbers = line_numbers(code)
+        # How many instructions the optimizer removed, once it has run.
+        self.removed_instructions = None
+        # How many inline cache slots each version of the instruction table
+        # with inline caches needs, for names and for attributes, keyed like
+        # `tables`.  Optimized code can have fewer instructions to cache.
+        self.inline_caches = {}
+        # The versions of the instruction table VMs have asked for, keyed by
+        # (optimize, superinstructions, inline_caches, quicken).
+        self.tables = {(False, False, False, False): self.instructions}
+        # What the functions made from the code share, once one has been
+        # made.  See `byterun.pyobj.FunctionInfo`.
+        self.function = None
+        # Where the loops start each iteration, once asked for.  See
+        # `loop_heads`.
+        self.loop_heads = None
+
+
+# A weak reference to each code object with a `CodeInfo`, and the info, by
+# the code object's id.  Code objects are told apart by identity, not by
+# equality: equal ones can come from different files, or have different
+# line numbers.
+_code_infos = {}
+
+
+def _forget_code(ref):
+    """Drop the info of a code object that has died."""
+    entry = _code_infos.get(ref.key)
+    if entry is not None and entry[0] is ref:
+        del _code_infos[ref.key]
+
+
+def code_info(code):
+    """Get the `CodeInfo` for `code`, decoding it the first time."""
+    key = id(code)
+    try:
+        return _code_infos[key][1]
+    except KeyError:
+        info = CodeInfo(code)
+        _code_infos[key] = weakref.KeyedRef(code, _forget_code, key), info
+        return info
+
+
+def instruction_table(
+    code, optimize=False, superinstructions=False, inline_caches=False,
+    quicken=False,
+):
+    """Get the instruction table for `code`, optimized and fused as asked.
+
+    Each version is built the first time it is asked for.
+
+    """
+    info = code_info(code)
+    key = (optimize, superinstructions, inline_caches, quicken)
+    try:
+        return info.tables[key]
+    except KeyError:
+        pass
+    if quicken:
+        # Fused pairs are left alone: they are already fast.
+        table = add_adaptive_operators(
+            instruction_table(code, optimize, superinstructions, inline_caches)
+        )
+    elif superinstructions:
+        table = fuse_superinstructions(
+            instruction_table(code, optimize, False, inline_caches),
+            info.line_starts,
+        )
+    elif inline_caches:
+        table, info.inline_caches[key] = add_inline_caches(
+            instruction_table(code, optimize)
+        )
+    else:
+        table, info.removed_instructions = optimize_instructions(
+            info.instructions, info.line_starts
+        )
+    if inline_caches and key not in info.inline_caches:
+        # Fusing and quickening keep the slots of the table they start from.
+        info.inline_caches[key] = (
+            info.inline_caches[(optimize, False, True, False)]
+        )
+    info.tables[key] = table
+    return table
+
+
+def fused_instructions(code):
+    """Get the instruction table for `code` with superinstructions fused."""
+    return instruction_table(code, superinstructions=True)
@@ -1,11 +1,12 @@
 """Implementations of Python fundamental objects for Byterun."""
 
 import collections
-import inspect
-import types
 
 import six
 
+from .pycode import code_info
+from .pysource import UNBOUND, tier_function
+
 PY3, PY2 = six.PY3, not six.PY3
 
 
@@ -20,32 +21,223 @@ def make_cell(value):
         return fn.func_closure[0]
 
 
+CO_OPTIMIZED = 0x01
+CO_VARARGS = 0x04
+CO_VARKEYWORDS = 0x08
+CO_GENERATOR = 0x20             # flag for "this code uses yield"
+
+
+def _plural(n):
+    return "" if n == 1 else "s"
+
+
+class BindingPlan(object):
+    """How a call binds its arguments to the parameters of a code object.
+
+    This does what the interpreter does when it sets up a frame: positional
+    arguments fill the parameters in order, keyword arguments fill them by
+    name, and defaults fill what's left.  Bad calls raise the same
+    TypeErrors the interpreter would raise for them.
+
+    A plan is worked out once per code object, and kept in its
+    `FunctionInfo`.
+
+    """
+    __slots__ = [
+        'name', 'argcount', 'positional', 'indexes', 'kwonly', 'varargs',
+        'varkw', 'simple', 'unbound',
+    ]
+
+    def __init__(self, code):
+        self.name = code.co_name
+        self.argcount = argcount = code.co_argcount
+        names = code.co_varnames
+        self.positional = names[:argcount]
+        i = argcount + getattr(code, 'co_kwonlyargcount', 0)
+        self.kwonly = names[argcount:i]
+        # Where each parameter that can be passed by keyword goes.
+        self.indexes = dict((name, j) for j, name in enumerate(names[:i]))
+        # Where the extra positional and keyword arguments go.
+        self.varargs = self.varkw = None
+        if code.co_flags & CO_VARARGS:
+            self.varargs = i
+            i += 1
+        if code.co_flags & CO_VARKEYWORDS:
+            self.varkw = i
+        # Whether a call with exactly the right number of positional
+        # arguments, and no keywords, needs nothing more than a copy.
+        self.simple = (
+            not self.kwonly and self.varargs is None and self.varkw is None
+        )
+        # The locals after the positional parameters, which start unbound.
+        self.unbound = [UNBOUND] * (code.co_nlocals - argcount)
+
+    def bind(self, args, kwargs, defaults):
+        """Get the fast locals for a call with `args` and `kwargs`."""
+        argcount = self.argcount
+        given = len(args)
+        if given == argcount and self.simple and not kwargs:
+            fast = list(args)
+            fast += self.unbound
+            return fast
+
+        if PY2 and not self.argcount and self.simple:
+            if args or kwargs:
+                raise TypeError("%s() takes no arguments (%d given)" % (
+                    self.name, given + len(kwargs),
+                ))
+            return self.unbound[:]
+        if PY2 and given > argcount and self.varargs is None:
+            raise self._too_many(given, kwargs, defaults, None)
+
+        fast = list(args[:argcount])
+        fast += [UNBOUND] * (argcount - len(fast))
+        fast += self.unbound
+        if self.varargs is not None:
+            fast[self.varargs] = tuple(args[argcount:])
+        if self.varkw is not None:
+            extra = fast[self.varkw] = {}
+        for key, value in six.iteritems(kwargs):
+            index = self.indexes.get(key)
+            if index is not None:
+                if fast[index] is not UNBOUND:
+                    raise TypeError(
+                        "%s() got multiple values for %sargument '%s'" % (
+                            self.name, "keyword " if PY2 else "", key,
+                        )
+                    )
+                fast[index] = value
+            elif self.varkw is not None:
+                extra[key] = value
+            else:
+                raise TypeError(
+                    "%s() got an unexpected keyword argument '%s'" % (
+                        self.name, key,
+                    )
+                )
+        if given > argcount and self.varargs is None:
+            raise self._too_many(given, kwargs, defaults, fast)
+
+        if given < argcount:
+            required = argcount - len(defaults)
+            missing = [
+                self.positional[i] for i in range(given, required)
+                if fast[i] is UNBOUND
+            ]
+            if missing:
+                raise self._missing(missing, "positional", defaults, fast)
+            for i in range(max(given, required), argcount):
+                if fast[i] is UNBOUND:
+                    fast[i] = defaults[i - required]
+        if self.kwonly:
+            missing = [
+                name for i, name in enumerate(self.kwonly, argcount)
+                if fast[i] is UNBOUND
+            ]
+            if missing:
+                raise self._missing(missing, "keyword-only", defaults, fast)
+        return fast
+
+    def _too_many(self, given, kwargs, defaults, fast):
+        argcount = self.argcount
+        if PY2:
+            return TypeError("%s() takes %s %d argument%s (%d given)" % (
+                self.name, "at most" if defaults else "exactly", argcount,
+                _plural(argcount), given + len(kwargs),
+            ))
+        if defaults:
+            sig = "from %d to %d" % (argcount - len(defaults), argcount)
+            plural = "s"
+        else:
+            sig = "%d" % argcount
+            plural = _plural(argcount)
+        kwonly_given = len([
+            value for value in fast[argcount:argcount + len(self.kwonly)]
+            if value is not UNBOUND
+        ])
+        if kwonly_given:
+            kwonly_sig = (
+                " positional argument%s (and %d keyword-only argument%s)" % (
+                    _plural(given), kwonly_given, _plural(kwonly_given),
+                )
+            )
+        else:
+            kwonly_sig = ""
+        return TypeError(
+            "%s() takes %s positional argument%s but %d%s %s given" % (
+                self.name, sig, plural, given, kwonly_sig,
+                "was" if given == 1 and not kwonly_given else "were",
+            )
+        )
+
+    def _missing(self, missing, kind, defaults, fast):
+        if PY2:
+            required = self.argcount - len(defaults)
+            return TypeError("%s() takes %s %d argument%s (%d given)" % (
+                self.name,
+                "at least" if self.varargs is not None or defaults
+                else "exactly",
+                required, _plural(required),
+                len([
+                    value for value in fast[:self.argcount]
+                    if value is not UNBOUND
+                ]),
+            ))
+        names = ["'%s'" % name for name in missing]
+        if len(names) == 1:
+            listed = names[0]
+        elif len(names) == 2:
+            listed = "%s and %s" % tuple(names)
+        else:
+            listed = "%s, and %s" % (", ".join(names[:-1]), names[-1])
+        return TypeError("%s() missing %d required %s argument%s: %s" % (
+            self.name, len(names), kind, _plural(len(names)), listed,
+        ))
+
+
+class FunctionInfo(object):
+    """What every function made from a code object has in common."""
+    __slots__ = ['name', 'doc', 'binding', 'generator']
+
+    def __init__(self, code):
+        self.name = code.co_name
+        self.doc = code.co_consts[0] if code.co_consts else None
+        self.binding = BindingPlan(code)
+        self.generator = bool(code.co_flags & CO_GENERATOR)
+
+
+def function_info(code):
+    """Get the `FunctionInfo` for `code`, working it out the first time."""
+    info = code_info(code)
+    if info.function is None:
+        info.function = FunctionInfo(code)
+    return info.function
+
+
 class Function(object):
     __slots__ = [
         'func_code', 'func_name', 'func_defaults', 'func_globals',
         'func_locals', 'func_dict', 'func_closure',
         '__name__', '__dict__', '__doc__',
-        '_vm', '_func',
+        '_vm', '_info', '_calls', '_tiered',
     ]
 
     def __init__(self, name, code, globs, defaults, closure, vm):
         self._vm = vm
+        self._info = info = function_info(code)
         self.func_code = code
-        self.func_name = self.__name__ = name or code.co_name
+        self.func_name = self.__name__ = name or info.name
         self.func_defaults = tuple(defaults)
         self.func_globals = globs
-        self.func_locals = self._vm.frame.f_locals
+        self.func_locals = vm.frame.namespace
         self.__dict__ = {}
         self.func_closure = closure
-        self.__doc__ = code.co_consts[0] if code.co_consts else None
+        self.__doc__ = info.doc
 
-        # Sometimes, we need a real Python function.  This is for that.
-        kw = {
-            'argdefs': self.func_defaults,
-        }
-        if closure:
-            kw['closure'] = tuple(make_cell(0) for _ in closure)
-        self._func = types.FunctionType(code, globs, **kw)
+        # How many times we've been called, and once we're hot, the real
+        # function translated from our bytecode, or False if we can't be.
+        self._calls = 0
+        self._tiered = None
 
     def __repr__(self):         # pragma: no cover
         return '<Function %s at 0x%08x>' % (
@@ -61,28 +253,42 @@ class Function(object):
             return self
 
     def __call__(self, *args, **kwargs):
-        if PY2 and self.func_name in ["<setcomp>", "<dictcomp>", "<genexpr>"]:
-            # D'oh! http://bugs.python.org/issue19611 Py2 doesn't know how to
-            # inspect set comprehensions, dict comprehensions, or generator
-            # expressions properly.  They are always functions of one argument,
-            # so just do the right thing.
-            assert len(args) == 1 and not kwargs, "Surprising comprehension!"
-            callargs = {".0": args[0]}
-        else:
-            callargs = inspect.getcallargs(self._func, *args, **kwargs)
-        frame = self._vm.make_frame(
-            self.func_code, callargs, self.func_globals, {}
+        return self.call(args, kwargs)
+
+    def call(self, args, kwargs):
+        """Call the function with a sequence of positional arguments and a
+        dict of keyword arguments.
+
+        The VM calls this directly, without packing the arguments up for
+        __call__.
+
+        """
+        vm = self._vm
+        if self._tiered is None and vm.hot_threshold is not None:
+            self._calls += 1
+            if self._calls > vm.hot_threshold:
+                self._tiered = tier_function(self) or False
+        if self._tiered and vm.can_run_tiered(self.func_code):
+            return self._tiered(*args, **kwargs)
+
+        info = self._info
+        fast_locals = info.binding.bind(args, kwargs, self.func_defaults)
+        frame = vm.make_frame(
+            self.func_code, f_globals=self.func_globals,
+            fast_locals=fast_locals, closure=self.func_closure,
         )
-        CO_GENERATOR = 32           # flag for "this code uses yield"
-        if self.func_code.co_flags & CO_GENERATOR:
-            gen = Generator(frame, self._vm)
+        if info.generator:
+            gen = Generator(frame, vm)
             frame.generator = gen
             retval = gen
         else:
-            retval = self._vm.run_frame(frame)
+            retval = vm.run_frame(frame)
+            vm.release_frame(frame)
         return retval
 
 class Method(object):
+    __slots__ = ['im_self', 'im_class', 'im_func']
+
     def __init__(self, obj, _class, func):
         self.im_self = obj
         self.im_class = _class
@@ -121,6 +327,8 @@ class Cell(object):
            actual value.
 
     """
+    __slots__ = ['contents']
+
     def __init__(self, value):
         self.contents = value
 
@@ -133,18 +341,82 @@ class Cell(object):
 
 Block = collections.namedtuple("Block", "type, handler, level")
 
+# The types of Block.
+BLOCK_LOOP = 1
+BLOCK_SETUP_EXCEPT = 2
+BLOCK_FINALLY = 3
+BLOCK_WITH = 4
+BLOCK_EXCEPT_HANDLER = 5
+
 
 class Frame(object):
-    def __init__(self, f_code, f_globals, f_locals, f_back):
+    """A frame running a code object.
+
+    Code keeps its local variables in `fast_locals`, a list indexed like
+    co_varnames, which LOAD_FAST and STORE_FAST use.  Code that isn't
+    optimized, like modules, class bodies and Python 2 functions using exec,
+    also has a `namespace` dict, which the *_NAME instructions use.
+    `f_locals` makes a dict of both for code that asks for one.
+
+    The variables closures share are in `cells`, a list laid out like
+    co_cellvars + co_freevars, as CPython's are: new cells for the code's
+    own cell variables, then the cells of the function's closure.
+
+    """
+    __slots__ = [
+        'f_code', 'f_globals', 'namespace', 'fast_locals', 'f_back',
+        'f_builtins', 'f_lineno', 'f_lasti', 'stack', 'block_stack',
+        'instructions', 'line_numbers', 'name_caches', 'attr_caches',
+        'cells', 'generator', 'record',
+    ]
+
+    def __init__(
+        self, f_code, f_globals, f_locals, f_back, fast_locals=None,
+        closure=None,
+    ):
         self.f_code = f_code
+        self.stack = []
+        self.block_stack = []
+        info = code_info(f_code)
+        self.instructions = info.instructions
+        self.line_numbers = info.line_numbers
+        # The VM's inline cache slots for LOAD_GLOBAL and LOAD_NAME, and for
+        # LOAD_ATTR and STORE_ATTR, if it uses them.
+        self.name_caches = None
+        self.attr_caches = None
+        self.setup(f_globals, f_locals, f_back, fast_locals, closure)
+
+    def setup(
+        self, f_globals, f_locals, f_back, fast_locals=None, closure=None,
+    ):
+        """Get ready to run the frame's code, for a new call.
+
+        `f_locals` is the namespace, and `fast_locals` the bound arguments
+        and unbound locals.  Without fast locals, all the locals start
+        unbound, except for optimized code, which takes the values of its
+        locals from `f_locals` instead of keeping it as a namespace.
+        `closure` is the tuple of cells for the code's free variables.
+
+        A VM can run a frame again for another call of the same code, after
+        `clear` has dropped what the last call left behind.
+
+        """
+        f_code = self.f_code
+        if fast_locals is None:
+            fast_locals = [UNBOUND] * f_code.co_nlocals
+            if f_code.co_flags & CO_OPTIMIZED and f_locals:
+                for i, name in enumerate(f_code.co_varnames):
+                    fast_locals[i] = f_locals.get(name, UNBOUND)
+        if f_code.co_flags & CO_OPTIMIZED:
+            f_locals = None
         self.f_globals = f_globals
-        self.f_locals = f_locals
+        self.namespace = f_locals
+        self.fast_locals = fast_locals
         self.f_back = f_back
-        self.stack = []
         if f_back:
             self.f_builtins = f_back.f_builtins
         else:
-            self.f_builtins = f_locals['__builtins__']
+            self.f_builtins = f_globals['__builtins__']
             if hasattr(self.f_builtins, '__dict__'):
                 self.f_builtins = self.f_builtins.__dict__
 
@@ -152,26 +424,71 @@ class Frame(object):
         self.f_lasti = 0
 
         if f_code.co_cellvars:
-            self.cells = {}
-            if not f_back.cells:
-                f_back.cells = {}
+            cells = []
+            varnames = f_code.co_varnames
             for var in f_code.co_cellvars:
-                # Make a cell for the variable in our locals, or None.
-                cell = Cell(self.f_locals.get(var))
-                f_back.cells[var] = self.cells[var] = cell
+                # Make a cell for the variable, with its argument or None.
+                if var in varnames:
+                    value = fast_locals[varnames.index(var)]
+                else:
+                    value = None
+                cells.append(Cell(value))
+            if closure:
+                cells.extend(closure)
+            self.cells = cells
+        elif f_code.co_freevars:
+            assert closure, "no closure for %r" % (f_code.co_freevars,)
+            self.cells = list(closure)
         else:
             self.cells = None
 
-        if f_code.co_freevars:
-            if not self.cells:
-                self.cells = {}
-            for var in f_code.co_freevars:
-                assert self.cells is not None
-                assert f_back.cells, "f_back.cells: %r" % (f_back.cells,)
-                self.cells[var] = f_back.cells[var]
-
-        self.block_stack = []
         self.generator = None
+        # The recorder's FrameRecord, False if the recorder doesn't track
+        # the frame, or None until it starts.
+        self.record = None
+
+    def clear(self):
+        """Drop the references the frame holds for the call it ran."""
+        self.f_globals = self.namespace = self.fast_locals = None
+        self.f_back = self.cells = self.record = None
+        del self.stack[:]
+        del self.block_stack[:]
+
+    @property
+    def f_locals(self):
+        """The frame's locals, as a dict.
+
+        For optimized code, this is a new dict each time, a snapshot of the
+        fast locals and the cells.  Otherwise it is the namespace, with the
+        fast locals copied into it, as CPython's PyFrame_FastToLocals does.
+
+        """
+        f_code = self.f_code
+        if self.namespace is None:
+            f_locals = {}
+        else:
+            f_locals = self.namespace
+        for name, value in zip(f_code.co_varnames, self.fast_locals):
+            if value is not UNBOUND:
+                f_locals[name] = value
+        if self.namespace is None and self.cells:
+            # An argument that is also a cell variable keeps the value it
+            # was passed in its fast local: the cell has the current one.
+            names = f_code.co_cellvars + f_code.co_freevars
+            for name, cell in zip(names, self.cells):
+                f_locals[name] = cell.contents
+        return f_locals
+
+    @f_locals.setter
+    def f_locals(self, f_locals):
+        self.namespace = f_locals
+
+    def locals_to_fast(self):
+        """Copy changes made to the namespace back into the fast locals."""
+        namespace = self.namespace
+        for i, name in enumerate(self.f_code.co_varnames):
+            if name in namespace:
+                self.fast_locals[i] = namespace[name]
 
     def __repr__(self):         # pragma: no cover
         return '<Frame at 0x%08x: %r @ %d>' % (
@@ -179,23 +496,12 @@ class Frame(object):
         )
 
     def line_number(self):
-        """Get the current line number the frame is executing."""
-        # We don't keep f_lineno up to date, so calculate it based on the
-        # instruction address and the line number table.
-        lnotab = self.f_code.co_lnotab
-        byte_increments = six.iterbytes(lnotab[0::2])
-        line_increments = six.iterbytes(lnotab[1::2])
-
-        byte_num = 0
-        line_num = self.f_code.co_firstlineno
-
-        for byte_incr, line_incr in zip(byte_increments, line_increments):
-            byte_num += byte_incr
-            if byte_num > self.f_lasti:
-                break
-            line_num += line_incr
-
-        return line_num
+        """Get the line number of the instruction the frame is running."""
+        # We don't keep f_lineno up to date.  f_lasti is the offset of the
+        # next instruction, so the one before it is in the current one.
+        if not self.f_lasti:
+            return self.f_code.co_firstlineno
+        return self.line_numbers[self.f_lasti - 1]
 
 
 class Generator(object):
@@ -0,0 +1,820 @@
+"""Translate the bytecode of hot functions into Python source.
+
+A VM function called often enough is translated into the source of an
+equivalent real Python function, which is compiled and used for its later
+calls.  The translation simulates the value stack statically: every stack
+slot becomes a local variable, so an instruction turns into a plain Python
+statement, and jumps become assignments to a program counter that picks the
+next block of statements to run.
+
+Only functions whose bytecode uses the instructions in `TRANSLATORS` are
+translated, without try blocks, with blocks, closures or yields, and not
+calling `LOCALS_READERS`; anything else is interpreted as usual.  A
+translated call still pushes a VM frame, so the call stack the VM sees,
+and everything it records, is the same.
+
+"""
+
+import dis
+import operator
+import types
+import weakref
+
+import six
+
+from .pycode import code_info
+
+PY3, PY2 = six.PY3, not six.PY3
+
+CO_VARARGS = 0x04
+CO_VARKEYWORDS = 0x08
+CO_GENERATOR = 0x20
+
+
+class UntranslatableError(Exception):
+    """The bytecode uses something the translator can't handle."""
+    pass
+
+
+class _Unbound(object):
+    """The value of a local variable that hasn't been assigned yet."""
+    def __repr__(self):         # pragma: no cover
+        return '<unbound>'
+
+UNBOUND = _Unbound()
+
+
+BINARY_OPERATORS = {
+    'POWER':    '%s ** %s',
+    'MULTIPLY': '%s * %s',
+    'DIVIDE':   '%s / %s',
+    'FLOOR_DIVIDE': '%s // %s',
+    'TRUE_DIVIDE':  '__truediv(%s, %s)',
+    'MODULO':   '%s %% %s',
+    'ADD':      '%s + %s',
+    'SUBTRACT': '%s - %s',
+    'SUBSCR':   '%s[%s]',
+    'LSHIFT':   '%s << %s',
+    'RSHIFT':   '%s >> %s',
+    'AND':      '%s & %s',
+    'XOR':      '%s ^ %s',
+    'OR':       '%s | %s',
+}
+
+INPLACE_OPERATORS = {
+    'POWER':    '%s **= %s',
+    'MULTIPLY': '%s *= %s',
+    'DIVIDE':   '%s /= %s',
+    'FLOOR_DIVIDE': '%s //= %s',
+    'TRUE_DIVIDE':  '%s = __itruediv(%s, %s)',
+    'MODULO':   '%s %%= %s',
+    'ADD':      '%s += %s',
+    'SUBTRACT': '%s -= %s',
+    'LSHIFT':   '%s <<= %s',
+    'RSHIFT':   '%s >>= %s',
+    'AND':      '%s &= %s',
+    'XOR':      '%s ^= %s',
+    'OR':       '%s |= %s',
+}
+
+UNARY_OPERATORS = {
+    'POSITIVE': '+%s',
+    'NEGATIVE': '-%s',
+    'NOT':      'not %s',
+    'CONVERT':  '__repr(%s)',
+    'INVERT':   '~%s',
+}
+
+COMPARE_OPERATORS = [
+    '%s < %s', '%s <= %s', '%s == %s', '%s != %s', '%s > %s', '%s >= %s',
+    '%s in %s', '%s not in %s', '%s is %s', '%s is not %s',
+]
+
+# The builtins that can read their caller's locals.  A translated function
+# keeps its locals to itself, so code that might call them isn't translated.
+LOCALS_READERS = frozenset(['locals', 'vars', 'dir'])
+
+# The helpers the generated source uses, by the names it uses for them.
+# Every name it uses starts with ``__``, since no argument's name does, so
+# an argument can't hide a builtin it needs.
+HELPERS = {
+    '__UNBOUND': UNBOUND,
+    '__truediv': operator.truediv,
+    '__itruediv': operator.itruediv,
+    '__repr': repr,
+    '__iter': iter,
+    '__next': next,
+    '__slice': slice,
+    '__set': set,
+    '__len': len,
+    '__list': list,
+    '__dict': dict,
+    '__isinstance': isinstance,
+    # Objects whose attributes the VM's inline caches depend on.
+    '__namespaces': (
+        (type, types.ModuleType, types.ClassType) if six.PY2
+        else (type, types.ModuleType)
+    ),
+    '__UnboundLocalError': UnboundLocalError,
+    '__NameError': NameError,
+    '__StopIteration': StopIteration,
+}
+
+
+class _State(object):
+    """The static state before an instruction: stack depth and loops."""
+    def __init__(self, depth, loops):
+        self.depth = depth
+        # A tuple of (end offset, stack depth) for each enclosing loop.
+        self.loops = loops
+
+    def key(self):
+        return self.depth, self.loops
+
+
+class Translator(object):
+    """Translates one code object into the source of a function factory."""
+
+    def __init__(self, code):
+        self.code = code
+        self.instructions = code_info(code).instructions
+        self.states = {}
+        self.successor_offsets = {}
+        self.targets = set([0])
+        self.consts = []
+        self.const_names = {}
+        self.nargs = code.co_argcount
+        if code.co_flags & CO_VARARGS:
+            self.nargs += 1
+        if code.co_flags & CO_VARKEYWORDS:
+            self.nargs += 1
+        self.max_depth = 0
+
+    def fail(self, why):
+        raise UntranslatableError("%s: %s" % (self.code.co_name, why))
+
+    def analyze(self):
+        """Find the stack depth and enclosing loops before each instruction."""
+        code = self.code
+        if code.co_flags & CO_GENERATOR:
+            self.fail("generator")
+        if code.co_cellvars or code.co_freevars:
+            self.fail("closure")
+        if getattr(code, 'co_kwonlyargcount', 0):
+            self.fail("keyword-only arguments")
+
+        todo = [(0, _State(0, ()))]
+        while todo:
+            offset, state = todo.pop()
+            known = self.states.get(offset)
+            if known is not None:
+                if known.key() != state.key():
+                    self.fail("inconsistent stack at %d" % offset)
+                continue
+            self.states[offset] = state
+            self.max_depth = max(self.max_depth, state.depth)
+            successors = self.successors(offset, state)
+            self.successor_offsets[offset] = [o for o, _ in successors]
+            todo.extend(successors)
+        self.find_assigned()
+
+    def find_assigned(self):
+        """Find the locals that are certainly assigned before each instruction.
+
+        Loading those needs no check that they're bound.
+
+        """
+        code = self.code
+        self.assigned = {0: frozenset(range(self.nargs))}
+        todo = [0]
+        while todo:
+            offset = todo.pop()
+            assigned = self.assigned[offset]
+            byteCode, byteName, arguments, next_offset = \
+                self.instructions[offset]
+            if byteName == 'STORE_FAST':
+                assigned = assigned | set(
+                    [code.co_varnames.index(arguments[0])]
+                )
+            for successor in self.successor_offsets[offset]:
+                known = self.assigned.get(successor)
+                if known is None:
+                    self.assigned[successor] = assigned
+                elif not known <= assigned:
+                    self.assigned[successor] = known & assigned
+                else:
+                    continue
+                todo.append(successor)
+        # The locals that might be loaded before they're assigned.
+        self.maybe_unbound = set()
+        for offset, assigned in self.assigned.items():
+            byteCode, byteName, arguments, next_offset = \
+                self.instructions[offset]
+            if byteName == 'LOAD_FAST':
+                index = code.co_varnames.index(arguments[0])
+                if index not in assigned:
+                    self.maybe_unbound.add(index)
+
+    def successors(self, offset, state):
+        """Get the (offset, state) pairs that can follow `offset`."""
+        byteCode, byteName, arguments, next_offset = self.instructions[offset]
+        if byteName not in TRANSLATORS:
+            self.fail("can't translate %s" % byteName)
+        depth, loops = state.depth, state.loops
+        arg = arguments[0] if arguments else None
+
+        if byteName == 'LOAD_GLOBAL' and arg in LOCALS_READERS:
+            self.fail("reads its locals with %s" % arg)
+        if byteName in ('RETURN_VALUE', 'RAISE_VARARGS'):
+            return []
+        if byteName in ('JUMP_ABSOLUTE', 'JUMP_FORWARD'):
+            self.targets.add(arg)
+            return [(arg, state)]
+        if byteName in ('POP_JUMP_IF_TRUE', 'POP_JUMP_IF_FALSE'):
+            self.targets.add(arg)
+            after = _State(depth - 1, loops)
+            return [(arg, after), (next_offset, after)]
+        if byteName in ('JUMP_IF_TRUE_OR_POP', 'JUMP_IF_FALSE_OR_POP'):
+            self.targets.add(arg)
+            return [(arg, state), (next_offset, _State(depth - 1, loops))]
+        if byteName == 'FOR_ITER':
+            self.targets.add(arg)
+            return [
+                (arg, _State(depth - 1, loops)),
+                (next_offset, _State(depth + 1, loops)),
+            ]
+        if byteName == 'SETUP_LOOP':
+            return [(next_offset, _State(depth, loops + ((arg, depth),)))]
+        if byteName == 'POP_BLOCK':
+            if not loops:
+                self.fail("POP_BLOCK outside a loop")
+            return [(next_offset, _State(depth, loops[:-1]))]
+        if byteName == 'BREAK_LOOP':
+            if not loops:
+                self.fail("BREAK_LOOP outside a loop")
+            end, level = loops[-1]
+            self.targets.add(end)
+            return [(end, _State(level, loops[:-1]))]
+
+        effect = stack_effect(byteName, arg)
+        if depth + effect < 0:
+            self.fail("stack underflow at %d" % offset)
+        return [(next_offset, _State(depth + effect, loops))]
+
+    def const(self, value):
+        """Get the name the generated source uses for constant `value`."""
+        key = id(value)
+        name = self.const_names.get(key)
+        if name is None:
+            name = self.const_names[key] = "__k%d" % len(self.consts)
+            self.consts.append(value)
+        return name
+
+    def local(self, name):
+        """Get the name the generated source uses for local variable `name`."""
+        return "l%d" % self.code.co_varnames.index(name)
+
+    def translate(self):
+        """Get the source of a factory for a function running the code.
+
+        The factory is called with the VM, the code object, the globals, and
+        a tuple of the constants the code uses, and returns a real function
+        that does what the code does.  Its defaults are set afterwards.
+
+        """
+        self.analyze()
+        code = self.code
+
+        # The function takes its arguments by their real names, so that
+        # they can be passed by keyword, then keeps them as locals like all
+        # the others.  Tuple arguments in Python 2 have no real names.
+        names = []
+        for i, name in enumerate(code.co_varnames[:self.nargs]):
+            if not _is_identifier(name):
+                name = "l%d" % i
+            elif name.startswith("__"):
+                self.fail("argument %s" % name)
+            names.append(name)
+        params = names[:code.co_argcount]
+        i = code.co_argcount
+        if code.co_flags & CO_VARARGS:
+            params.append("*" + names[i])
+            i += 1
+        if code.co_flags & CO_VARKEYWORDS:
+            params.append("**" + names[i])
+
+        body = []
+        for offset in sorted(self.states):
+            if offset in self.targets:
+                state = self.states[offset]
+                if body and not body[-1][1]:
+                    # The previous block falls through into this one.
+                    body.append(("__pc = %d" % offset, True))
+                body.append(("if __pc == %d:" % offset, None))
+            body.extend(
+                (line, ends) for line, ends in self.instruction_source(offset)
+            )
+
+        lines = []
+        lines.append("def __factory(__vm, __code, __globals, __k):")
+        for i in range(len(self.consts)):
+            lines.append("    __k%d = __k[%d]" % (i, i))
+        lines.append("    __gget = __globals.get")
+        lines.append("    __Frame = __vm.make_tiered_frame")
+        signature = ", ".join(params)
+        lines.append("    def %s(%s):" % (_function_name(code), signature))
+        lines.append("        __frame = __Frame(__code, __globals)")
+        lines.append("        try:")
+        if names:
+            lines.append("            %s = %s" % (
+                ", ".join("l%d" % i for i in range(len(names))),
+                ", ".join(names),
+            ))
+        for i in sorted(self.maybe_unbound):
+            lines.append("            l%d = __UNBOUND" % i)
+        lines.append("            __bget = __frame.f_builtins.get")
+        lines.append("            __pc = 0")
+        lines.append("            while True:")
+        for line, ends in body:
+            if line.startswith("if __pc =="):
+                lines.append("                " + line)
+            else:
+                lines.append("                    " + line)
+        lines.append("        finally:")
+        lines.append("            __vm.pop_frame()")
+        lines.append("    return %s" % _function_name(code))
+        return "\n".join(lines) + "\n"
+
+    def instruction_source(self, offset):
+        """Get (line, ends_block) pairs of source for one instruction."""
+        byteCode, byteName, arguments, next_offset = self.instructions[offset]
+        depth = self.states[offset].depth
+        arg = arguments[0] if arguments else None
+        translator = TRANSLATORS[byteName]
+        source = translator(self, depth, arg, offset, byteName)
+        if isinstance(source, str):
+            source = [source]
+        ends = byteName in ENDS_BLOCK
+        return [(line, ends and i == len(source) - 1)
+                for i, line in enumerate(source)]
+
+
+def _is_identifier(name):
+    return (
+        bool(name) and not name[0].isdigit() and
+        all(c.isalnum() or c == '_' for c in name)
+    )
+
+
+def _function_name(code):
+    """The name of the generated function: the code's name if possible.
+
+    If not, `tier_function` gives it the code's name afterwards.
+
+    """
+    if _is_identifier(code.co_name):
+        return code.co_name
+    return "_tiered"
+
+
+def _renamed(code, name):
+    """Get a copy of code object `code`, called `name`."""
+    if hasattr(code, 'replace'):
+        return code.replace(co_name=name)
+    args = [
+        code.co_argcount, code.co_nlocals, code.co_stacksize, code.co_flags,
+        code.co_code, code.co_consts, code.co_names, code.co_varnames,
+        code.co_filename, name, code.co_firstlineno, code.co_lnotab,
+        code.co_freevars, code.co_cellvars,
+    ]
+    if PY3:
+        args.insert(1, code.co_kwonlyargcount)
+    return types.CodeType(*args)
+
+
+def s(n):
+    """The name of stack slot `n`."""
+    return "s%d" % n
+
+
+def stack_effect(byteName, arg):
+    """How much an instruction that doesn't jump changes the stack depth."""
+    if byteName in STACK_EFFECTS:
+        return STACK_EFFECTS[byteName]
+    if byteName.startswith(('BINARY_', 'INPLACE_')):
+        return -1
+    if byteName.startswith('UNARY_'):
+        return 0
+    if byteName in ('BUILD_TUPLE', 'BUILD_LIST', 'BUILD_SET', 'BUILD_SLICE'):
+        return 1 - arg
+    if byteName == 'UNPACK_SEQUENCE':
+        return arg - 1
+    if byteName == 'DUP_TOPX':
+        return arg
+    if byteName.startswith('CALL_FUNCTION'):
+        lenKw, lenPos = divmod(arg, 256)
+        effect = -(lenPos + 2 * lenKw)
+        if byteName == 'CALL_FUNCTION_VAR_KW':
+            effect -= 2
+        elif byteName != 'CALL_FUNCTION':
+            effect -= 1
+        return effect
+    if 'SLICE+' in byteName:
+        count = int(byteName[-1])
+        pops = 1 + (count + 1) // 2
+        if byteName.startswith('STORE_'):
+            return -pops - 1
+        if byteName.startswith('DELETE_'):
+            return -pops
+        return 1 - pops
+    raise UntranslatableError(byteName)     # pragma: no cover
+
+
+STACK_EFFECTS = {
+    'NOP': 0,
+    'LOAD_CONST': 1,
+    'LOAD_FAST': 1,
+    'STORE_FAST': -1,
+    'LOAD_GLOBAL': 1,
+    'STORE_GLOBAL': -1,
+    'LOAD_ATTR': 0,
+    'STORE_ATTR': -2,
+    'COMPARE_OP': -1,
+    'POP_TOP': -1,
+    'DUP_TOP': 1,
+    'ROT_TWO': 0,
+    'ROT_THREE': 0,
+    'ROT_FOUR': 0,
+    'DUP_TOP_TWO': 2,
+    'BUILD_MAP': 1,
+    'STORE_MAP': -2,
+    'STORE_SUBSCR': -3,
+    'DELETE_SUBSCR': -2,
+    'GET_ITER': 0,
+    'LIST_APPEND': -1,
+    'SET_ADD': -1,
+    'MAP_ADD': -2,
+    'PRINT_ITEM': -1,
+    'PRINT_ITEM_TO': -2,
+    'PRINT_NEWLINE': 0,
+    'PRINT_NEWLINE_TO': -1,
+}
+
+# The instructions that never fall through to the next one.
+ENDS_BLOCK = set([
+    'RETURN_VALUE', 'JUMP_ABSOLUTE', 'JUMP_FORWARD', 'BREAK_LOOP',
+    'RAISE_VARARGS',
+])
+
+
+## The translations of each instruction.  Each gets the translator, the stack
+## depth before the instruction, its argument, offset and name, and returns a
+## line of source or a list of them.
+
+def _nop(t, d, arg, offset, name):
+    return "pass"
+
+def _load_const(t, d, arg, offset, name):
+    return "%s = %s" % (s(d), t.const(arg))
+
+def _load_fast(t, d, arg, offset, name):
+    local = t.local(arg)
+    lines = []
+    if t.code.co_varnames.index(arg) not in t.assigned[offset]:
+        lines.append("if %s is __UNBOUND: raise __UnboundLocalError(%r)" % (
+            local, "local variable '%s' referenced before assignment" % arg,
+        ))
+    lines.append("%s = %s" % (s(d), local))
+    return lines
+
+def _store_fast(t, d, arg, offset, name):
+    return "%s = %s" % (t.local(arg), s(d-1))
+
+def _load_global(t, d, arg, offset, name):
+    return [
+        "%s = __gget(%r, __UNBOUND)" % (s(d), arg),
+        "if %s is __UNBOUND:" % s(d),
+        "    %s = __bget(%r, __UNBOUND)" % (s(d), arg),
+        "    if %s is __UNBOUND: raise __NameError(%r)" % (
+            s(d), "global name '%s' is not defined" % arg,
+        ),
+    ]
+
+def _store_global(t, d, arg, offset, name):
+    return [
+        "__globals[%r] = %s" % (arg, s(d-1)),
+        "__vm.name_changed(%r)" % (arg,),
+    ]
+
+def _load_attr(t, d, arg, offset, name):
+    return "%s = %s.%s" % (s(d-1), s(d-1), arg)
+
+def _store_attr(t, d, arg, offset, name):
+    return [
+        "%s.%s = %s" % (s(d-1), arg, s(d-2)),
+        "if __isinstance(%s, __namespaces): __vm.attribute_changed(%s, %r)" % (
+            s(d-1), s(d-1), arg,
+        ),
+    ]
+
+def _binary(t, d, arg, offset, name):
+    return "%s = %s" % (s(d-2), BINARY_OPERATORS[name[7:]] % (s(d-2), s(d-1)))
+
+def _inplace(t, d, arg, offset, name):
+    op = name[8:]
+    if op == 'TRUE_DIVIDE':
+        return INPLACE_OPERATORS[op] % (s(d-2), s(d-2), s(d-1))
+    return INPLACE_OPERATORS[op] % (s(d-2), s(d-1))
+
+def _unary(t, d, arg, offset, name):
+    return "%s = %s" % (s(d-1), UNARY_OPERATORS[name[6:]] % s(d-1))
+
+def _compare_op(t, d, arg, offset, name):
+    if arg >= len(COMPARE_OPERATORS):
+        t.fail("exception match")
+    return "%s = %s" % (s(d-2), COMPARE_OPERATORS[arg] % (s(d-2), s(d-1)))
+
+def _pop_top(t, d, arg, offset, name):
+    return "%s = None" % s(d-1)
+
+def _dup_top(t, d, arg, offset, name):
+    return "%s = %s" % (s(d), s(d-1))
+
+def _rot_two(t, d, arg, offset, name):
+    return "%s, %s = %s, %s" % (s(d-2), s(d-1), s(d-1), s(d-2))
+
+def _rot_three(t, d, arg, offset, name):
+    return "%s, %s, %s = %s, %s, %s" % (
+        s(d-3), s(d-2), s(d-1), s(d-1), s(d-3), s(d-2),
+    )
+
+def _rot_four(t, d, arg, offset, name):
+    return "%s, %s, %s, %s = %s, %s, %s, %s" % (
+        s(d-4), s(d-3), s(d-2), s(d-1), s(d-1), s(d-4), s(d-3), s(d-2),
+    )
+
+def _dup_topx(t, d, arg, offset, name):
+    return "%s = %s" % (
+        _tuple(_slots(d, arg)), _tuple(_slots(d - arg, arg)),
+    )
+
+def _dup_top_two(t, d, arg, offset, name):
+    return _dup_topx(t, d, 2, offset, name)
+
+def _slots(first, count):
+    return [s(i) for i in range(first, first + count)]
+
+def _tuple(elts):
+    if len(elts) == 1:
+        return "%s," % elts[0]
+    return ", ".join(elts)
+
+def _build_tuple(t, d, arg, offset, name):
+    return "%s = (%s)" % (s(d-arg), _tuple(_slots(d - arg, arg)))
+
+def _build_list(t, d, arg, offset, name):
+    return "%s = [%s]" % (s(d-arg), ", ".join(_slots(d - arg, arg)))
+
+def _build_set(t, d, arg, offset, name):
+    return "%s = __set([%s])" % (s(d-arg), ", ".join(_slots(d - arg, arg)))
+
+def _build_map(t, d, arg, offset, name):
+    return "%s = {}" % s(d)
+
+def _store_map(t, d, arg, offset, name):
+    return "%s[%s] = %s" % (s(d-3), s(d-1), s(d-2))
+
+def _build_slice(t, d, arg, offset, name):
+    return "%s = __slice(%s)" % (s(d-arg), ", ".join(_slots(d - arg, arg)))
+
+def _store_subscr(t, d, arg, offset, name):
+    return "%s[%s] = %s" % (s(d-2), s(d-1), s(d-3))
+
+def _delete_subscr(t, d, arg, offset, name):
+    return "del %s[%s]" % (s(d-2), s(d-1))
+
+def _unpack_sequence(t, d, arg, offset, name):
+    # The first item ends up on top of the stack.
+    targets = [s(d - 1 + i) for i in reversed(range(arg))]
+    return "%s = %s" % (_tuple(targets), s(d-1))
+
+def _slice(t, d, arg, offset, name):
+    count = int(name[-1])
+    base = d - 1 - (count + 1) // 2
+    start = end = ""
+    if count == 1:
+        start = s(base + 1)
+    elif count == 2:
+        end = s(base + 1)
+    elif count == 3:
+        start, end = s(base + 1), s(base + 2)
+    target = "%s[%s:%s]" % (s(base), start, end)
+    if name.startswith('STORE_'):
+        return "%s = %s" % (target, s(base - 1))
+    if name.startswith('DELETE_'):
+        return "del %s" % target
+    return "%s = %s" % (s(base), target)
+
+def _get_iter(t, d, arg, offset, name):
+    return "%s = __iter(%s)" % (s(d-1), s(d-1))
+
+def _for_iter(t, d, arg, offset, name):
+    return [
+        "try:",
+        "    %s = __next(%s)" % (s(d), s(d-1)),
+        "except __StopIteration:",
+        "    __pc = %d" % arg,
+        "    continue",
+    ]
+
+def _jump(t, d, arg, offset, name):
+    return ["__pc = %d" % arg, "continue"]
+
+def _pop_jump_if(t, d, arg, offset, name):
+    test = "not " if name.endswith('FALSE') else ""
+    return "if %s%s: __pc = %d; continue" % (test, s(d-1), arg)
+
+def _jump_if_or_pop(t, d, arg, offset, name):
+    test = "not " if name.startswith('JUMP_IF_FALSE') else ""
+    return "if %s%s: __pc = %d; continue" % (test, s(d-1), arg)
+
+def _block(t, d, arg, offset, name):
+    return "pass"
+
+def _break_loop(t, d, arg, offset, name):
+    end, level = t.states[offset].loops[-1]
+    return ["__pc = %d" % end, "continue"]
+
+def _return_value(t, d, arg, offset, name):
+    return "return %s" % s(d-1)
+
+def _call_function(t, d, arg, offset, name):
+    lenKw, lenPos = divmod(arg, 256)
+    extra = 0
+    if name == 'CALL_FUNCTION_VAR_KW':
+        extra = 2
+    elif name != 'CALL_FUNCTION':
+        extra = 1
+    base = d - extra - 2 * lenKw - lenPos - 1
+    posargs = "[%s]" % ", ".join(_slots(base + 1, lenPos))
+    first_kw = base + 1 + lenPos
+    namedargs = "{%s}" % ", ".join(
+        "%s: %s" % (s(first_kw + 2*i), s(first_kw + 2*i + 1))
+        for i in range(lenKw)
+    )
+    if name in ('CALL_FUNCTION_VAR', 'CALL_FUNCTION_VAR_KW'):
+        posargs += " + __list(%s)" % s(d - extra)
+    if name in ('CALL_FUNCTION_KW', 'CALL_FUNCTION_VAR_KW'):
+        namedargs = "__dict(%s, **%s)" % (namedargs, s(d-1))
+    return "%s = __vm.call_object(%s, %s, %s)" % (
+        s(base), s(base), posargs, namedargs,
+    )
+
+def _list_append(t, d, arg, offset, name):
+    return "%s.append(%s)" % (s(d - 1 - arg), s(d-1))
+
+def _set_add(t, d, arg, offset, name):
+    return "%s.add(%s)" % (s(d - 1 - arg), s(d-1))
+
+def _map_add(t, d, arg, offset, name):
+    return "%s[%s] = %s" % (s(d - 2 - arg), s(d-1), s(d-2))
+
+def _raise_varargs(t, d, arg, offset, name):
+    if arg == 0:
+        t.fail("re-raise")
+    args = _slots(d - arg, arg)
+    if PY3 and arg == 2:
+        return "raise %s from %s" % tuple(args)
+    return "raise %s" % ", ".join(args)
+
+def _print_item(t, d, arg, offset, name):
+    return "__vm.print_item(%s)" % s(d-1)
+
+def _print_item_to(t, d, arg, offset, name):
+    return "__vm.print_item(%s, %s)" % (s(d-2), s(d-1))
+
+def _print_newline(t, d, arg, offset, name):
+    return "__vm.print_newline()"
+
+def _print_newline_to(t, d, arg, offset, name):
+    return "__vm.print_newline(%s)" % s(d-1)
+
+
+TRANSLATORS = {
+    'NOP': _nop,
+    'LOAD_CONST': _load_const,
+    'LOAD_FAST': _load_fast,
+    'STORE_FAST': _store_fast,
+    'LOAD_GLOBAL': _load_global,
+    'STORE_GLOBAL': _store_global,
+    'LOAD_ATTR': _load_attr,
+    'STORE_ATTR': _store_attr,
+    'COMPARE_OP': _compare_op,
+    'POP_TOP': _pop_top,
+    'DUP_TOP': _dup_top,
+    'ROT_TWO': _rot_two,
+    'ROT_THREE': _rot_three,
+    'ROT_FOUR': _rot_four,
+    'DUP_TOPX': _dup_topx,
+    'DUP_TOP_TWO': _dup_top_two,
+    'BUILD_TUPLE': _build_tuple,
+    'BUILD_LIST': _build_list,
+    'BUILD_SET': _build_set,
+    'BUILD_MAP': _build_map,
+    'STORE_MAP': _store_map,
+    'BUILD_SLICE': _build_slice,
+    'STORE_SUBSCR': _store_subscr,
+    'DELETE_SUBSCR': _delete_subscr,
+    'UNPACK_SEQUENCE': _unpack_sequence,
+    'GET_ITER': _get_iter,
+    'FOR_ITER': _for_iter,
+    'JUMP_ABSOLUTE': _jump,
+    'JUMP_FORWARD': _jump,
+    'POP_JUMP_IF_TRUE': _pop_jump_if,
+    'POP_JUMP_IF_FALSE': _pop_jump_if,
+    'JUMP_IF_TRUE_OR_POP': _jump_if_or_pop,
+    'JUMP_IF_FALSE_OR_POP': _jump_if_or_pop,
+    'SETUP_LOOP': _block,
+    'POP_BLOCK': _block,
+    'BREAK_LOOP': _break_loop,
+    'RETURN_VALUE': _return_value,
+    'CALL_FUNCTION': _call_function,
+    'CALL_FUNCTION_VAR': _call_function,
+    'CALL_FUNCTION_KW': _call_function,
+    'CALL_FUNCTION_VAR_KW': _call_function,
+    'LIST_APPEND': _list_append,
+    'SET_ADD': _set_add,
+    'MAP_ADD': _map_add,
+    'RAISE_VARARGS': _raise_varargs,
+    'PRINT_ITEM': _print_item,
+    'PRINT_ITEM_TO': _print_item_to,
+    'PRINT_NEWLINE': _print_newline,
+    'PRINT_NEWLINE_TO': _print_newline_to,
+}
+for _name in dis.opname:
+    if _name.startswith('BINARY_') and _name[7:] in BINARY_OPERATORS:
+        TRANSLATORS[_name] = _binary
+    elif _name.startswith('INPLACE_') and _name[8:] in INPLACE_OPERATORS:
+        TRANSLATORS[_name] = _inplace
+    elif _name.startswith('UNARY_') and _name[6:] in UNARY_OPERATORS:
+        TRANSLATORS[_name] = _unary
+    elif 'SLICE+' in _name:
+        TRANSLATORS[_name] = _slice
+
+
+# For each code object, its (factory, constants), or None if it can't be
+# translated.
+_factories = weakref.WeakKeyDictionary()
+
+
+def function_factory(code):
+    """Get the (factory, constants) for `code`, or None if untranslatable."""
+    try:
+        return _factories[code]
+    except KeyError:
+        pass
+    try:
+        translator = Translator(code)
+        source = translator.translate()
+    except UntranslatableError:
+        made = None
+    else:
+        namespace = dict(HELPERS)
+        # Don't let this module's __future__ imports change the meaning of
+        # the generated source: `/` has to be classic division in Python 2.
+        compiled = compile(
+            source, "<tiered %s>" % code.co_name, "exec", 0, True
+        )
+        six.exec_(compiled, namespace)
+        made = (namespace['__factory'], tuple(translator.consts))
+    _factories[code] = made
+    return made
+
+
+def function_source(code):
+    """Get the generated source for `code`, for debugging."""
+    return Translator(code).translate()
+
+
+def tier_function(func):
+    """Make a real Python function that does what VM Function `func` does.
+
+    Returns None if `func`'s code can't be translated.
+
+    """
+    made = function_factory(func.func_code)
+    if made is None:
+        return None
+    factory, consts = made
+    tiered = factory(func._vm, func.func_code, func.func_globals, consts)
+    name = func.func_code.co_name
+    if tiered.__name__ != name:
+        # Errors in calling it name it the way they would the VM function.
+        tiered.__code__ = _renamed(tiered.__code__, name)
+        tiered.__name__ = name
+    if func.func_defaults:
+        if PY3:
+            tiered.__defaults__ = func.func_defaults
+        else:
+            tiered.func_defaults = func.func_defaults
+    return tiered
@@ -6,29 +6,167 @@ from __future__ import print_function, division
 import dis
 import inspect
 import linecache
-import logging
 import operator
 import sys
-import collections
+import types
+import weakref
 
 import six
-from six.moves import reprlib
 
 PY3, PY2 = six.PY3, not six.PY3
 
-from .pyobj import Frame, Block, Method, Function, Generator
-
-log = logging.getLogger(__name__)
-
-if six.PY3:
-    byteint = lambda b: b
+from .hooks import TraceHook, subscriptions
+from .pycode import (
+    OPNAMES, QUICKENED_NAMES, QUICKENED_OPERATOR, QUICKENED_SUBSCR,
+    SUPERINSTRUCTIONS, code_info, instruction_table,
+)
+from .pyobj import (
+    CO_OPTIMIZED, UNBOUND, Frame, Block, Method, Function, Generator,
+    BLOCK_LOOP, BLOCK_SETUP_EXCEPT, BLOCK_FINALLY, BLOCK_WITH,
+    BLOCK_EXCEPT_HANDLER,
+)
+from .recording import Recorder
+
+
+# Why the block stack is being unwound, like the WHY_* codes in ceval.c.  A
+# handler returns one of these, or None to carry on with the next
+# instruction.  They are pushed on the value stack for END_FINALLY, so they
+# are small ints, never None, never a string, and never an exception class.
+WHY_EXCEPTION = 1
+WHY_RERAISE = 2
+WHY_RETURN = 3
+WHY_BREAK = 4
+WHY_CONTINUE = 5
+WHY_YIELD = 6
+WHY_SILENCED = 7
+
+# For each name the inline caches of LOAD_GLOBAL and LOAD_NAME have looked
+# up, a one-item list holding a version number, bumped whenever a VM changes
+# that name in any namespace, so that the caches know to look it up again.
+# They are shared by all VMs, since VMs can share globals.
+_name_versions = {}
+
+# A cache slot that has never been filled, and never matches.
+EMPTY_NAME_CACHE = ([1], 0, None)
+
+
+def name_changed(name):
+    """Invalidate the inline caches for `name`."""
+    version = _name_versions.get(name)
+    if version is not None:
+        version[0] += 1
+
+
+def all_names_changed():
+    """Invalidate all the inline caches, when we can't tell what changed."""
+    for version in _name_versions.values():
+        version[0] += 1
+
+
+def _cache_name(name, val):
+    """Make an inline cache entry for `name`, found to be `val`."""
+    version = _name_versions.get(name)
+    if version is None:
+        version = _name_versions[name] = [0]
+    return (version, version[0], val)
+
+
+# Bumped whenever a VM changes an attribute of a class, so that the inline
+# caches of LOAD_ATTR and STORE_ATTR know to look their attributes up again.
+# One version for all classes: a change to a class changes its subclasses.
+_type_version = [0]
+
+# The classes whose attributes can be changed.
+if PY2:
+    CLASS_TYPES = (type, types.ClassType)
 else:
-    byteint = ord
-
-# Create a repr that won't overflow.
-repr_obj = reprlib.Repr()
-repr_obj.maxother = 120
-repper = repr_obj.repr
+    CLASS_TYPES = (type,)
+
+# How the attribute an inline cache entry is for was found.  Entries are
+# (type, type version, ATTR_* kind, class attribute, whether the instance has
+# a dict that could shadow the class attribute), and a kind of None means
+# the attribute is left to getattr and setattr.
+ATTR_INSTANCE = 1       # In the instance dict.
+ATTR_CLASS = 2          # A plain attribute of the class.
+ATTR_METHOD = 3         # A VM Function in the class, for LOAD_METHOD.
+
+# An attribute cache slot that has never been filled, and never matches.
+EMPTY_ATTR_CACHE = (None, -1, None, None, False)
+
+_missing = object()
+
+# How many finished frames a VM keeps for each code object.  Recursion
+# deeper than this makes new frames for the deepest calls.
+MAX_POOLED_FRAMES = 32
+
+# What LOAD_METHOD leaves on the stack in place of a method it didn't find.
+NO_METHOD = object()
+
+
+def _class_attribute(cls, name):
+    """Find attribute `name` in the classes of `cls`'s MRO, or _missing."""
+    for klass in cls.__mro__:
+        klass_dict = klass.__dict__
+        if name in klass_dict:
+            return klass_dict[name]
+    return _missing
+
+
+def _is_data_descriptor(attr):
+    attr_type = type(attr)
+    return hasattr(attr_type, '__set__') or hasattr(attr_type, '__delete__')
+
+
+def _attr_kind(obj, name):
+    """Work out how object.__getattribute__ finds attribute `name` of `obj`.
+
+    Returns an ATTR_* kind, or None if it doesn't, or it isn't one of the
+    ways we cache, and the class attribute, if any.
+
+    """
+    cls = type(obj)
+    if (isinstance(obj, CLASS_TYPES + (types.ModuleType,)) or
+            cls.__getattribute__ is not object.__getattribute__):
+        return None, None
+    attr = _class_attribute(cls, name)
+    if attr is not _missing and _is_data_descriptor(attr):
+        return None, None
+    instance_dict = getattr(obj, '__dict__', None)
+    if isinstance(instance_dict, dict) and name in instance_dict:
+        return ATTR_INSTANCE, None
+    if attr is _missing:
+        # Made by __getattr__.
+        return None, None
+    if isinstance(attr, Function):
+        return ATTR_METHOD, attr
+    if hasattr(type(attr), '__get__'):
+        return None, None
+    return ATTR_CLASS, attr
+
+
+def _cache_load_attr(obj, name):
+    """Make an inline cache entry for getting attribute `name` of `obj`."""
+    kind, attr = _attr_kind(obj, name)
+    has_dict = isinstance(getattr(obj, '__dict__', None), dict)
+    return (type(obj), _type_version[0], kind, attr, has_dict)
+
+
+def _cache_store_attr(obj, name):
+    """Make an inline cache entry for setting attribute `name` of `obj`.
+
+    Only attributes that plain object.__setattr__ stores in the instance
+    dict get the ATTR_INSTANCE kind.
+
+    """
+    cls = type(obj)
+    kind = None
+    if (not isinstance(obj, CLASS_TYPES + (types.ModuleType,)) and
+            cls.__setattr__ is object.__setattr__ and
+            isinstance(getattr(obj, '__dict__', None), dict)):
+        attr = _class_attribute(cls, name)
+        if attr is _missing or not _is_data_descriptor(attr):
+            kind = ATTR_INSTANCE
+    return (cls, _type_version[0], kind, None, True)
 
 
 class VirtualMachineError(Exception):
@@ -36,17 +174,244 @@ class VirtualMachineError(Exception):
     pass
 
 
+def _operator_handler(method, op):
+    """Make a handler that calls an operator-family `method` with `op`."""
+    def handler(vm):
+        return method(vm, op)
+    return handler
+
+
+def _unknown_handler(byteName):
+    """Make a handler for an opcode the VM has no method for."""
+    def handler(vm, *arguments):        # pragma: no cover
+        raise VirtualMachineError("unknown bytecode type: %s" % byteName)
+    return handler
+
+
+# The operator families whose instructions are handled by one method, given
+# the operator name, by instruction name prefix.
+OPERATOR_FAMILIES = [
+    ('UNARY_', 'unaryOperator'),
+    ('BINARY_', 'binaryOperator'),
+    ('INPLACE_', 'inplaceOperator'),
+]
+
+
+def _implementation(cls, byteName):
+    """Get the function that runs `byteName` in VM class `cls`, and the
+    operator name to call it with, or None."""
+    method = getattr(cls, 'byte_%s' % byteName, None)
+    if method is not None:
+        return six.get_unbound_function(method), None
+    for prefix, family in OPERATOR_FAMILIES:
+        if byteName.startswith(prefix):
+            method = getattr(cls, family)
+            return six.get_unbound_function(method), byteName[len(prefix):]
+    if 'SLICE+' in byteName:
+        return six.get_unbound_function(cls.sliceOperator), byteName
+    return None, None
+
+
+def _overrides(cls, byteNames):
+    """Does VM class `cls` run any of `byteNames` its own way?"""
+    return any(
+        _implementation(cls, byteName) != _implementation(
+            VirtualMachine, byteName,
+        )
+        for byteName in byteNames
+    )
+
+
+def _fused_handler(table, first, second, split):
+    """Make a handler for a superinstruction that runs the handlers of its
+    pair, the first with `split` of its arguments."""
+    first, second = table[first], table[second]
+    def handler(vm, *arguments):
+        first(vm, *arguments[:split])
+        return second(vm, *arguments[split:])
+    return handler
+
+
+def _deferring_handler(vm, left, right, fn, stats, byteCode, arguments):
+    """Run a quickened instruction as the instruction it was quickened
+    from."""
+    return vm.dispatch_table[byteCode](vm, *arguments)
+
+
+# How many arguments the first instruction of each superinstruction's pair
+# takes.
+_SPLITS = {
+    'LOAD_FAST': 2, 'STORE_FAST': 2, 'LOAD_CONST': 1, 'COMPARE_OP': 1,
+    'BINARY_ADD': 0,
+}
+
+
+def build_dispatch_table(cls):
+    """Build the opcode-indexed list of handlers for VM class `cls`.
+
+    Each handler is a plain function called as ``handler(vm, *arguments)``.
+    The UNARY_, BINARY_, INPLACE_ and SLICE+ families get handlers with the
+    operator name already bound, unless the class has a `byte_*` method for
+    the instruction.  Everything else uses the class's own `byte_*` method,
+    so subclasses that override them are honored.
+
+    Superinstructions and quickened instructions do the work of the
+    instructions they stand for themselves.  If the class overrides one of
+    those, they run its handlers instead, unless it overrides them too.
+
+    """
+    table = []
+    for byteName in OPNAMES:
+        function, op = _implementation(cls, byteName)
+        if function is None:
+            handler = _unknown_handler(byteName)
+        elif op is None:
+            handler = function
+        else:
+            handler = _operator_handler(function, op)
+        table.append(handler)
+    if cls is VirtualMachine:
+        return table
+    for pair in SUPERINSTRUCTIONS:
+        byteName = '%s__%s' % pair
+        if (not _overrides(cls, [byteName]) and _overrides(cls, pair)):
+            table[OPNAMES.index(byteName)] = _fused_handler(
+                table, OPNAMES.index(pair[0]), OPNAMES.index(pair[1]),
+                _SPLITS[pair[0]],
+            )
+    if _overrides(cls, QUICKENED_NAMES):
+        for byteName in ('QUICKENED_OPERATOR', 'QUICKENED_SUBSCR'):
+            if not _overrides(cls, [byteName]):
+                table[OPNAMES.index(byteName)] = _deferring_handler
+    return table
+
+
+def _bind_arguments(handler, arguments):
+    """Make a closure that calls `handler` with the VM and `arguments`."""
+    if not arguments:
+        return handler
+    elif len(arguments) == 1:
+        arg, = arguments
+        def op(vm):
+            return handler(vm, arg)
+    elif len(arguments) == 2:
+        arg1, arg2 = arguments
+        def op(vm):
+            return handler(vm, arg1, arg2)
+    else:
+        def op(vm):
+            return handler(vm, *arguments)
+    return op
+
+
+def compile_threaded(dispatch_table, instructions):
+    """Compile an instruction table into threaded code.
+
+    Returns two lists indexed by offset, like `instructions`: closures that
+    run each instruction's handler with its arguments already bound, called
+    with just the VM, and the offsets of the instructions that follow them.
+
+    """
+    ops = [None] * len(instructions)
+    next_offsets = [None] * len(instructions)
+    for offset, instruction in enumerate(instructions):
+        if instruction is None:
+            continue
+        byteCode, byteName, arguments, next_offset = instruction
+        ops[offset] = _bind_arguments(dispatch_table[byteCode], arguments)
+        next_offsets[offset] = next_offset
+    return ops, next_offsets
+
+
+# The ways a VirtualMachine can run frames.
+ENGINES = ('classic', 'threaded')
+
+# The exact operand types each operator is quickened for, by the operator's
+# name in BINARY_OPERATORS and INPLACE_OPERATORS.  COMPARE_OP's ordering
+# comparisons use COMPARED_TYPES.
+if PY2:
+    _NUMBERS = (int, long, float)
+else:
+    _NUMBERS = (int, float)
+_NUMBER_PAIRS = [(x, y) for x in _NUMBERS for y in _NUMBERS]
+_STRING_PAIRS = [(str, str), (six.text_type, six.text_type)]
+QUICKENED_TYPES = {
+    'ADD': _NUMBER_PAIRS + _STRING_PAIRS + [(list, list), (tuple, tuple)],
+    'SUBTRACT': _NUMBER_PAIRS,
+    'MULTIPLY': _NUMBER_PAIRS + [(str, int), (list, int)],
+    'DIVIDE': _NUMBER_PAIRS,
+    'TRUE_DIVIDE': _NUMBER_PAIRS,
+    'FLOOR_DIVIDE': _NUMBER_PAIRS,
+    'MODULO': _NUMBER_PAIRS + [(str, tuple)],
+    'SUBSCR': [
+        (list, int), (tuple, int), (str, int), (dict, str), (dict, int),
+    ],
+}
+COMPARED_TYPES = _NUMBER_PAIRS + _STRING_PAIRS + [(tuple, tuple)]
+# The COMPARE_OP argument of the comparisons that can be quickened: <, <=,
+# ==, !=, > and >=.
+QUICKENED_COMPARISONS = range(6)
+COMPARISON_SYMBOLS = ['<', '<=', '==', '!=', '>', '>=']
+
+# How often each quickened instruction's type guard hit or missed, by the
+# names of the instruction and the types.  Shared by all VMs, like the
+# quickened instruction tables.
+quickening_stats = {}
+
+
 class VirtualMachine(object):
-    def __init__(self):
+    def __init__(
+        self, superinstructions=False, engine='classic', hot_threshold=None,
+        optimize=False, inline_caches=False, quicken=False, recorder=None,
+    ):
+        # The opcode-indexed handlers for this class.
+        self.dispatch_table = self.get_dispatch_table()
+        # Run code with common pairs of instructions fused into one.
+        self.superinstructions = superinstructions
+        # How to run frames: one of ENGINES.
+        if engine not in ENGINES:
+            raise VirtualMachineError("Unknown engine: %r" % (engine,))
+        self.engine = engine
+        # Functions called more than this many times are translated into
+        # Python source and compiled, or never if None.
+        self.hot_threshold = hot_threshold
+        # Run code through the peephole optimizer in pycode first.
+        self.optimize = optimize
+        # How many instructions the optimizer removed from each code object
+        # this VM has run.
+        self.removed_instructions = {}
+        # Cache where LOAD_GLOBAL and LOAD_NAME find their names.  Only
+        # changes the VM makes are noticed: a namespace changed behind its
+        # back, say through globals(), leaves stale entries.
+        self.inline_caches = inline_caches
+        # The inline cache slots for each code object, and the namespaces
+        # they are for, see get_cache_slots.
+        self.cache_slots = {}
+        # Specialize arithmetic and comparisons for the types they see.
+        self.quicken = quicken
+        # Frames that finished running, kept to run the next call of their
+        # code, and how many frames were made and reused.  They are pooled
+        # by the id of their code, since equal code objects can have
+        # different line numbers: each frame keeps its code alive, so the
+        # id can't be reused while there are frames under it.
+        self.frame_pool = {}
+        self.frames_made = 0
+        self.frames_reused = 0
+        # The hooks watching the VM, their methods for each event, and
+        # whether any of them wants an event at all.
+        self.hooks = []
+        self.event_hooks = subscriptions(self.hooks)
+        self.instrumented = False
+        # The hook calling the trace function given to settrace.
+        self.trace_hook = None
         # The call stack of frames.
         self.frames = []
         # The current frame.
         self.frame = None
         self.return_value = None
         self.last_exception = None
-        self.variables = collections.defaultdict(int)
-        self.actions = []
-        self.datas = []
+        # What records the main function's data dependencies.
+        self.recorder = Recorder() if recorder is None else recorder
         
     def top(self):
         """Return the value at the top of the stack, with no changes."""
@@ -72,8 +437,9 @@ class VirtualMachine(object):
 
         """
         if n:
-            ret = self.frame.stack[-n:]
-            self.frame.stack[-n:] = []
+            stack = self.frame.stack
+            ret = stack[-n:]
+            del stack[-n:]
             return ret
         else:
             return []
@@ -94,9 +460,21 @@ class VirtualMachine(object):
     def pop_block(self):
         return self.frame.block_stack.pop()
 
-    def make_frame(self, code, callargs={}, f_globals=None, f_locals=None):
-        log.info("make_frame: code=%r, callargs=%s" % (code, repper(callargs)))
-        if f_globals is not None:
+    def make_frame(
+        self, code, callargs={}, f_globals=None, f_locals=None,
+        fast_locals=None, closure=None,
+    ):
+        """Make a frame to run `code`.
+
+        A function call passes its bound arguments as `fast_locals`, and
+        the frame gets a new namespace only if the code isn't optimized.
+        A closure passes the cells of its free variables as `closure`.
+
+        """
+        if fast_locals is not None:
+            if f_locals is None and not code.co_flags & CO_OPTIMIZED:
+                f_locals = {}
+        elif f_globals is not None:
             f_globals = f_globals
             if f_locals is None:
                 f_locals = f_globals
@@ -110,13 +488,105 @@ class VirtualMachine(object):
                 '__doc__': None,
                 '__package__': None,
             }
-        f_locals.update(callargs)
-        frame = Frame(code, f_globals, f_locals, self.frame)
+        if callargs:
+            f_locals.update(callargs)
+        pool = self.frame_pool.get(id(code))
+        if pool:
+            frame = pool.pop()
+            frame.setup(f_globals, f_locals, self.frame, fast_locals, closure)
+            if frame.name_caches is not None:
+                frame.name_caches, frame.attr_caches = (
+                    self.get_cache_slots(frame)
+                )
+            self.frames_reused += 1
+            return frame
+        frame = Frame(
+            code, f_globals, f_locals, self.frame, fast_locals, closure,
+        )
+        self.frames_made += 1
+        if (self.optimize or self.superinstructions or self.inline_caches or
+                self.quicken):
+            frame.instructions = instruction_table(
+                code, self.optimize, self.superinstructions,
+                self.inline_caches, self.quicken,
+            )
+            if self.inline_caches:
+                frame.name_caches, frame.attr_caches = (
+                    self.get_cache_slots(frame)
+                )
+            if self.optimize and code not in self.removed_instructions:
+                self.removed_instructions[code] = (
+                    code_info(code).removed_instructions
+                )
+        return frame
+
+    def release_frame(self, frame):
+        """Keep `frame`, which has returned, to run a later call of its code.
+
+        Only frames nothing else refers to can be released: not generator
+        frames, which are resumed later.
+
+        """
+        pool = self.frame_pool.get(id(frame.f_code))
+        if pool is None:
+            pool = self.frame_pool[id(frame.f_code)] = []
+        if len(pool) < MAX_POOLED_FRAMES:
+            frame.clear()
+            pool.append(frame)
+
+    def get_cache_slots(self, frame):
+        """Get the inline cache slots for running `frame`'s code.
+
+        Returns a list of slots for names and a list for attributes.  A
+        cached name is only good for the globals and builtins it was found
+        in, so the slots are started afresh if the code runs with others.
+
+        """
+        slots = self.cache_slots.get(frame.f_code)
+        if (slots is None or slots[0] is not frame.f_globals or
+                slots[1] is not frame.f_builtins):
+            names, attrs = code_info(frame.f_code).inline_caches[(
+                self.optimize, self.superinstructions, self.inline_caches,
+                self.quicken,
+            )]
+            slots = self.cache_slots[frame.f_code] = (
+                frame.f_globals, frame.f_builtins,
+                [EMPTY_NAME_CACHE] * names, [EMPTY_ATTR_CACHE] * attrs,
+            )
+        return slots[2], slots[3]
+
+    def name_changed(self, name):
+        """Note that `name` has changed in a namespace outside the VM."""
+        name_changed(name)
+
+    def can_run_tiered(self, code):
+        """Can a call of `code` made now run its translation by the source
+        tier?
+
+        Not if the recorder tracks the frame, since a translated function
+        keeps its locals to itself, and not while hooks are watching, since
+        it has no instructions to report.
+
+        """
+        return not (
+            self.instrumented
+            or self.recorder.tracks(code, len(self.frames) + 1)
+        )
+
+    def make_tiered_frame(self, code, f_globals):
+        """Make and push the frame for a call of a translated function.
+
+        The function keeps its locals itself, so the frame's are empty.
+
+        """
+        frame = Frame(code, f_globals, None, self.frame)
+        self.push_frame(frame)
         return frame
 
     def push_frame(self, frame):
         self.frames.append(frame)
         self.frame = frame
+        self.recorder.start(frame, len(self.frames))
 
     def pop_frame(self):
         self.frames.pop()
@@ -152,11 +622,11 @@ class VirtualMachine(object):
             raise VirtualMachineError("Frames left over!")
         if self.frame and self.frame.stack:             # pragma: no cover
             raise VirtualMachineError("Data left on stack! %r" % self.frame.stack)
-        
-        return self.variables, self.actions
+
+        return self.recorder.close()
 
     def unwind_block(self, block):
-        if block.type == 'except-handler':
+        if block.type == BLOCK_EXCEPT_HANDLER:
             offset = 3
         else:
             offset = 0
@@ -164,87 +634,90 @@ class VirtualMachine(object):
         while len(self.frame.stack) > block.level + offset:
             self.pop()
 
-        if block.type == 'except-handler':
+        if block.type == BLOCK_EXCEPT_HANDLER:
             tb, value, exctype = self.popn(3)
             self.last_exception = exctype, value, tb
 
     def parse_byte_and_args(self):
-        """ Parse 1 - 3 bytes of bytecode into
-        an instruction and optionally arguments."""
+        """ Get the next instruction and its arguments from the frame's
+        pre-decoded instruction table, and advance past it."""
         f = self.frame
         opoffset = f.f_lasti
-        byteCode = byteint(f.f_code.co_code[opoffset])
-        f.f_lasti += 1
-        byteName = dis.opname[byteCode]
-        arg = None
-        arguments = []
-        if byteCode >= dis.HAVE_ARGUMENT:
-            arg = f.f_code.co_code[f.f_lasti:f.f_lasti+2]
-            f.f_lasti += 2
-            intArg = byteint(arg[0]) + (byteint(arg[1]) << 8)
-            if byteCode in dis.hasconst:
-                arg = f.f_code.co_consts[intArg]
-            elif byteCode in dis.hasfree:
-                if intArg < len(f.f_code.co_cellvars):
-                    arg = f.f_code.co_cellvars[intArg]
-                else:
-                    var_idx = intArg - len(f.f_code.co_cellvars)
-                    arg = f.f_code.co_freevars[var_idx]
-            elif byteCode in dis.hasname:
-                arg = f.f_code.co_names[intArg]
-            elif byteCode in dis.hasjrel:
-                arg = f.f_lasti + intArg
-            elif byteCode in dis.hasjabs:
-                arg = intArg
-            elif byteCode in dis.haslocal:
-                arg = f.f_code.co_varnames[intArg]
-            else:
-                arg = intArg
-            arguments = [arg]
-
+        byteCode, byteName, arguments, f.f_lasti = f.instructions[opoffset]
         return byteName, arguments, opoffset
 
-    def log(self, byteName, arguments, opoffset):
-        """ Log arguments, block stack, and data stack for each opcode."""
-        op = "%d: %s" % (opoffset, byteName)
-        if arguments:
-            op += " %r" % (arguments[0],)
-        indent = "    "*(len(self.frames)-1)
-        stack_rep = repper(self.frame.stack)
-        block_stack_rep = repper(self.frame.block_stack)
-        stack_size = [sys.getsizeof(e) for e in self.frame.stack]
-        log.info("  %sdata: %s" % (indent, stack_rep))
-        log.info("  %sdata size: %s" % (indent, stack_size))
-        log.info("  %sblks: %s" % (indent, block_stack_rep))
-        log.info("%s%s" % (indent, op))
-
-    def dispatch(self, byteName, arguments):
-        """ Dispatch by bytename to the corresponding methods.
+    def add_hook(self, hook):
+        """Deliver the events `hook` has methods for, see `byterun.hooks`."""
+        self.hooks.append(hook)
+        self.subscribe()
+
+    def remove_hook(self, hook):
+        """Stop delivering events to `hook`."""
+        self.hooks.remove(hook)
+        self.subscribe()
+
+    def subscribe(self):
+        """Work out which hooks get each event, after the hooks change."""
+        self.event_hooks = subscriptions(self.hooks)
+        self.instrumented = any(self.event_hooks.values())
+
+    def settrace(self, tracefunc):
+        """Trace the code the VM runs with `tracefunc`, like sys.settrace.
+
+        None stops tracing.  See `byterun.hooks.TraceHook`.
+
+        """
+        if self.trace_hook in self.hooks:
+            self.remove_hook(self.trace_hook)
+        self.trace_hook = None
+        if tracefunc is not None:
+            self.trace_hook = TraceHook(tracefunc)
+            self.add_hook(self.trace_hook)
+
+    @classmethod
+    def get_dispatch_table(cls):
+        """Get the opcode-indexed handler table for this class.
+
+        It's built the first time each class needs it, so a subclass gets a
+        table of its own, with its own `byte_*` methods in it.
+
+        """
+        table = cls.__dict__.get('_dispatch_table')
+        if table is None:
+            table = cls._dispatch_table = build_dispatch_table(cls)
+            cls._threaded_codes = weakref.WeakKeyDictionary()
+        return table
+
+    def get_threaded_code(self, frame):
+        """Get the threaded code for the instructions `frame` will run.
+
+        It's compiled once per code object and instruction table for each VM
+        class, and shared by all its VMs.
+
+        """
+        instructions = frame.instructions
+        by_table = self._threaded_codes.setdefault(frame.f_code, {})
+        entry = by_table.get(id(instructions))
+        if entry is None:
+            # The entry keeps the table, so its id can't be reused while the
+            # entry exists: the table can outlive this code object's info,
+            # when an equal code object is the key here.
+            entry = by_table[id(instructions)] = (
+                instructions,
+                compile_threaded(self.dispatch_table, instructions),
+            )
+        return entry[1]
+
+    def dispatch(self, byteCode, arguments):
+        """ Dispatch by opcode to the corresponding handler.
         Exceptions are caught and set on the virtual machine."""
         why = None
         try:
-            if byteName.startswith('UNARY_'):
-                self.unaryOperator(byteName[6:])
-            elif byteName.startswith('BINARY_'):
-                self.binaryOperator(byteName[7:])
-            elif byteName.startswith('INPLACE_'):
-                self.inplaceOperator(byteName[8:])
-            elif 'SLICE+' in byteName:
-                self.sliceOperator(byteName)
-            else:
-                # dispatch
-                bytecode_fn = getattr(self, 'byte_%s' % byteName, None)
-                if not bytecode_fn:            # pragma: no cover
-                    raise VirtualMachineError(
-                        "unknown bytecode type: %s" % byteName
-                    )
-                why = bytecode_fn(*arguments)
-
+            why = self.dispatch_table[byteCode](self, *arguments)
         except:
             # deal with exceptions encountered while executing the op.
             self.last_exception = sys.exc_info()[:2] + (None,)
-            log.exception("Caught exception during execution")
-            why = 'exception'
+            why = WHY_EXCEPTION
 
         return why
 
@@ -252,33 +725,33 @@ class VirtualMachine(object):
         """ Manage a frame's block stack.
         Manipulate the block stack and data stack for looping,
         exception handling, or returning."""
-        assert why != 'yield'
+        assert why != WHY_YIELD
 
         block = self.frame.block_stack[-1]
-        if block.type == 'loop' and why == 'continue':
-            self.jump(self.return_value)
+        if block.type == BLOCK_LOOP and why == WHY_CONTINUE:
+            self.byte_JUMP_ABSOLUTE(self.return_value)
             why = None
             return why
 
         self.pop_block()
         self.unwind_block(block)
 
-        if block.type == 'loop' and why == 'break':
+        if block.type == BLOCK_LOOP and why == WHY_BREAK:
             why = None
             self.jump(block.handler)
             return why
 
         if PY2:
             if (
-                block.type == 'finally' or
-                (block.type == 'setup-except' and why == 'exception') or
-                block.type == 'with'
+                block.type == BLOCK_FINALLY or
+                (block.type == BLOCK_SETUP_EXCEPT and why == WHY_EXCEPTION) or
+                block.type == BLOCK_WITH
             ):
-                if why == 'exception':
+                if why == WHY_EXCEPTION:
                     exctype, value, tb = self.last_exception
                     self.push(tb, value, exctype)
                 else:
-                    if why in ('return', 'continue'):
+                    if why in (WHY_RETURN, WHY_CONTINUE):
                         self.push(self.return_value)
                     self.push(why)
 
@@ -288,10 +761,10 @@ class VirtualMachine(object):
 
         elif PY3:
             if (
-                why == 'exception' and
-                block.type in ['setup-except', 'finally']
+                why == WHY_EXCEPTION and
+                block.type in (BLOCK_SETUP_EXCEPT, BLOCK_FINALLY)
             ):
-                self.push_block('except-handler')
+                self.push_block(BLOCK_EXCEPT_HANDLER)
                 exctype, value, tb = self.last_exception
                 self.push(tb, value, exctype)
                 # PyErr_Normalize_Exception goes here
@@ -300,8 +773,8 @@ class VirtualMachine(object):
                 self.jump(block.handler)
                 return why
 
-            elif block.type == 'finally':
-                if why in ('return', 'continue'):
+            elif block.type == BLOCK_FINALLY:
+                if why in (WHY_RETURN, WHY_CONTINUE):
                     self.push(self.return_value)
                 self.push(why)
 
@@ -318,28 +791,25 @@ class VirtualMachine(object):
         Exceptions are raised, the return value is returned.
 
         """
+        if self.instrumented:
+            return self.run_frame_instrumented(frame)
+        if self.engine == 'threaded':
+            return self.run_frame_threaded(frame)
+
         self.push_frame(frame)
-        if len(self.frames) == 2:
-            self.main_lineno = frame.f_code.co_firstlineno + 1
-            self.main_argv = frame.f_locals.keys()
+        instructions = frame.instructions
         while True:
-            byteName, arguments, opoffset = self.parse_byte_and_args()
-
-            # we define the second frame is the main function.
-            if log.isEnabledFor(logging.INFO) and len(self.frames) == 2:
-                self.log(byteName, arguments, opoffset)
+            opoffset = frame.f_lasti
+            byteCode, byteName, arguments, frame.f_lasti = instructions[opoffset]
 
             # When unwinding the block stack, we need to keep track of why we
             # are doing it.
-            why = self.dispatch(byteName, arguments)
-            if why == 'exception':
-                # TODO: ceval calls PyTraceBack_Here, not sure what that does.
-                pass
+            why = self.dispatch(byteCode, arguments)
 
-            if why == 'reraise':
-                why = 'exception'
+            if why == WHY_RERAISE:
+                why = WHY_EXCEPTION
 
-            if why != 'yield':
+            if why != WHY_YIELD:
                 while why and frame.block_stack:
                     # Deal with any block management we need to do.
                     why = self.manage_block_stack(why)
@@ -351,7 +821,125 @@ class VirtualMachine(object):
 
         self.pop_frame()
 
-        if why == 'exception':
+        if why == WHY_EXCEPTION:
+            six.reraise(*self.last_exception)
+
+        return self.return_value
+
+    def run_frame_instrumented(self, frame):
+        """Run a frame like run_frame, delivering events to the hooks.
+
+        This is the loop for any engine while a hook wants events.  Like
+        CPython's, a line event comes before an instruction that starts a
+        line in the code's line number table, and before any instruction a
+        backward jump lands on.
+
+        """
+        event_hooks = self.event_hooks
+        line_hooks = event_hooks['line']
+        instruction_hooks = event_hooks['instruction']
+        exception_hooks = event_hooks['exception']
+        # Whether any hook wants to see each instruction run.
+        watching = line_hooks or instruction_hooks
+
+        self.push_frame(frame)
+        try:
+            for hook in event_hooks['call']:
+                hook(self, frame)
+        except:
+            self.pop_frame()
+            raise
+        instructions = frame.instructions
+        line_numbers = frame.line_numbers
+        line_starts = code_info(frame.f_code).line_starts
+        # A resumed generator carries on with the line it yielded on.
+        last_offset = frame.f_lasti
+        while True:
+            opoffset = frame.f_lasti
+            byteCode, byteName, arguments, frame.f_lasti = instructions[opoffset]
+
+            if not watching:
+                why = self.dispatch(byteCode, arguments)
+            else:
+                # An exception from a hook is raised in the code, as if by
+                # the instruction.
+                try:
+                    if line_hooks and (
+                            opoffset in line_starts or opoffset < last_offset):
+                        for hook in line_hooks:
+                            hook(self, frame, line_numbers[opoffset])
+                    last_offset = opoffset
+                    for hook in instruction_hooks:
+                        hook(self, frame, opoffset, byteName, arguments)
+                except:
+                    self.last_exception = sys.exc_info()[:2] + (None,)
+                    why = WHY_EXCEPTION
+                else:
+                    why = self.dispatch(byteCode, arguments)
+            if why == WHY_EXCEPTION:
+                for hook in exception_hooks:
+                    hook(self, frame, self.last_exception)
+
+            if why == WHY_RERAISE:
+                why = WHY_EXCEPTION
+
+            if why != WHY_YIELD:
+                while why and frame.block_stack:
+                    why = self.manage_block_stack(why)
+
+            if why:
+                break
+
+        # Like sys.settrace, a frame that ends with an exception returns
+        # None.
+        value = None if why == WHY_EXCEPTION else self.return_value
+        try:
+            for hook in event_hooks['return']:
+                hook(self, frame, value)
+        finally:
+            self.pop_frame()
+
+        if why == WHY_EXCEPTION:
+            six.reraise(*self.last_exception)
+
+        return self.return_value
+
+    def run_frame_threaded(self, frame):
+        """Run a frame with the threaded-code engine.
+
+        This does what run_frame does, but runs the frame's threaded code, so
+        each step is an indexed call of a closure, with no decoding and no
+        dispatch.  Hooks need the instrumented loop, so it's not used while
+        there are any.
+
+        """
+        ops, next_offsets = self.get_threaded_code(frame)
+        self.push_frame(frame)
+        while True:
+            offset = frame.f_lasti
+            frame.f_lasti = next_offsets[offset]
+            try:
+                why = ops[offset](self)
+            except:
+                self.last_exception = sys.exc_info()[:2] + (None,)
+                why = WHY_EXCEPTION
+
+            if why is None:
+                continue
+
+            if why == WHY_RERAISE:
+                why = WHY_EXCEPTION
+
+            if why != WHY_YIELD:
+                while why and frame.block_stack:
+                    why = self.manage_block_stack(why)
+
+            if why:
+                break
+
+        self.pop_frame()
+
+        if why == WHY_EXCEPTION:
             six.reraise(*self.last_exception)
 
         return self.return_value
@@ -359,10 +947,10 @@ class VirtualMachine(object):
     ## Stack manipulation
 
     def byte_LOAD_CONST(self, const):
-        self.push(const)
+        self.frame.stack.append(const)
 
     def byte_POP_TOP(self):
-        self.pop()
+        self.frame.stack.pop()
 
     def byte_DUP_TOP(self):
         self.push(self.top())
@@ -391,75 +979,98 @@ class VirtualMachine(object):
 
     ## Names
 
-    def byte_LOAD_NAME(self, name):
+    def byte_LOAD_NAME(self, name, slot=None):
         frame = self.frame
-        if name in frame.f_locals:
-            val = frame.f_locals[name]
+        if slot is not None:
+            version, seen, val = frame.name_caches[slot]
+            if version[0] == seen:
+                # The stack directly: this is the path to make fast.
+                frame.stack.append(val)
+                return
+        if name in frame.namespace:
+            val = frame.namespace[name]
         elif name in frame.f_globals:
             val = frame.f_globals[name]
         elif name in frame.f_builtins:
             val = frame.f_builtins[name]
         else:
             raise NameError("name '%s' is not defined" % name)
+        # Only worth caching where the locals are the globals: elsewhere,
+        # class bodies say, they run once.
+        if slot is not None and frame.namespace is frame.f_globals:
+            frame.name_caches[slot] = _cache_name(name, val)
         self.push(val)
 
     def byte_STORE_NAME(self, name):
-        self.frame.f_locals[name] = self.pop()
+        self.frame.namespace[name] = self.pop()
+        name_changed(name)
 
     def byte_DELETE_NAME(self, name):
-        del self.frame.f_locals[name]
+        del self.frame.namespace[name]
+        name_changed(name)
 
-    def byte_LOAD_FAST(self, name):
-        if name in self.frame.f_locals:
-            val = self.frame.f_locals[name]
-        else:
+    def byte_LOAD_FAST(self, name, index):
+        frame = self.frame
+        val = frame.fast_locals[index]
+        if val is UNBOUND:
             raise UnboundLocalError(
                 "local variable '%s' referenced before assignment" % name
             )
-        if len(self.frames) == 2:
-            if name not in self.main_argv:
-                self.datas.append(name)
-        self.push(val)
-
-    def byte_STORE_FAST(self, name):
-        val = self.pop()
-        if len(self.frames) == 2:
-            self.variables[name] = sys.getsizeof(val)
-
-            # means it runs LOAD_FAST before, and also means there is a data dependency.
-            self.datas.append(name)
-            self.datas.append(self.main_lineno)
-            self.actions.append(self.datas)
-            self.datas = []
-            self.main_lineno += 1
-        
-        self.frame.f_locals[name] = val
+        if frame.record:
+            frame.record.read(name)
+        frame.stack.append(val)
 
-    def byte_DELETE_FAST(self, name):
-        del self.frame.f_locals[name]
+    def byte_STORE_FAST(self, name, index):
+        frame = self.frame
+        val = frame.stack.pop()
+        if frame.record:
+            frame.record.write(name, val, frame.line_number())
+        frame.fast_locals[index] = val
+
+    def byte_DELETE_FAST(self, name, index):
+        fast_locals = self.frame.fast_locals
+        if fast_locals[index] is UNBOUND:
+            raise UnboundLocalError(
+                "local variable '%s' referenced before assignment" % name
+            )
+        fast_locals[index] = UNBOUND
 
-    def byte_LOAD_GLOBAL(self, name):
+    def byte_LOAD_GLOBAL(self, name, slot=None):
         f = self.frame
+        if slot is not None:
+            version, seen, val = f.name_caches[slot]
+            if version[0] == seen:
+                f.stack.append(val)
+                return
         if name in f.f_globals:
             val = f.f_globals[name]
         elif name in f.f_builtins:
             val = f.f_builtins[name]
         else:
             raise NameError("global name '%s' is not defined" % name)
+        if slot is not None:
+            f.name_caches[slot] = _cache_name(name, val)
         self.push(val)
 
     def byte_STORE_GLOBAL(self, name):
         f = self.frame
         f.f_globals[name] = self.pop()
+        name_changed(name)
 
-    def byte_LOAD_DEREF(self, name):
-        self.push(self.frame.cells[name].get())
+    def byte_DELETE_GLOBAL(self, name):
+        del self.frame.f_globals[name]
+        name_changed(name)
 
-    def byte_STORE_DEREF(self, name):
-        self.frame.cells[name].set(self.pop())
+    def byte_LOAD_DEREF(self, name, index):
+        frame = self.frame
+        frame.stack.append(frame.cells[index].contents)
+
+    def byte_STORE_DEREF(self, name, index):
+        frame = self.frame
+        frame.cells[index].contents = frame.stack.pop()
 
     def byte_LOAD_LOCALS(self):
-        self.push(self.frame.f_locals)
+        self.push(self.frame.namespace)
 
     ## Operators
 
@@ -472,8 +1083,8 @@ class VirtualMachine(object):
     }
 
     def unaryOperator(self, op):
-        x = self.pop()
-        self.push(self.UNARY_OPERATORS[op](x))
+        stack = self.frame.stack
+        stack[-1] = self.UNARY_OPERATORS[op](stack[-1])
 
     BINARY_OPERATORS = {
         'POWER':    pow,
@@ -493,38 +1104,30 @@ class VirtualMachine(object):
     }
 
     def binaryOperator(self, op):
-        x, y = self.popn(2)
-        self.push(self.BINARY_OPERATORS[op](x, y))
+        stack = self.frame.stack
+        y = stack.pop()
+        stack[-1] = self.BINARY_OPERATORS[op](stack[-1], y)
+
+    INPLACE_OPERATORS = {
+        'POWER':    operator.ipow,
+        'MULTIPLY': operator.imul,
+        'DIVIDE':   getattr(operator, 'idiv', lambda x, y: None),
+        'FLOOR_DIVIDE': operator.ifloordiv,
+        'TRUE_DIVIDE':  operator.itruediv,
+        'MODULO':   operator.imod,
+        'ADD':      operator.iadd,
+        'SUBTRACT': operator.isub,
+        'LSHIFT':   operator.ilshift,
+        'RSHIFT':   operator.irshift,
+        'AND':      operator.iand,
+        'XOR':      operator.ixor,
+        'OR':       operator.ior,
+    }
 
     def inplaceOperator(self, op):
-        x, y = self.popn(2)
-        if op == 'POWER':
-            x **= y
-        elif op == 'MULTIPLY':
-            x *= y
-        elif op in ['DIVIDE', 'FLOOR_DIVIDE']:
-            x //= y
-        elif op == 'TRUE_DIVIDE':
-            x /= y
-        elif op == 'MODULO':
-            x %= y
-        elif op == 'ADD':
-            x += y
-        elif op == 'SUBTRACT':
-            x -= y
-        elif op == 'LSHIFT':
-            x <<= y
-        elif op == 'RSHIFT':
-            x >>= y
-        elif op == 'AND':
-            x &= y
-        elif op == 'XOR':
-            x ^= y
-        elif op == 'OR':
-            x |= y
-        else:           # pragma: no cover
-            raise VirtualMachineError("Unknown in-place operator: %r" % op)
-        self.push(x)
+        stack = self.frame.stack
+        y = stack.pop()
+        stack[-1] = self.INPLACE_OPERATORS[op](stack[-1], y)
 
     def sliceOperator(self, op):
         start = 0
@@ -562,27 +1165,212 @@ class VirtualMachine(object):
     ]
 
     def byte_COMPARE_OP(self, opnum):
+        stack = self.frame.stack
+        y = stack.pop()
+        stack[-1] = self.COMPARE_OPERATORS[opnum](stack[-1], y)
+
+    ## Quickening
+
+    def byte_ADAPTIVE_OPERATOR(
+        self, byteCode, byteName, arguments, offset, countdown,
+    ):
+        countdown[0] -= 1
+        if countdown[0] <= 0:
+            self.quicken_instruction(byteCode, byteName, arguments, offset)
+        return self.dispatch_table[byteCode](self, *arguments)
+
+    def quicken_instruction(self, byteCode, byteName, arguments, offset):
+        """Replace the adaptive instruction at `offset` in the frame.
+
+        If the types of the operands now on the stack are ones we specialize
+        for, it becomes a QUICKENED_OPERATOR, otherwise the generic
+        instruction again.
+
+        """
+        frame = self.frame
+        stack = frame.stack
+        operand_types = type(stack[-2]), type(stack[-1])
+        if byteName == 'COMPARE_OP':
+            opnum, = arguments
+            if opnum in QUICKENED_COMPARISONS and operand_types in COMPARED_TYPES:
+                fn = self.COMPARE_OPERATORS[opnum]
+                name = COMPARISON_SYMBOLS[opnum]
+            else:
+                fn = None
+        else:
+            family, op = byteName.split('_', 1)
+            if operand_types in QUICKENED_TYPES[op]:
+                if family == 'BINARY':
+                    fn = self.BINARY_OPERATORS[op]
+                else:
+                    fn = self.INPLACE_OPERATORS[op]
+                name = byteName
+            else:
+                fn = None
+
+        next_offset = frame.instructions[offset][3]
+        if fn is None:
+            instruction = (byteCode, byteName, arguments, next_offset)
+        else:
+            name = "%s(%s, %s)" % (
+                name, operand_types[0].__name__, operand_types[1].__name__
+            )
+            stats = quickening_stats.setdefault(name, [0, 0])
+            if byteName == 'BINARY_SUBSCR':
+                # Subscripts have their own, for the recorder to see them.
+                opcode, opname = QUICKENED_SUBSCR, 'QUICKENED_SUBSCR'
+            else:
+                opcode, opname = QUICKENED_OPERATOR, 'QUICKENED_OPERATOR'
+            instruction = (
+                opcode, opname,
+                operand_types + (fn, stats, byteCode, arguments),
+                next_offset,
+            )
+        frame.instructions[offset] = instruction
+        if self.engine == 'threaded':
+            ops, next_offsets = self.get_threaded_code(frame)
+            ops[offset] = _bind_arguments(
+                self.dispatch_table[instruction[0]], instruction[2]
+            )
+
+    def byte_QUICKENED_OPERATOR(
+        self, left, right, fn, stats, byteCode, arguments,
+    ):
+        stack = self.frame.stack
+        if type(stack[-2]) is left and type(stack[-1]) is right:
+            stats[0] += 1
+            y = stack.pop()
+            stack[-1] = fn(stack[-1], y)
+        else:
+            stats[1] += 1
+            return self.dispatch_table[byteCode](self, *arguments)
+
+    def byte_QUICKENED_SUBSCR(
+        self, left, right, fn, stats, byteCode, arguments,
+    ):
+        frame = self.frame
+        stack = frame.stack
+        if type(stack[-2]) is left and type(stack[-1]) is right:
+            stats[0] += 1
+            key = stack.pop()
+            obj = stack[-1]
+            stack[-1] = obj[key]
+            if frame.record and frame.record.heap:
+                frame.record.read_item(obj, key)
+        else:
+            stats[1] += 1
+            return self.dispatch_table[byteCode](self, *arguments)
+
+    ## Superinstructions
+
+    def byte_LOAD_FAST__LOAD_FAST(self, name1, index1, name2, index2):
+        self.byte_LOAD_FAST(name1, index1)
+        self.byte_LOAD_FAST(name2, index2)
+
+    def byte_LOAD_FAST__LOAD_ATTR(self, name, index, attr, slot=None):
+        self.byte_LOAD_FAST(name, index)
+        self.byte_LOAD_ATTR(attr, slot)
+
+    def byte_LOAD_FAST__LOAD_CONST(self, name, index, const):
+        self.byte_LOAD_FAST(name, index)
+        self.push(const)
+
+    def byte_LOAD_FAST__STORE_FAST(self, name1, index1, name2, index2):
+        self.byte_LOAD_FAST(name1, index1)
+        self.byte_STORE_FAST(name2, index2)
+
+    def byte_STORE_FAST__JUMP_ABSOLUTE(self, name, index, jump):
+        self.byte_STORE_FAST(name, index)
+        self.byte_JUMP_ABSOLUTE(jump)
+
+    def byte_COMPARE_OP__POP_JUMP_IF_FALSE(self, opnum, jump):
+        x, y = self.popn(2)
+        if not self.COMPARE_OPERATORS[opnum](x, y):
+            frame = self.frame
+            frame.f_lasti = jump
+            if frame.record:
+                frame.record.jumped(jump)
+
+    def byte_BINARY_ADD__STORE_FAST(self, name, index):
         x, y = self.popn(2)
-        self.push(self.COMPARE_OPERATORS[opnum](x, y))
+        self.push(x + y)
+        self.byte_STORE_FAST(name, index)
+
+    def byte_LOAD_CONST__BINARY_ADD(self, const):
+        self.push(self.pop() + const)
 
     ## Attributes and indexing
 
-    def byte_LOAD_ATTR(self, attr):
-        obj = self.pop()
-        val = getattr(obj, attr)
-        self.push(val)
+    # A frame the recorder tracks, if it follows the heap, records the
+    # attributes and items it loads and stores, by the labels of the objects.
 
-    def byte_STORE_ATTR(self, name):
+    def byte_LOAD_ATTR(self, attr, slot=None):
+        frame = self.frame
+        stack = frame.stack
+        obj = stack[-1]
+        if frame.record and frame.record.heap:
+            frame.record.read_attr(obj, attr)
+        if slot is None:
+            stack[-1] = getattr(obj, attr)
+            return
+        cls, seen, kind, val, has_dict = frame.attr_caches[slot]
+        if cls is not type(obj) or seen != _type_version[0]:
+            frame.attr_caches[slot] = _cache_load_attr(obj, attr)
+            stack[-1] = getattr(obj, attr)
+        elif kind == ATTR_INSTANCE:
+            try:
+                stack[-1] = obj.__dict__[attr]
+            except KeyError:
+                stack[-1] = getattr(obj, attr)
+        elif kind == ATTR_CLASS and not (has_dict and attr in obj.__dict__):
+            stack[-1] = val
+        else:
+            # Methods are bound by getattr: calls of them skip binding with
+            # LOAD_METHOD instead.
+            stack[-1] = getattr(obj, attr)
+
+    def byte_STORE_ATTR(self, name, slot=None):
         val, obj = self.popn(2)
         setattr(obj, name, val)
+        frame = self.frame
+        if frame.record and frame.record.heap:
+            frame.record.write_attr(obj, name, val, frame.line_number())
+        if slot is not None:
+            cls, seen, kind, _, _ = self.frame.attr_caches[slot]
+            if (kind == ATTR_INSTANCE and cls is type(obj) and
+                    seen == _type_version[0]):
+                # An instance attribute: no caches to invalidate.
+                return
+            self.frame.attr_caches[slot] = _cache_store_attr(obj, name)
+        self.attribute_changed(obj, name)
 
     def byte_DELETE_ATTR(self, name):
         obj = self.pop()
         delattr(obj, name)
+        self.attribute_changed(obj, name)
+
+    def attribute_changed(self, obj, name):
+        """Invalidate the inline caches that attribute `name` of `obj` affects."""
+        if isinstance(obj, CLASS_TYPES):
+            _type_version[0] += 1
+        elif isinstance(obj, types.ModuleType):
+            name_changed(name)
+
+    def byte_BINARY_SUBSCR(self):
+        frame = self.frame
+        stack = frame.stack
+        key = stack.pop()
+        obj = stack[-1]
+        stack[-1] = obj[key]
+        if frame.record and frame.record.heap:
+            frame.record.read_item(obj, key)
 
     def byte_STORE_SUBSCR(self):
         val, obj, subscr = self.popn(3)
         obj[subscr] = val
+        frame = self.frame
+        if frame.record and frame.record.heap:
+            frame.record.write_item(obj, subscr, val, frame.line_number())
 
     def byte_DELETE_SUBSCR(self):
         obj, subscr = self.popn(2)
@@ -611,6 +1399,9 @@ class VirtualMachine(object):
         the_map, val, key = self.popn(3)
         the_map[key] = val
         self.push(the_map)
+        frame = self.frame
+        if frame.record and frame.record.heap:
+            frame.record.write_item(the_map, key, val, frame.line_number())
 
     def byte_UNPACK_SEQUENCE(self, count):
         seq = self.pop()
@@ -631,6 +1422,11 @@ class VirtualMachine(object):
         val = self.pop()
         the_list = self.peek(count)
         the_list.append(val)
+        frame = self.frame
+        if frame.record and frame.record.heap:
+            frame.record.write_item(
+                the_list, len(the_list) - 1, val, frame.line_number()
+            )
 
     def byte_SET_ADD(self, count):
         val = self.pop()
@@ -641,6 +1437,9 @@ class VirtualMachine(object):
         val, key = self.popn(2)
         the_map = self.peek(count)
         the_map[key] = val
+        frame = self.frame
+        if frame.record and frame.record.heap:
+            frame.record.write_item(the_map, key, val, frame.line_number())
 
     ## Printing
 
@@ -688,8 +1487,14 @@ class VirtualMachine(object):
     def byte_JUMP_FORWARD(self, jump):
         self.jump(jump)
 
+    # A tracked frame is told of the jumps that can go back to the head of
+    # a loop, so the recorder can count the iterations.
+
     def byte_JUMP_ABSOLUTE(self, jump):
-        self.jump(jump)
+        frame = self.frame
+        frame.f_lasti = jump
+        if frame.record:
+            frame.record.jumped(jump)
 
     if 0:   # Not in py2.7
         def byte_JUMP_IF_TRUE(self, jump):
@@ -703,14 +1508,18 @@ class VirtualMachine(object):
                 self.jump(jump)
 
     def byte_POP_JUMP_IF_TRUE(self, jump):
-        val = self.pop()
-        if val:
-            self.jump(jump)
+        frame = self.frame
+        if frame.stack.pop():
+            frame.f_lasti = jump
+            if frame.record:
+                frame.record.jumped(jump)
 
     def byte_POP_JUMP_IF_FALSE(self, jump):
-        val = self.pop()
-        if not val:
-            self.jump(jump)
+        frame = self.frame
+        if not frame.stack.pop():
+            frame.f_lasti = jump
+            if frame.record:
+                frame.record.jumped(jump)
 
     def byte_JUMP_IF_TRUE_OR_POP(self, jump):
         val = self.top()
@@ -729,7 +1538,7 @@ class VirtualMachine(object):
     ## Blocks
 
     def byte_SETUP_LOOP(self, dest):
-        self.push_block('loop', dest)
+        self.push_block(BLOCK_LOOP, dest)
 
     def byte_GET_ITER(self):
         self.push(iter(self.pop()))
@@ -744,7 +1553,7 @@ class VirtualMachine(object):
             self.jump(jump)
 
     def byte_BREAK_LOOP(self):
-        return 'break'
+        return WHY_BREAK
 
     def byte_CONTINUE_LOOP(self, dest):
         # This is a trick with the return value.
@@ -754,23 +1563,23 @@ class VirtualMachine(object):
         # pushed on the stack for both, so continue puts the jump destination
         # into return_value.
         self.return_value = dest
-        return 'continue'
+        return WHY_CONTINUE
 
     def byte_SETUP_EXCEPT(self, dest):
-        self.push_block('setup-except', dest)
+        self.push_block(BLOCK_SETUP_EXCEPT, dest)
 
     def byte_SETUP_FINALLY(self, dest):
-        self.push_block('finally', dest)
+        self.push_block(BLOCK_FINALLY, dest)
 
     def byte_END_FINALLY(self):
         v = self.pop()
-        if isinstance(v, str):
+        if isinstance(v, int):
             why = v
-            if why in ('return', 'continue'):
+            if why in (WHY_RETURN, WHY_CONTINUE):
                 self.return_value = self.pop()
-            if why == 'silenced':       # PY3
+            if why == WHY_SILENCED:       # PY3
                 block = self.pop_block()
-                assert block.type == 'except-handler'
+                assert block.type == BLOCK_EXCEPT_HANDLER
                 self.unwind_block(block)
                 why = None
         elif v is None:
@@ -780,7 +1589,7 @@ class VirtualMachine(object):
             val = self.pop()
             tb = self.pop()
             self.last_exception = (exctype, val, tb)
-            why = 'reraise'
+            why = WHY_RERAISE
         else:       # pragma: no cover
             raise VirtualMachineError("Confused END_FINALLY")
         return why
@@ -813,9 +1622,9 @@ class VirtualMachine(object):
             self.last_exception = (exctype, val, tb)
 
             if tb:
-                return 'reraise'
+                return WHY_RERAISE
             else:
-                return 'exception'
+                return WHY_EXCEPTION
 
     elif PY3:
         def byte_RAISE_VARARGS(self, argc):
@@ -831,9 +1640,9 @@ class VirtualMachine(object):
             if exc is None:         # reraise
                 exc_type, val, tb = self.last_exception
                 if exc_type is None:
-                    return 'exception'      # error
+                    return WHY_EXCEPTION      # error
                 else:
-                    return 'reraise'
+                    return WHY_RERAISE
 
             elif type(exc) == type:
                 # As in `raise ValueError`
@@ -844,7 +1653,7 @@ class VirtualMachine(object):
                 exc_type = type(exc)
                 val = exc
             else:
-                return 'exception'      # error
+                return WHY_EXCEPTION      # error
 
             # If you reach this point, you're guaranteed that
             # val is a valid exception instance and exc_type is its class.
@@ -853,16 +1662,16 @@ class VirtualMachine(object):
                 if type(cause) == type:
                     cause = cause()
                 elif not isinstance(cause, BaseException):
-                    return 'exception'  # error
+                    return WHY_EXCEPTION  # error
 
                 val.__cause__ = cause
 
             self.last_exception = exc_type, val, val.__traceback__
-            return 'exception'
+            return WHY_EXCEPTION
 
     def byte_POP_EXCEPT(self):
         block = self.pop_block()
-        if block.type != 'except-handler':
+        if block.type != BLOCK_EXCEPT_HANDLER:
             raise Exception("popped block is not an except handler")
         self.unwind_block(block)
 
@@ -871,9 +1680,9 @@ class VirtualMachine(object):
         self.push(ctxmgr.__exit__)
         ctxmgr_obj = ctxmgr.__enter__()
         if PY2:
-            self.push_block('with', dest)
+            self.push_block(BLOCK_WITH, dest)
         elif PY3:
-            self.push_block('finally', dest)
+            self.push_block(BLOCK_FINALLY, dest)
         self.push(ctxmgr_obj)
 
     def byte_WITH_CLEANUP(self):
@@ -884,8 +1693,8 @@ class VirtualMachine(object):
         u = self.top()
         if u is None:
             exit_func = self.pop(1)
-        elif isinstance(u, str):
-            if u in ('return', 'continue'):
+        elif isinstance(u, int):
+            if u in (WHY_RETURN, WHY_CONTINUE):
                 exit_func = self.pop(2)
             else:
                 exit_func = self.pop(1)
@@ -903,7 +1712,7 @@ class VirtualMachine(object):
                 self.push(None)
                 self.push(w, v, u)
                 block = self.pop_block()
-                assert block.type == 'except-handler'
+                assert block.type == BLOCK_EXCEPT_HANDLER
                 self.push_block(block.type, block.handler, block.level-1)
         else:       # pragma: no cover
             raise VirtualMachineError("Confused WITH_CLEANUP")
@@ -915,7 +1724,7 @@ class VirtualMachine(object):
                 self.popn(3)
                 self.push(None)
             elif PY3:
-                self.push('silenced')
+                self.push(WHY_SILENCED)
 
     ## Functions
 
@@ -930,8 +1739,8 @@ class VirtualMachine(object):
         fn = Function(name, code, globs, defaults, None, self)
         self.push(fn)
 
-    def byte_LOAD_CLOSURE(self, name):
-        self.push(self.frame.cells[name])
+    def byte_LOAD_CLOSURE(self, name, index):
+        self.push(self.frame.cells[index])
 
     def byte_MAKE_CLOSURE(self, argc):
         if PY3:
@@ -962,6 +1771,24 @@ class VirtualMachine(object):
 
     def call_function(self, arg, args, kwargs):
         lenKw, lenPos = divmod(arg, 256)
+        if not (lenKw or args or kwargs):
+            # Only positional arguments: a VM function gets them straight
+            # from the stack.
+            stack = self.frame.stack
+            first = len(stack) - lenPos
+            func = stack[first - 1]
+            func_type = type(func)
+            if func_type is Method and func.im_self is not None:
+                posargs = [func.im_self]
+                posargs.extend(stack[first:])
+                func = func.im_func
+                func_type = type(func)
+            else:
+                posargs = stack[first:]
+            if func_type is Function:
+                del stack[first - 1:]
+                stack.append(func.call(posargs, {}))
+                return
         namedargs = {}
         for i in range(lenKw):
             key, val = self.popn(2)
@@ -971,7 +1798,52 @@ class VirtualMachine(object):
         posargs.extend(args)
 
         func = self.pop()
+        self.push(self.call_object(func, posargs, namedargs))
+
+    def byte_LOAD_METHOD(self, name, slot=None):
         frame = self.frame
+        stack = frame.stack
+        obj = stack[-1]
+        if frame.record and frame.record.heap:
+            frame.record.read_attr(obj, name)
+        if slot is not None:
+            cls, seen, kind, method, has_dict = frame.attr_caches[slot]
+            if cls is not type(obj) or seen != _type_version[0]:
+                frame.attr_caches[slot] = _cache_load_attr(obj, name)
+            elif kind == ATTR_METHOD and not (
+                    has_dict and name in obj.__dict__):
+                stack[-1] = method
+                stack.append(obj)
+                return
+        # Without a cache, a method has to be bound to be found at all, but
+        # CALL_METHOD can still skip calling through the bound method.
+        attr = getattr(obj, name)
+        if type(attr) is Method and attr.im_self is obj:
+            stack[-1] = attr.im_func
+            stack.append(obj)
+        else:
+            stack[-1] = NO_METHOD
+            stack.append(attr)
+
+    def byte_CALL_METHOD(self, arg):
+        lenKw, lenPos = divmod(arg, 256)
+        stack = self.frame.stack
+        # LOAD_METHOD left the function and self, or NO_METHOD and what to
+        # call, under the arguments.
+        depth = 2 + lenPos + 2 * lenKw
+        method = stack[-depth]
+        if method is NO_METHOD:
+            del stack[-depth]
+            return self.call_function(arg, [], {})
+        if not lenKw and type(method) is Function:
+            posargs = stack[1 - depth:]
+            del stack[-depth:]
+            stack.append(method.call(posargs, {}))
+            return
+        return self.call_function(arg + 1, [], {})
+
+    def call_object(self, func, posargs, namedargs):
+        """Call `func` with a list of positional and a dict of named args."""
         if hasattr(func, 'im_func'):
             # Methods get self as an implicit first parameter.
             if func.im_self:
@@ -987,18 +1859,31 @@ class VirtualMachine(object):
                     )
                 )
             func = func.im_func
-        retval = func(*posargs, **namedargs)
-        self.push(retval)
+        elif func is locals and not (posargs or namedargs):
+            # The real locals() would show the VM's own locals: the frame
+            # makes the dict the running code expects.
+            return self.frame.f_locals
+        elif (func is setattr or func is delattr) and len(posargs) >= 2:
+            # Changing a class or a module this way changes what the inline
+            # caches know, as STORE_ATTR and DELETE_ATTR do.
+            result = func(*posargs, **namedargs)
+            self.attribute_changed(posargs[0], posargs[1])
+            return result
+        return func(*posargs, **namedargs)
 
     def byte_RETURN_VALUE(self):
         self.return_value = self.pop()
+        if self.frame.record:
+            self.recorder.returned(self.frame, self.return_value)
         if self.frame.generator:
             self.frame.generator.finished = True
-        return "return"
+        return WHY_RETURN
 
     def byte_YIELD_VALUE(self):
         self.return_value = self.pop()
-        return "yield"
+        if self.frame.record:
+            self.recorder.returned(self.frame, self.return_value, False)
+        return WHY_YIELD
 
     def byte_YIELD_FROM(self):
         u = self.pop()
@@ -1011,6 +1896,8 @@ class VirtualMachine(object):
             else:
                 retval = x.send(u)
             self.return_value = retval
+            if self.frame.record:
+                self.recorder.returned(self.frame, retval, False)
         except StopIteration as e:
             self.pop()
             self.push(e.value)
@@ -1018,9 +1905,9 @@ class VirtualMachine(object):
             # YIELD_FROM decrements f_lasti, so that it will be called
             # repeatedly until a StopIteration is raised.
             self.jump(self.frame.f_lasti - 1)
-            # Returning "yield" prevents the block stack cleanup code
+            # Returning WHY_YIELD prevents the block stack cleanup code
             # from executing, suspending the frame in its current state.
-            return "yield"
+            return WHY_YIELD
 
     ## Importing
 
@@ -1028,7 +1915,7 @@ class VirtualMachine(object):
         level, fromlist = self.popn(2)
         frame = self.frame
         self.push(
-            __import__(name, frame.f_globals, frame.f_locals, fromlist, level)
+            __import__(name, frame.f_globals, frame.namespace, fromlist, level)
         )
 
     def byte_IMPORT_STAR(self):
@@ -1036,7 +1923,8 @@ class VirtualMachine(object):
         mod = self.pop()
         for attr in dir(mod):
             if attr[0] != '_':
-                self.frame.f_locals[attr] = getattr(mod, attr)
+                self.frame.namespace[attr] = getattr(mod, attr)
+                name_changed(attr)
 
     def byte_IMPORT_FROM(self, name):
         mod = self.top()
@@ -1046,7 +1934,15 @@ class VirtualMachine(object):
 
     def byte_EXEC_STMT(self):
         stmt, globs, locs = self.popn(3)
-        six.exec_(stmt, globs, locs)
+        frame = self.frame
+        if globs is None:
+            # Run in our own namespaces, and pick up the changes made to
+            # the locals, as ceval does.
+            six.exec_(stmt, frame.f_globals, frame.f_locals)
+            frame.locals_to_fast()
+        else:
+            six.exec_(stmt, globs, locs)
+        all_names_changed()
 
     if PY2:
         def byte_BUILD_CLASS(self):
@@ -1060,7 +1956,8 @@ class VirtualMachine(object):
             self.push(__build_class__)
 
         def byte_STORE_LOCALS(self):
-            self.frame.f_locals = self.pop()
+            self.frame.namespace = self.pop()
+            all_names_changed()
 
     if 0:   # Not in py2.7
         def byte_SET_LINENO(self, lineno):
@@ -0,0 +1,802 @@
+"""Record the data dependencies of the code a VM runs.
+
+The `Recorder` tracks the frames running the code objects it is told to,
+or by default the main function: the frames the module calls directly.
+Each time a tracked frame stores a local variable, it makes an `Action`:
+the locals the frame read since its last store, the name it stored, the
+line it stored it on, and the size of the value, counting the objects it
+refers to (see `byterun.sizes`).  When one tracked frame
+calls another, or returns or yields to it, an action for the edge ties
+the two frames' dependencies together.
+
+A recorder made with ``heap=True`` also follows data through objects: a
+tracked frame storing an attribute or item of an object, or appending to
+or adding to a list or dict it's building, stores a heap location named
+after the object, like ``Point#3.x`` or ``list#7[2]``, and loading one
+reads it.  `HeapShadow` gives the objects their numbers.
+
+A recorder made with ``loops=True`` merges what the tracked frames do over
+and over in their loops.  While a loop runs, the actions on each line that
+are the same but for their sizes are merged into one `LoopAction`, with
+how many times it happened, the first and last iterations it happened in,
+and the smallest and largest size, which goes to the sink when the loop
+ends.  A loop in a loop merges into the outer one, so a loop makes a
+record for each different action in it however long it runs.
+
+Actions go to a sink as they are made, so a long run needs no more memory
+than its sink keeps:
+
+* `ListSink` keeps the stores in a list, the way
+  ``VirtualMachine.run_code`` returns them.
+* `JSONLinesSink` writes each as a line of JSON.
+* `BinarySink` writes them compactly, for `read_binary` to read back.
+* `GeneratorSink` sends each to a generator the caller wrote.
+* `ActionTable` keeps them in compact columns, and can be queried.
+
+"""
+
+import array
+import collections
+import json
+import struct
+import sys
+import weakref
+
+import six
+from six.moves import range, reprlib, zip
+
+from .pycode import loop_heads
+from .pyobj import BLOCK_LOOP, CO_OPTIMIZED
+from .sizes import DeepSizer
+
+
+# The kinds of action.
+STORE = 'store'
+CALL = 'call'
+RETURN = 'return'
+KINDS = (STORE, CALL, RETURN)
+
+
+class Action(collections.namedtuple(
+    'Action', 'reads, name, line, size, frame, kind, peer',
+)):
+    """One thing a tracked frame did.
+
+    `frame` is the number of the frame, counting the tracked frames in the
+    order they started, and `reads` are the names it read first.  A STORE
+    stores `name`, and its `peer` is None.  A CALL calls frame `peer`,
+    which runs the code called `name`.  A RETURN returns or yields a value
+    of `size` bytes to frame `peer`, from its own code called `name`.
+
+    """
+    __slots__ = ()
+
+    def as_list(self):
+        """The action as ``run_code`` returns it: the reads, name and line."""
+        return list(self.reads) + [self.name, self.line]
+
+
+class LoopAction(collections.namedtuple(
+    'LoopAction', 'action, count, first, last, min_size, max_size',
+)):
+    """Actions a loop repeated, merged into one.
+
+    `action` is the first of them, and `count` is how many there were.
+    `first` and `last` are the iterations of the loop the first and last
+    of them happened in, counting from 0, and `min_size` and `max_size` are
+    the smallest and largest of their sizes.
+
+    """
+    __slots__ = ()
+
+
+class LoopRecord(object):
+    """The actions merged so far in one run of a loop.
+
+    `block` is the loop's block on the frame's block stack, which is a new
+    one each time the loop starts.
+
+    """
+    __slots__ = ['block', 'iteration', 'merged']
+
+    def __init__(self, block):
+        self.block = block
+        self.iteration = 0
+        # A list of what LoopAction takes, for each different action, in
+        # the order they first happened.
+        self.merged = collections.OrderedDict()
+
+    def add(self, action):
+        """Merge `action`, an Action or the LoopAction of an inner loop."""
+        if type(action) is LoopAction:
+            count, min_size, max_size = action[1], action[4], action[5]
+            action = action.action
+        else:
+            count = 1
+            min_size = max_size = action.size
+        key = action.kind, action.reads, action.name, action.line, action.peer
+        merged = self.merged.get(key)
+        if merged is None:
+            self.merged[key] = [
+                action, count, self.iteration, self.iteration,
+                min_size, max_size,
+            ]
+            return
+        merged[1] += count
+        merged[3] = self.iteration
+        if min_size < merged[4]:
+            merged[4] = min_size
+        if max_size > merged[5]:
+            merged[5] = max_size
+
+    def actions(self):
+        """Get the LoopActions of the loop's run."""
+        return [LoopAction(*merged) for merged in self.merged.values()]
+
+
+# How many reads a frame's record keeps before a store, by default.  Only
+# the most recent are kept, so a long stretch of code with no stores uses
+# bounded memory.
+MAX_READS = 1024
+
+
+class _All(object):
+    """Every function's code, for `Recorder` to track them all.
+
+    Modules and class bodies keep their variables in namespaces, not fast
+    locals, so there would be nothing to record of them.
+
+    """
+    def __contains__(self, code):
+        return bool(code.co_flags & CO_OPTIMIZED)
+
+    def __repr__(self):         # pragma: no cover
+        return 'ALL'
+
+ALL = _All()
+
+
+class FrameRecord(object):
+    """What the recorder knows about a tracked frame.
+
+    The VM keeps it on the frame, as ``frame.record``, and calls `read`
+    and `write` when the frame loads and stores its locals.  If the
+    recorder follows the heap, `heap` is its `HeapShadow`, and the VM calls
+    `read_attr`, `write_attr`, `read_item` and `write_item` when the frame
+    loads and stores the attributes and items of objects.
+
+    If the recorder merges loops, `loops` are the `LoopRecord`s of the
+    loops the frame is running, innermost last, and `loop_heads` are where
+    its code's loops start each iteration: the VM calls `jumped` when the
+    frame jumps, so a jump to one counts an iteration.
+
+    """
+    __slots__ = [
+        'recorder', 'number', 'name', 'reads', 'parameters', 'heap',
+        'frame', 'loops', 'loop_heads',
+    ]
+
+    def __init__(self, recorder, number, frame):
+        self.recorder = recorder
+        self.number = number
+        self.name = frame.f_code.co_name
+        self.reads = collections.deque(maxlen=recorder.max_reads)
+        # The parameters still holding the caller's arguments, which aren't
+        # dependencies.  Once one is stored to, its reads are.
+        self.parameters = set(frame.f_locals)
+        self.heap = recorder.heap
+        self.frame = frame
+        if recorder.loops:
+            self.loops = []
+            self.loop_heads = loop_heads(frame.f_code)
+        else:
+            self.loops = None
+            self.loop_heads = frozenset()
+
+    def read(self, name):
+        if name not in self.parameters:
+            self.reads.append(name)
+
+    def write(self, name, value, line):
+        self.parameters.discard(name)
+        self.recorder.stored(name, self.store(name, value, line))
+
+    def store(self, name, value, line):
+        """Send the store of `value` in `name` to the sink, and get its
+        size."""
+        size = self.recorder.sizer(value)
+        reads = tuple(self.reads)
+        self.reads.clear()
+        self.emit(Action(reads, name, line, size, self.number, STORE, None))
+        return size
+
+    def emit(self, action):
+        """Send `action` to the sink, or merge it into the loop running."""
+        loop = self.loop() if self.loops is not None else None
+        if loop is None:
+            self.recorder.sink.write(action)
+            return
+        keep_every = self.recorder.keep_every
+        if keep_every and not any(
+                running.iteration % keep_every for running in self.loops):
+            self.recorder.sink.write(action)
+        loop.add(action)
+
+    def loop(self):
+        """Get the `LoopRecord` of the innermost loop running, or None.
+
+        Loops whose blocks have gone from the block stack since the last
+        look have ended, so their merged actions are passed on.
+
+        """
+        blocks = [
+            block for block in self.frame.block_stack
+            if block.type == BLOCK_LOOP
+        ]
+        loops = self.loops
+        running = 0
+        while (running < len(loops) and running < len(blocks) and
+                loops[running].block is blocks[running]):
+            running += 1
+        while len(loops) > running:
+            self.pass_on(loops.pop().actions())
+        for block in blocks[running:]:
+            loops.append(LoopRecord(block))
+        if not loops:
+            self.recorder.looping.discard(self)
+            return None
+        self.recorder.looping.add(self)
+        return loops[-1]
+
+    def pass_on(self, actions):
+        """Merge an ended loop's actions into the loop outside it, or send
+        them to the sink if there is none."""
+        if self.loops:
+            for action in actions:
+                self.loops[-1].add(action)
+        else:
+            for action in actions:
+                self.recorder.sink.write(action)
+
+    def jumped(self, jump):
+        if jump in self.loop_heads:
+            loop = self.loop()
+            if loop is not None:
+                loop.iteration += 1
+
+    def finish(self):
+        """Send the actions of the loops still running to the sink."""
+        if self.loops:
+            while self.loops:
+                self.pass_on(self.loops.pop().actions())
+            self.recorder.looping.discard(self)
+
+    # Only the objects that tracked frames have stored into have labels, so
+    # loading from any other object reads nothing.
+
+    def read_attr(self, obj, name):
+        label = self.heap.label(obj)
+        if label is not None:
+            self.reads.append(label + '.' + name)
+
+    def write_attr(self, obj, name, value, line):
+        self.store(self.heap.label(obj, True) + '.' + name, value, line)
+
+    def read_item(self, obj, key):
+        label = self.heap.label(obj)
+        if label is not None:
+            self.reads.append('%s[%s]' % (label, key_repr(key)))
+
+    def write_item(self, obj, key, value, line):
+        label = self.heap.label(obj, True)
+        self.store('%s[%s]' % (label, key_repr(key)), value, line)
+
+
+# Keys are shown in heap locations by their reprs, shortened if need be.
+_key_repr = reprlib.Repr()
+_key_repr.maxstring = _key_repr.maxother = 40
+
+
+def key_repr(key):
+    if type(key) is int:
+        return repr(key)
+    return _key_repr.repr(key)
+
+
+# How many objects a HeapShadow holds before it first sweeps.
+MIN_SWEEP = 1024
+
+
+class HeapShadow(object):
+    """Label the objects that tracked frames store into, by identity.
+
+    An object's label is its type's name and a number, given in the order
+    the objects are first stored into.  Each object is known by its id
+    for as long as it lives, so an object that gets the id of a dead one
+    gets a label of its own.  An object that can be weakly referenced is
+    forgotten when it dies.  Lists, dicts and other objects that can't be
+    weakly referenced can't say when they die, so the shadow keeps them
+    alive, in `held`, and `sweep` lets go of the ones nothing else refers
+    to.  It sweeps each time `held` has doubled since the last time, so
+    a dead object is kept for a while, but not for the whole run.
+
+    """
+
+    def __init__(self):
+        # The label and type of each object, by id.
+        self.objects = {}
+        # Weak references to the objects that can have them, by id.
+        self.refs = {}
+        # The objects that can't, by id.
+        self.held = {}
+        self.sweep_at = MIN_SWEEP
+        self.count = 0
+
+    def label(self, obj, create=False):
+        """Get the label of `obj`, or None if it has none and not `create`."""
+        key = id(obj)
+        entry = self.objects.get(key)
+        if entry is not None and entry[1] is type(obj):
+            return entry[0]
+        if not create:
+            return None
+        label = '%s#%d' % (type(obj).__name__, self.count)
+        self.count += 1
+        self.objects[key] = label, type(obj)
+        try:
+            self.refs[key] = weakref.KeyedRef(obj, self.forget, key)
+        except TypeError:
+            self.held[key] = obj
+            if len(self.held) >= self.sweep_at:
+                self.sweep()
+        return label
+
+    def forget(self, ref):
+        """Drop the label of an object that has died."""
+        if self.refs.get(ref.key) is ref:
+            del self.refs[ref.key]
+            del self.objects[ref.key]
+
+    def sweep(self):
+        """Let go of the held objects that only the shadow refers to."""
+        held = self.held
+        for key in list(held):
+            # The references are the one in `held`, and the argument.
+            if sys.getrefcount(held[key]) <= 2:
+                del held[key]
+                del self.objects[key]
+        self.sweep_at = max(MIN_SWEEP, 2 * len(held))
+
+
+class SizeHistory(object):
+    """The sizes of the values stored in a variable: the `last`, the
+    `peak`, and how many `stores` there were."""
+    __slots__ = ['last', 'peak', 'stores']
+
+    def __init__(self):
+        self.last = self.peak = self.stores = 0
+
+    def add(self, size):
+        self.last = size
+        if size > self.peak:
+            self.peak = size
+        self.stores += 1
+
+    def __repr__(self):         # pragma: no cover
+        return '<SizeHistory last=%d peak=%d stores=%d>' % (
+            self.last, self.peak, self.stores,
+        )
+
+
+class Recorder(object):
+    """Track the locals of some frames, and send their actions to a sink.
+
+    `codes` is the code objects whose frames are tracked, `ALL` to track
+    the frames of every function, or None to track the main function, as
+    the VM always has; `track` adds another.  Frames that aren't tracked
+    cost nothing more than a check when they start.  With `heap`, the
+    tracked frames' loads and stores of attributes and items are recorded
+    too.  With `loops`, what they do in loops is merged into `LoopAction`s;
+    with `keep_every` too, the actions of every `keep_every`th iteration,
+    starting with the first, are sent as they happen as well.  In a loop
+    in a loop, that's the iterations of both that are kept.
+
+    Values are sized with `sizer`, a `byterun.sizes.DeepSizer` unless
+    another function is given: ``sys.getsizeof`` counts only the values
+    themselves.  `variables` maps each local name stored to the size of
+    the last value stored in it, and `sizes` to its `SizeHistory`.
+
+    The VM calls `start` when a frame starts or resumes, `returned`
+    when it returns or yields, and `close` when the program ends.
+
+    """
+
+    def __init__(
+        self, sink=None, max_reads=MAX_READS, codes=None, heap=False,
+        sizer=None, loops=False, keep_every=None,
+    ):
+        self.sink = ListSink() if sink is None else sink
+        self.sizer = DeepSizer() if sizer is None else sizer
+        self.max_reads = max_reads
+        self.codes = codes if codes is None or codes is ALL else set(codes)
+        self.heap = HeapShadow() if heap else None
+        self.loops = loops
+        self.keep_every = keep_every
+        # The records of the frames with loops running.
+        self.looping = set()
+        self.variables = collections.defaultdict(int)
+        self.sizes = {}
+        self.frames = 0
+
+    def stored(self, name, size):
+        """Note that a value of `size` bytes was stored in local `name`."""
+        self.variables[name] = size
+        history = self.sizes.get(name)
+        if history is None:
+            history = self.sizes[name] = SizeHistory()
+        history.add(size)
+
+    def track(self, code):
+        """Track the frames that run `code` from now on."""
+        if self.codes is None:
+            self.codes = set()
+        if self.codes is not ALL:
+            self.codes.add(code)
+
+    def tracks(self, code, depth):
+        """Is a frame running `code`, with `depth` frames on the stack
+        counting it, tracked?"""
+        if self.codes is None:
+            return depth == 2
+        return code in self.codes
+
+    def start(self, frame, depth):
+        """Get ready for `frame` to run, with `depth` frames on the stack.
+
+        The first time it runs, the frame gets its `FrameRecord`, or False
+        if it isn't tracked.  Each time it runs, a call from a tracked
+        frame is recorded.
+
+        """
+        if frame.record is None:
+            if self.tracks(frame.f_code, depth):
+                frame.record = FrameRecord(self, self.frames, frame)
+                self.frames += 1
+            else:
+                frame.record = False
+        record, caller = frame.record, frame.f_back
+        if record and caller is not None and caller.record:
+            caller.record.emit(Action(
+                tuple(caller.record.reads), record.name, caller.line_number(),
+                0, caller.record.number, CALL, record.number,
+            ))
+
+    def returned(self, frame, value, finished=True):
+        """Record the tracked frame `frame` returning `value`, or yielding
+        it if not `finished`."""
+        record, caller = frame.record, frame.f_back
+        reads = tuple(record.reads)
+        record.reads.clear()
+        if caller is not None and caller.record:
+            record.emit(Action(
+                reads, record.name, frame.line_number(), self.sizer(value),
+                record.number, RETURN, caller.record.number,
+            ))
+        if finished:
+            record.finish()
+
+    def close(self):
+        """Finish the recording, and get what the sink made of it.
+
+        The loops of frames that ended with an exception, or generators
+        that never finished, are sent to the sink first.
+
+        """
+        for record in list(self.looping):
+            record.finish()
+        return self.variables, self.sink.close()
+
+
+def _open(target, mode):
+    """Get a file for `target`, a file or a file name, and whether we own
+    it."""
+    if isinstance(target, six.string_types):
+        return open(target, mode), True
+    return target, False
+
+
+class ListSink(object):
+    """Keep the stores in a list, as lists of reads, name and line.
+
+    The lists have no room for calls and returns, so they are left out, or
+    for what a loop merged, so its stores are listed once.
+
+    """
+
+    def __init__(self):
+        self.actions = []
+
+    def write(self, action):
+        if type(action) is LoopAction:
+            action = action.action
+        if action.kind == STORE:
+            self.actions.append(action.as_list())
+
+    def close(self):
+        return self.actions
+
+
+class JSONLinesSink(object):
+    """Write each action to a file as a line of JSON.
+
+    A LoopAction's line has its action as an object in it.
+
+    """
+
+    def __init__(self, target):
+        self.file, self.owned = _open(target, 'w')
+
+    def write(self, action):
+        fields = action._asdict()
+        if type(action) is LoopAction:
+            fields['action'] = action.action._asdict()
+        self.file.write(json.dumps(fields) + "\n")
+
+    def close(self):
+        if self.owned:
+            self.file.close()
+        else:
+            self.file.flush()
+
+
+# The records of a binary recording: the first use of a name gives it a
+# number, and an action refers to its names by number.  What a loop merged
+# is a loop record followed by the record of its action.
+_NAME = b'N'
+_ACTION = b'A'
+_LOOP = b'L'
+_NAME_HEADER = struct.Struct('<II')         # number, length of UTF-8
+_LOOP_HEADER = struct.Struct('<QQQqq')      # count, first, last, min, max
+# line, size, name, reads, frame, kind, peer (-1 for none)
+_ACTION_HEADER = struct.Struct('<IqIIIBi')
+_NUMBER = struct.Struct('<I')
+
+
+class BinarySink(object):
+    """Write the actions to a file compactly, for `read_binary`."""
+
+    def __init__(self, target):
+        self.file, self.owned = _open(target, 'wb')
+        self.numbers = {}
+
+    def number(self, name):
+        number = self.numbers.get(name)
+        if number is None:
+            number = self.numbers[name] = len(self.numbers)
+            encoded = name.encode('utf-8')
+            self.file.write(_NAME)
+            self.file.write(_NAME_HEADER.pack(number, len(encoded)))
+            self.file.write(encoded)
+        return number
+
+    def write(self, action):
+        # Name the names before the action refers to them.
+        loop = None
+        if type(action) is LoopAction:
+            loop, action = action, action.action
+        reads = [self.number(name) for name in action.reads]
+        name = self.number(action.name)
+        if loop is not None:
+            self.file.write(_LOOP)
+            self.file.write(_LOOP_HEADER.pack(*loop[1:]))
+        self.file.write(_ACTION)
+        peer = -1 if action.peer is None else action.peer
+        self.file.write(_ACTION_HEADER.pack(
+            action.line, action.size, name, len(reads), action.frame,
+            KINDS.index(action.kind), peer,
+        ))
+        for number in reads:
+            self.file.write(_NUMBER.pack(number))
+
+    def close(self):
+        if self.owned:
+            self.file.close()
+        else:
+            self.file.flush()
+
+
+def read_binary(target):
+    """Read the actions `BinarySink` wrote to `target`, one by one."""
+    f, owned = _open(target, 'rb')
+    names = {}
+    loop = None
+    try:
+        while True:
+            tag = f.read(1)
+            if not tag:
+                break
+            if tag == _NAME:
+                number, length = _NAME_HEADER.unpack(
+                    f.read(_NAME_HEADER.size)
+                )
+                name = f.read(length).decode('utf-8')
+                names[number] = str(name) if six.PY2 else name
+            elif tag == _ACTION:
+                line, size, name, count, frame, kind, peer = (
+                    _ACTION_HEADER.unpack(f.read(_ACTION_HEADER.size))
+                )
+                reads = tuple(
+                    names[_NUMBER.unpack(f.read(_NUMBER.size))[0]]
+                    for _ in range(count)
+                )
+                action = Action(
+                    reads, names[name], line, size, frame, KINDS[kind],
+                    None if peer < 0 else peer,
+                )
+                if loop is not None:
+                    action, loop = LoopAction(action, *loop), None
+                yield action
+            elif tag == _LOOP:
+                loop = _LOOP_HEADER.unpack(f.read(_LOOP_HEADER.size))
+            else:
+                raise ValueError("Not a binary recording: %r" % (tag,))
+    finally:
+        if owned:
+            f.close()
+
+
+class GeneratorSink(object):
+    """Send each action to a generator, which the caller wrote to consume
+    them.
+
+    The generator is started when the sink is made, gets each action from
+    its ``yield``, and is closed at the end.
+
+    """
+
+    def __init__(self, generator):
+        self.generator = generator
+        next(generator)
+
+    def write(self, action):
+        self.generator.send(action)
+
+    def close(self):
+        self.generator.close()
+
+
+class ActionTable(object):
+    """Keep the actions in columns of machine integers, for querying.
+
+    An action is known by its number, its place in the recording.  Names
+    are interned as symbols, numbered in the order they're first seen, so
+    an action takes a few bytes for each column and each read, not a list
+    of strings.  The reads of action ``i`` are
+    ``read_symbols[read_starts[i]:read_starts[i+1]]``.
+
+    `writers`, `readers`, `on_line` and `in_frame` find the numbers of the
+    actions that store a name, read a name, happen on a line, or happen in
+    a frame.  The indexes they use are built by the first query after a
+    write.
+
+    What a loop merged takes an action's row, and `loops` maps its number
+    to the rest of its LoopAction, so that is what ``table[number]`` is.
+
+    """
+
+    def __init__(self):
+        self.symbols = []
+        self.symbol_numbers = {}
+        self.lines = array.array('i')
+        self.names = array.array('i')
+        self.sizes = array.array('l')
+        self.frames = array.array('i')
+        # The index of each action's kind in KINDS, and its peer, or -1.
+        self.kinds = array.array('b')
+        self.peers = array.array('i')
+        self.read_starts = array.array('l', [0])
+        self.read_symbols = array.array('i')
+        self.loops = {}
+        self.indexes = None
+
+    def symbol(self, name):
+        """Get the symbol for `name`, interning it if it's new."""
+        number = self.symbol_numbers.get(name)
+        if number is None:
+            number = self.symbol_numbers[name] = len(self.symbols)
+            self.symbols.append(name)
+        return number
+
+    def write(self, action):
+        if type(action) is LoopAction:
+            self.loops[len(self)] = action[1:]
+            action = action.action
+        symbol = self.symbol
+        self.read_symbols.extend([symbol(name) for name in action.reads])
+        self.read_starts.append(len(self.read_symbols))
+        self.names.append(symbol(action.name))
+        self.lines.append(action.line)
+        self.sizes.append(action.size)
+        self.frames.append(action.frame)
+        self.kinds.append(KINDS.index(action.kind))
+        self.peers.append(-1 if action.peer is None else action.peer)
+        self.indexes = None
+
+    def close(self):
+        return self
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, number):
+        if number < 0:
+            number += len(self)
+        symbols = self.symbols
+        reads = self.read_symbols[
+            self.read_starts[number]:self.read_starts[number + 1]
+        ]
+        peer = self.peers[number]
+        action = Action(
+            tuple(symbols[symbol] for symbol in reads),
+            symbols[self.names[number]], self.lines[number],
+            self.sizes[number], self.frames[number],
+            KINDS[self.kinds[number]], None if peer < 0 else peer,
+        )
+        loop = self.loops.get(number)
+        if loop is not None:
+            return LoopAction(action, *loop)
+        return action
+
+    def __iter__(self):
+        for number in range(len(self)):
+            yield self[number]
+
+    def nbytes(self):
+        """How many bytes the columns take, leaving out the symbols."""
+        return sum(
+            len(column) * column.itemsize for column in (
+                self.lines, self.names, self.sizes, self.frames, self.kinds,
+                self.peers, self.read_starts, self.read_symbols,
+            )
+        )
+
+    def build_indexes(self):
+        writers = collections.defaultdict(lambda: array.array('l'))
+        readers = collections.defaultdict(lambda: array.array('l'))
+        lines = collections.defaultdict(lambda: array.array('l'))
+        frames = collections.defaultdict(lambda: array.array('l'))
+        starts, read_symbols = self.read_starts, self.read_symbols
+        store = KINDS.index(STORE)
+        columns = zip(self.names, self.lines, self.frames, self.kinds)
+        for number, (symbol, line, frame, kind) in enumerate(columns):
+            if kind == store:
+                writers[symbol].append(number)
+            lines[line].append(number)
+            frames[frame].append(number)
+            # A name read twice by one action is only listed once.
+            reads = read_symbols[starts[number]:starts[number + 1]]
+            for read in set(reads):
+                readers[read].append(number)
+        self.indexes = writers, readers, lines, frames
+        return self.indexes
+
+    def lookup(self, which, key):
+        indexes = self.indexes or self.build_indexes()
+        numbers = indexes[which].get(key)
+        return list(numbers) if numbers is not None else []
+
+    def writers(self, name):
+        """The numbers of the actions that store `name`."""
+        return self.lookup(0, self.symbol_numbers.get(name))
+
+    def readers(self, name):
+        """The numbers of the actions that read `name`."""
+        return self.lookup(1, self.symbol_numbers.get(name))
+
+    def on_line(self, line):
+        """The numbers of the actions on line `line`."""
+        return self.lookup(2, line)
+
+    def in_frame(self, frame):
+        """The numbers of the actions in the frame numbered `frame`."""
+        return self.lookup(3, frame)
@@ -0,0 +1,144 @@
+"""Estimate how much memory objects take, counting what they refer to.
+
+`sys.getsizeof` only counts an object itself: a list of a million strings
+is a few megabytes of pointers to it, and nothing for the strings.  A
+`DeepSizer` adds in the objects a container or an instance refers to, and
+the objects they refer to, counting each object once.  Classes, modules,
+functions and code are shared, not data, so they are counted as they are
+but not followed.
+
+"""
+
+import collections
+import itertools
+import sys
+import types
+
+import six
+
+from .pyobj import Cell, Function, Generator, Method
+
+# Types whose instances refer to nothing we count.
+ATOMIC_TYPES = set([
+    int, float, complex, bool, type(None), bytes, six.text_type, bytearray,
+    slice, six.moves.range,
+])
+if six.PY2:
+    ATOMIC_TYPES.add(long)
+
+# Types whose instances all take the same space, so it's only asked once.
+FIXED_SIZE_TYPES = set([float, complex, bool, type(None)])
+if six.PY2:
+    FIXED_SIZE_TYPES.add(int)
+
+# Types whose instances are counted, but not followed.
+OPAQUE_TYPES = (
+    type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+    types.MethodType, types.CodeType, types.FrameType, types.GeneratorType,
+    Function, Method, Generator, Cell,
+)
+if six.PY2:
+    OPAQUE_TYPES += (types.ClassType,)
+
+SEQUENCE_TYPES = (list, tuple)
+ITERABLE_TYPES = (set, frozenset, collections.deque)
+
+_MISSING = object()
+
+# How many items of a container are sized, by default, before the rest are
+# estimated from them.
+SAMPLE = 100
+
+
+class DeepSizer(object):
+    """Estimate the deep sizes of objects, as ``sizer(obj)``.
+
+    Each estimate has a memo of the ids of the objects it has counted, so
+    an object referred to twice, or a cycle, is only counted once.  The
+    sizes of the types in FIXED_SIZE_TYPES are cached in `type_sizes`.
+
+    A container with more than `sample` items is estimated from `sample`
+    of them, spread evenly through it: each counts for its share of the
+    items, unless it's in the sample more than once, when it's counted
+    once.  With a `sample` of None, everything is counted.
+
+    """
+
+    def __init__(self, sample=SAMPLE):
+        self.sample = sample
+        self.type_sizes = {}
+
+    def __call__(self, obj):
+        type_sizes = self.type_sizes
+        memo = set()
+        total = 0.0
+        # Objects to count, each with how many objects it stands for.
+        todo = [(obj, 1.0)]
+        while todo:
+            obj, weight = todo.pop()
+            if id(obj) in memo:
+                continue
+            memo.add(id(obj))
+            cls = type(obj)
+            size = type_sizes.get(cls)
+            if size is None:
+                size = sys.getsizeof(obj)
+                if cls in FIXED_SIZE_TYPES:
+                    type_sizes[cls] = size
+            total += size * weight
+            if cls in ATOMIC_TYPES or isinstance(obj, OPAQUE_TYPES):
+                continue
+            referents, count = self.referents(obj)
+            if count > len(referents):
+                # An object in the sample more than once is shared by the
+                # items, not one of many like it, so it counts once.
+                times = collections.Counter(map(id, referents))
+                scaled = weight * count / len(referents)
+                todo.extend(
+                    (referent, scaled if times[id(referent)] == 1 else weight)
+                    for referent in referents
+                )
+            else:
+                todo.extend((referent, weight) for referent in referents)
+        return int(total)
+
+    def referents(self, obj):
+        """Get the objects `obj` refers to, or a sample of them, and how
+        many there are."""
+        sample = self.sample
+        if isinstance(obj, SEQUENCE_TYPES):
+            count = len(obj)
+            if sample is not None and count > sample:
+                return obj[::count // sample], count
+            return obj, count
+        if isinstance(obj, dict):
+            count = len(obj)
+            items = six.iteritems(obj)
+            if sample is not None and count > sample:
+                items = itertools.islice(items, 0, None, count // sample)
+            referents = []
+            for key, value in items:
+                referents.append(key)
+                referents.append(value)
+            return referents, 2 * count
+        if isinstance(obj, ITERABLE_TYPES):
+            count = len(obj)
+            items = obj
+            if sample is not None and count > sample:
+                items = itertools.islice(obj, 0, None, count // sample)
+            return list(items), count
+        # An instance: its dict, and its slots.
+        referents = []
+        attrs = getattr(obj, '__dict__', None)
+        if type(attrs) is dict:
+            referents.append(attrs)
+        for cls in type(obj).__mro__:
+            slots = cls.__dict__.get('__slots__', ())
+            if isinstance(slots, six.string_types):
+                slots = (slots,)
+            for slot in slots:
+                if slot not in ('__dict__', '__weakref__'):
+                    value = getattr(obj, slot, _MISSING)
+                    if value is not _MISSING:
+                        referents.append(value)
+        return referents, len(referents)
@@ -0,0 +1,183 @@
+"""Slice a recording: find the lines a value came from, or goes to.
+
+A `Slicer` turns the actions a `byterun.recording.Recorder` made into a
+dependency graph, once, and then answers questions about it:
+
+* `backward`: which lines could have influenced the value of a variable
+  on a line?
+* `forward`: which lines could be affected by changing a line?
+
+Each action depends on the last store of each name it read, in its own
+frame for locals, or anywhere for heap locations.  Tracked frames don't
+record reads of parameters that still hold their arguments, so everything
+a called frame does depends on the call that started it, and the first
+thing a frame does after a tracked frame returns or yields to it depends
+on the return.  So the slices are safe, if not always tight.  Actions a
+loop merged are one node each.
+
+The graph is kept both ways, as arrays of action numbers, so a query only
+visits the actions in its slice, however long the recording is.  Slices
+are sets of line numbers; `source_lines` gets their source.
+
+"""
+
+import array
+
+from six.moves import range, zip
+
+from .recording import CALL, KINDS, RETURN, STORE, ActionTable
+
+_STORE, _CALL, _RETURN = (KINDS.index(kind) for kind in (STORE, CALL, RETURN))
+
+
+def _reversed_edges(starts, targets, count):
+    """Turn the edges from each of `count` nodes, in the compressed form
+    `Slicer` keeps them, into the edges to each one."""
+    incoming = array.array('l', [0]) * (count + 1)
+    for target in targets:
+        incoming[target + 1] += 1
+    for node in range(count):
+        incoming[node + 1] += incoming[node]
+    sources = array.array('l', [0]) * len(targets)
+    filled = array.array('l', incoming[:count])
+    for node in range(count):
+        for target in targets[starts[node]:starts[node + 1]]:
+            sources[filled[target]] = node
+            filled[target] += 1
+    return incoming, sources
+
+
+class Slicer(object):
+    """The dependencies between recorded actions, for slicing.
+
+    `actions` is an `ActionTable`, or anything else with the actions in
+    order, like a list or what `read_binary` reads, which is put in one.
+    It's kept as `table`.  The actions action ``i`` depends on are
+    ``dependencies[dependency_starts[i]:dependency_starts[i+1]]``, and the
+    actions that depend on it are ``users[user_starts[i]:user_starts[i+1]]``.
+
+    """
+
+    def __init__(self, actions):
+        if not isinstance(actions, ActionTable):
+            table = ActionTable()
+            for action in actions:
+                table.write(action)
+            actions = table
+        self.table = actions
+        self.dependency_starts, self.dependencies = self.build()
+        self.user_starts, self.users = _reversed_edges(
+            self.dependency_starts, self.dependencies, len(actions),
+        )
+
+    def build(self):
+        """Find what each action depends on, in one pass."""
+        table = self.table
+        # Which symbols are heap locations, labelled like ``Point#3``.
+        heap = ['#' in symbol for symbol in table.symbols]
+        starts = array.array('l', [0])
+        dependencies = array.array('l')
+        # The last store of each local, by frame and symbol, and of each
+        # heap location, by symbol.
+        last_stores = {}
+        # The call that started each frame, and the return each frame has
+        # yet to see, by frame number.
+        calls = {}
+        returns = {}
+        read_starts, read_symbols = table.read_starts, table.read_symbols
+        columns = zip(table.names, table.frames, table.kinds, table.peers)
+        for number, (name, frame, kind, peer) in enumerate(columns):
+            found = set()
+            for symbol in read_symbols[
+                    read_starts[number]:read_starts[number + 1]]:
+                store = last_stores.get(
+                    symbol if heap[symbol] else (frame, symbol)
+                )
+                if store is not None:
+                    found.add(store)
+            call = calls.get(frame)
+            if call is not None:
+                found.add(call)
+            returned = returns.pop(frame, None)
+            if returned is not None:
+                found.add(returned)
+            if kind == _STORE:
+                last_stores[name if heap[name] else (frame, name)] = number
+            elif kind == _CALL:
+                calls[peer] = number
+            elif kind == _RETURN:
+                returns[peer] = number
+            # A loop's merged store can read what it stored last time.
+            found.discard(number)
+            dependencies.extend(sorted(found))
+            starts.append(len(dependencies))
+        return starts, dependencies
+
+    def closure(self, numbers, starts, edges):
+        """Get the actions reachable from `numbers` by `edges`."""
+        seen = set(numbers)
+        todo = list(seen)
+        while todo:
+            number = todo.pop()
+            for other in edges[starts[number]:starts[number + 1]]:
+                if other not in seen:
+                    seen.add(other)
+                    todo.append(other)
+        return seen
+
+    def backward_actions(self, numbers):
+        """The actions `numbers` depend on, counting themselves."""
+        return self.closure(numbers, self.dependency_starts, self.dependencies)
+
+    def forward_actions(self, numbers):
+        """The actions that depend on `numbers`, counting themselves."""
+        return self.closure(numbers, self.user_starts, self.users)
+
+    def lines(self, numbers):
+        lines = self.table.lines
+        return frozenset(lines[number] for number in numbers)
+
+    def backward(self, name, line):
+        """The lines that could have influenced `name` on line `line`.
+
+        If `name` is stored on the line, that's where the slice starts:
+        otherwise it starts from the stores that the line's reads of it
+        read.
+
+        """
+        table = self.table
+        symbol = table.symbol_numbers.get(name)
+        if symbol is None:
+            return frozenset()
+        starts = [
+            number for number in table.writers(name)
+            if table.lines[number] == line
+        ]
+        if not starts:
+            dependency_starts, dependencies = (
+                self.dependency_starts, self.dependencies,
+            )
+            names, kinds = table.names, table.kinds
+            for number in table.readers(name):
+                if table.lines[number] != line:
+                    continue
+                starts.extend(
+                    store for store in dependencies[
+                        dependency_starts[number]:dependency_starts[number + 1]
+                    ] if names[store] == symbol and kinds[store] == _STORE
+                )
+        return self.lines(self.backward_actions(starts))
+
+    def forward(self, line):
+        """The lines that could be affected by changing line `line`,
+        counting it."""
+        return self.lines(self.forward_actions(self.table.on_line(line)))
+
+
+def source_lines(source, lines):
+    """Get the numbers and text of `lines` of `source`, in order."""
+    text = source.splitlines()
+    return [
+        (line, text[line - 1]) for line in sorted(lines)
+        if 0 < line <= len(text)
+    ]
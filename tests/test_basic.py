@@ -76,6 +76,13 @@ class TestIt(vmtest.VmTestCase):
                 assert x == 2 and y == 3
                 assert isinstance(x, int)
                 """)
+
+        def test_inplace_float_division(self):
+            self.assert_ok("""\
+                x, y = 7.0, 2
+                x /= y
+                assert x == 3.5
+                """)
     elif PY3:
         def test_inplace_division(self):
             self.assert_ok("""\
@@ -450,6 +457,26 @@ class TestIt(vmtest.VmTestCase):
             m(1815)
             """)
 
+    def test_method_calls(self):
+        self.assert_ok("""\
+            class Thing(object):
+                def meth(self, x, y=2):
+                    return (x, y)
+                @staticmethod
+                def smeth(x):
+                    return x
+                @classmethod
+                def cmeth(cls, x):
+                    return cls.__name__, x
+            def other(x, y=3):
+                return ('other', x, y)
+            t = Thing()
+            for i in range(3):
+                print(t.meth(i), t.meth(i, y=i), t.smeth(i), t.cmeth(i))
+                print([].append(i), "a,b".split(","), Thing.meth(t, i))
+                t.meth = other
+            """)
+
     def test_callback(self):
         self.assert_ok("""\
             def lcase(s):
@@ -96,6 +96,79 @@ class TestFunctions(vmtest.VmTestCase):
             fn()
             """)
 
+    def test_keywords_and_defaults(self):
+        self.assert_ok("""\
+            def fn(a, b, c=3, d=4, *args, **kwargs):
+                print(a, b, c, d, args, sorted(kwargs.items()))
+            fn(1, 2)
+            fn(1, b=2, d=5)
+            fn(d=1, c=2, b=3, a=4, e=5)
+            fn(1, 2, 3, 4, 5, 6, f=7)
+            """)
+
+    def test_bad_calls(self):
+        self.assert_ok("""\
+            def none(): pass
+            def one(a): pass
+            def two(a, b=1): pass
+            def star(a, b, *c): pass
+            def starstar(a, b, c=1, **k): pass
+            calls = [
+                (none, (1,), {}), (none, (), {'x': 1}),
+                (one, (), {}), (one, (1, 2), {}), (one, (1, 2), {'a': 1}),
+                (one, (), {'z': 1}),
+                (two, (1, 2, 3), {}), (two, (), {'b': 2}),
+                (two, (1,), {'a': 2}), (two, (1, 2), {'q': 3}),
+                (star, (1,), {}),
+                (starstar, (), {'c': 1}), (starstar, (1, 2, 3, 4), {}),
+            ]
+            for fn, args, kwargs in calls:
+                try:
+                    fn(*args, **kwargs)
+                except TypeError as e:
+                    print(e)
+            """)
+
+    if not PY3:
+        def test_tuple_arguments(self):
+            self.assert_ok("""\
+                def fn(a, (b, c), d=(5, 6)):
+                    print(a, b, c, d)
+                fn(1, (2, 3))
+                fn(1, [2, 3], d=4)
+                """)
+
+        def test_exec_in_functions(self):
+            self.assert_ok("""\
+                def fn(a):
+                    b = 2
+                    exec "c = a + b; b = 10"
+                    print(a, b, c)
+                fn(1)
+                """)
+
+    def test_locals(self):
+        self.assert_ok("""\
+            def fn(a, b=2, *args, **kwargs):
+                c = 3
+                def inner():
+                    return a
+                print(sorted(locals()), locals()['a'], locals()['c'])
+                del c
+                print(sorted(locals()))
+            fn(1)
+            fn(1, 2, 3, d=4)
+            """)
+
+    def test_locals_of_reassigned_cell_arguments(self):
+        self.assert_ok("""\
+            def fn(a):
+                a = 5
+                inner = lambda: a
+                return locals()['a'], inner()
+            print(fn(1))
+            """)
+
     def test_partial(self):
         self.assert_ok("""\
             from _functools import partial
@@ -0,0 +1,197 @@
+"""Tests of decoded code objects for Byterun."""
+
+from __future__ import print_function
+
+import dis
+import unittest
+
+from byterun.pycode import (
+    code_info, count_instructions, decode_code, instruction_table,
+    line_numbers, optimize_instructions,
+)
+
+
+def _code(src):
+    return compile(src, "<test>", "exec")
+
+
+def _table(*ops):
+    """Make an instruction table from (byteName, arguments) pairs.
+
+    Every instruction is three bytes long, so jump targets are multiples of
+    three.
+
+    """
+    instructions = [None] * (3 * len(ops))
+    for i, (byteName, arguments) in enumerate(ops):
+        instructions[3 * i] = (
+            dis.opmap[byteName], byteName, arguments, 3 * i + 3
+        )
+    return instructions
+
+
+def _names(instructions):
+    """The names and arguments of the instructions that can run, in order."""
+    names = []
+    offset = 0
+    while offset < len(instructions):
+        byteCode, byteName, arguments, next_offset = instructions[offset]
+        names.append((byteName, arguments))
+        offset = next_offset
+    return names
+
+
+class TestDecoding(unittest.TestCase):
+    def test_arguments_are_resolved(self):
+        code = _code("x = 17\ny = x\n")
+        instructions = [i for i in decode_code(code) if i is not None]
+        names = [(byteName, arguments) for _, byteName, arguments, _ in instructions]
+        self.assertEqual(names[:4], [
+            ('LOAD_CONST', (17,)),
+            ('STORE_NAME', ('x',)),
+            ('LOAD_NAME', ('x',)),
+            ('STORE_NAME', ('y',)),
+        ])
+
+    def test_offsets_chain_together(self):
+        code = _code("for i in range(3):\n    pass\n")
+        instructions = decode_code(code)
+        offset = 0
+        seen = 0
+        while offset < len(instructions):
+            byteCode, byteName, arguments, next_offset = instructions[offset]
+            self.assertEqual(byteName, dis.opname[byteCode])
+            self.assertGreater(next_offset, offset)
+            offset = next_offset
+            seen += 1
+        self.assertEqual(seen, len([i for i in instructions if i]))
+
+    def test_relative_jumps_are_absolute(self):
+        code = _code("for i in range(3):\n    pass\n")
+        instructions = decode_code(code)
+        for_iter = [i for i in instructions if i and i[1] == 'FOR_ITER'][0]
+        target = for_iter[2][0]
+        self.assertEqual(instructions[target][1], 'POP_BLOCK')
+
+    def test_line_numbers(self):
+        code = _code("a = 1\n\nb = a + 2\n")
+        lines = line_numbers(code)
+        self.assertEqual(len(lines), len(code.co_code))
+        instructions = decode_code(code)
+        offset = 0
+        seen = []
+        while offset < len(instructions):
+            next_offset = instructions[offset][3]
+            self.assertEqual(
+                set(lines[offset:next_offset]), set([lines[offset]])
+            )
+            seen.append(lines[offset])
+            offset = next_offset
+        self.assertEqual(sorted(set(seen)), [1, 3])
+
+    def test_infos_are_shared(self):
+        code = _code("a = 1\n")
+        self.assertIs(code_info(code), code_info(code))
+        self.assertIs(
+            code_info(code).instructions, code_info(code).instructions
+        )
+
+    def test_equal_code_objects_keep_their_lines(self):
+        spread = _code("def f():\n    x = 1\n    return x\n").co_consts[0]
+        packed = _code("def f():\n    x = 1; return x\n").co_consts[0]
+        self.assertEqual(spread, packed)
+        self.assertIsNot(code_info(spread), code_info(packed))
+        self.assertIn(3, code_info(spread).line_numbers)
+        self.assertNotIn(3, code_info(packed).line_numbers)
+
+
+class TestOptimizer(unittest.TestCase):
+    def test_dead_code_is_removed(self):
+        code = _code(
+            "def f(a):\n"
+            "    if a:\n"
+            "        return 1\n"
+            "    else:\n"
+            "        return 2\n"
+        ).co_consts[0]
+        optimized = instruction_table(code, optimize=True)
+        self.assertEqual(_names(optimized)[-2:], [
+            ('LOAD_CONST', (2,)),
+            ('RETURN_VALUE', ()),
+        ])
+        info = code_info(code)
+        self.assertEqual(
+            count_instructions(optimized),
+            count_instructions(info.instructions) - info.removed_instructions,
+        )
+        self.assertGreater(info.removed_instructions, 0)
+
+    def test_jumps_are_threaded(self):
+        optimized, removed = optimize_instructions(_table(
+            ('LOAD_FAST', ('a',)),
+            ('POP_JUMP_IF_FALSE', (9,)),
+            ('RETURN_VALUE', ()),
+            ('JUMP_ABSOLUTE', (15,)),
+            ('LOAD_CONST', (None,)),
+            ('RETURN_VALUE', ()),
+        ), [0])
+        self.assertEqual(_names(optimized), [
+            ('LOAD_FAST', ('a',)),
+            ('POP_JUMP_IF_FALSE', (15,)),
+            ('RETURN_VALUE', ()),
+            ('RETURN_VALUE', ()),
+        ])
+        self.assertEqual(removed, 2)
+
+    def test_constants_are_folded(self):
+        optimized, removed = optimize_instructions(_table(
+            ('LOAD_CONST', (2,)),
+            ('LOAD_CONST', (3,)),
+            ('BINARY_MULTIPLY', ()),
+            ('UNARY_NEGATIVE', ()),
+            ('LOAD_CONST', ('x',)),
+            ('BUILD_TUPLE', (2,)),
+            ('RETURN_VALUE', ()),
+        ), [0])
+        self.assertEqual(_names(optimized), [
+            ('LOAD_CONST', ((-6, 'x'),)),
+            ('RETURN_VALUE', ()),
+        ])
+        self.assertEqual(removed, 5)
+
+    def test_method_calls(self):
+        optimized, removed = optimize_instructions(_table(
+            ('LOAD_FAST', ('obj',)),
+            ('LOAD_ATTR', ('meth',)),
+            ('LOAD_FAST', ('f',)),
+            ('LOAD_FAST', ('obj',)),
+            ('LOAD_ATTR', ('x',)),
+            ('CALL_FUNCTION', (1,)),
+            ('LOAD_CONST', (1,)),
+            ('BINARY_ADD', ()),
+            ('CALL_FUNCTION', (1,)),
+            ('RETURN_VALUE', ()),
+        ), [0])
+        self.assertEqual([name for name, _ in _names(optimized)], [
+            'LOAD_FAST', 'LOAD_METHOD', 'LOAD_FAST', 'LOAD_FAST', 'LOAD_ATTR',
+            'CALL_FUNCTION', 'LOAD_CONST', 'BINARY_ADD', 'CALL_METHOD',
+            'RETURN_VALUE',
+        ])
+        self.assertEqual(removed, 0)
+
+    def test_no_folding_across_lines_or_errors(self):
+        table = _table(
+            ('LOAD_CONST', (1,)),
+            ('LOAD_CONST', (0,)),
+            ('BINARY_FLOOR_DIVIDE', ()),
+            ('LOAD_CONST', ('ab',)),
+            ('LOAD_CONST', (30,)),
+            ('BINARY_MULTIPLY', ()),
+            ('LOAD_CONST', (1,)),
+            ('LOAD_CONST', (2,)),
+            ('BINARY_ADD', ()),
+            ('RETURN_VALUE', ()),
+        )
+        optimized, removed = optimize_instructions(table, [0, 24])
+        self.assertEqual(_names(optimized), _names(table))
+        self.assertEqual(removed, 0)
@@ -0,0 +1,214 @@
+"""Tests of the source tier for hot functions in Byterun."""
+
+from __future__ import print_function
+
+import textwrap
+import types
+import unittest
+
+from . import vmtest
+from byterun.pysource import function_factory
+from byterun.pyvm2 import VirtualMachine
+
+
+class TestTieredFunctions(vmtest.VmTestCase):
+    # The main function is never translated, so these call the functions
+    # under test from another function.
+
+    def test_loops_and_breaks(self):
+        self.assert_ok("""\
+            def find(items, wanted):
+                found = None
+                for i, item in enumerate(items):
+                    if item == wanted:
+                        found = i
+                        break
+                else:
+                    found = -1
+                n = 0
+                while True:
+                    n += 1
+                    if n > 3:
+                        break
+                return found, n
+
+            def main():
+                for wanted in "abz":
+                    print(find("abc", wanted))
+            main()
+            """)
+
+    def test_arguments(self):
+        self.assert_ok("""\
+            def fn(a, b=17, *args, **kwargs):
+                return a, b, args, sorted(kwargs.items())
+
+            def main():
+                for _ in range(3):
+                    print(fn(1))
+                    print(fn(b=2, a=3))
+                    print(fn(1, 2, 3, 4, x=5))
+                    print(fn(*[1, 2, 3], **{'y': 6}))
+            main()
+            """)
+
+    def test_bad_call(self):
+        self.assert_ok("""\
+            def fn(a, b):
+                return a + b
+
+            def main():
+                print(fn(1, 2))
+                print(fn(1))
+            main()
+            """, raises=TypeError)
+
+    def test_unbound_local(self):
+        self.assert_ok("""\
+            def fn(flag):
+                if flag:
+                    x = 1
+                return x
+
+            def main():
+                print(fn(True))
+                print(fn(False))
+            main()
+            """, raises=UnboundLocalError)
+
+    def test_arguments_named_like_builtins(self):
+        self.assert_ok("""\
+            def g(*args, **kwargs):
+                return args, sorted(kwargs.items())
+
+            def fn(list, dict, isinstance, StopIteration):
+                for x in [1]:
+                    pass
+                return g(*list, **dict), isinstance
+
+            def fails(NameError):
+                return undefined_name
+
+            def main():
+                print(fn([1, 2], {'a': 3}, 4, 5))
+                print(fails(6))
+            main()
+            """, raises=NameError)
+
+    def test_bad_call_of_lambda(self):
+        self.assert_ok("""\
+            fn = lambda a: a
+
+            def main():
+                print(fn(1))
+                print(fn())
+            main()
+            """, raises=TypeError)
+
+    def test_stack_shuffling_and_containers(self):
+        self.assert_ok("""\
+            def fn(seq):
+                a, b, c = seq
+                a, b = b, a
+                d = {a: b, 'c': c}
+                l = [x * 2 for x in seq]
+                l[1:2] = [99, 98]
+                del l[0]
+                t = (a, b, c)
+                s = set([a, b])
+                l[0] += 1
+                return sorted(d.items()), l[:], l[1:], l[:2], t, len(s)
+
+            def main():
+                print(fn((1, 2, 3)))
+                print(fn([4, 5, 6]))
+            main()
+            """)
+
+    def test_globals_and_exceptions(self):
+        self.assert_ok("""\
+            total = 0
+            def add(n):
+                global total
+                total = total + n
+                if total > 5:
+                    raise ValueError("too much: %d" % total)
+                return total
+
+            def main():
+                try:
+                    for i in range(5):
+                        add(i)
+                except ValueError as e:
+                    print(e)
+                print(total)
+            main()
+            """)
+
+    def test_locals(self):
+        self.assert_ok("""\
+            def fn(a, b=2):
+                c = a + b
+                print(sorted(locals().items()))
+                return c
+
+            def main():
+                print(fn(1))
+                print(fn(3, 4))
+            main()
+            """)
+
+
+def _function_code(src):
+    code = compile(textwrap.dedent(src), "<test>", "exec")
+    return code.co_consts[0]
+
+
+class TestTranslation(unittest.TestCase):
+    def test_untranslatable_code(self):
+        self.assertIsNone(function_factory(_function_code("""\
+            def gen():
+                yield 1
+            """)))
+        self.assertIsNone(function_factory(_function_code("""\
+            def guarded():
+                try:
+                    return 1
+                except:
+                    return 2
+            """)))
+        self.assertIsNone(function_factory(_function_code("""\
+            def outer(x):
+                return lambda: x
+            """)))
+        self.assertIsNone(function_factory(_function_code("""\
+            def snoop(x):
+                return locals()
+            """)))
+
+    def test_factories_are_shared(self):
+        code = _function_code("""\
+            def fn(x):
+                return x + 1
+            """)
+        self.assertIs(function_factory(code), function_factory(code))
+
+    def test_nested_helpers_run_translated(self):
+        code = compile(textwrap.dedent("""\
+            def helper(n):
+                return n * 2
+            def snoop(n):
+                return sorted(locals())
+            def main():
+                return [(helper(i), snoop(i)) for i in range(3)]
+            results = main()
+            """), "<test>", "exec")
+        env = {'__builtins__': __builtins__}
+        vm = VirtualMachine(hot_threshold=0)
+        vm.run_code(code, f_globals=env)
+        self.assertEqual(env['results'], [(i * 2, ['n']) for i in range(3)])
+        self.assertIsInstance(env['helper']._tiered, types.FunctionType)
+        self.assertIs(env['snoop']._tiered, False)
+        # Translated calls never run an interpreted frame to keep.
+        self.assertNotIn(id(env['helper'].func_code), vm.frame_pool)
+        self.assertIn(id(env['snoop'].func_code), vm.frame_pool)
@@ -0,0 +1,67 @@
+"""Tests of deep size estimates for Byterun."""
+
+from __future__ import print_function
+
+import sys
+import unittest
+
+from byterun.sizes import DeepSizer
+
+
+class Slotted(object):
+    __slots__ = ['a', 'b']
+
+
+class TestDeepSizer(unittest.TestCase):
+    def test_contents_are_counted(self):
+        strings = ['x' * 1000, 'y' * 1000]
+        size = DeepSizer()(strings)
+        self.assertEqual(
+            size,
+            sys.getsizeof(strings) + sum(sys.getsizeof(s) for s in strings),
+        )
+
+    def test_shared_objects_count_once(self):
+        s = 'z' * 1000
+        pair = [s, s]
+        self.assertEqual(
+            DeepSizer()(pair), sys.getsizeof(pair) + sys.getsizeof(s)
+        )
+        cycle = []
+        cycle.append(cycle)
+        self.assertEqual(DeepSizer()(cycle), sys.getsizeof(cycle))
+
+    def test_instances(self):
+        class Plain(object):
+            pass
+        obj = Plain()
+        obj.data = 'w' * 500
+        self.assertEqual(DeepSizer()(obj), (
+            sys.getsizeof(obj) + sys.getsizeof(obj.__dict__) +
+            sys.getsizeof('data') + sys.getsizeof(obj.data)
+        ))
+        slotted = Slotted()
+        slotted.a = 'v' * 500
+        self.assertEqual(
+            DeepSizer()(slotted),
+            sys.getsizeof(slotted) + sys.getsizeof(slotted.a),
+        )
+
+    def test_classes_are_not_followed(self):
+        self.assertEqual(DeepSizer()(Slotted), sys.getsizeof(Slotted))
+
+    def test_sampling(self):
+        strings = [str(i) * 10 for i in range(10000)]
+        exact = DeepSizer(sample=None)(strings)
+        estimate = DeepSizer(sample=50)(strings)
+        self.assertAlmostEqual(estimate / float(exact), 1.0, places=1)
+
+    def test_sampled_shared_objects_count_once(self):
+        shared = ['s' * 1000] * 1000
+        self.assertEqual(
+            DeepSizer(sample=50)(shared), DeepSizer(sample=None)(shared)
+        )
+        mixed = [str(i) * 10 if i % 3 else shared[0] for i in range(10000)]
+        exact = DeepSizer(sample=None)(mixed)
+        estimate = DeepSizer(sample=50)(mixed)
+        self.assertAlmostEqual(estimate / float(exact), 1.0, places=1)
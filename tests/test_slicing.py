@@ -0,0 +1,100 @@
+"""Tests of slicing Byterun's recordings."""
+
+from __future__ import print_function
+
+import unittest
+
+from byterun.pyvm2 import VirtualMachine
+from byterun.recording import ALL, ActionTable, Recorder
+from byterun.slicing import Slicer, source_lines
+
+
+SLICED_CODE = """\
+class Box(object):
+    pass
+
+def double(n):
+    twice = n * 2
+    return twice
+
+def main(a, b):
+    x = a + 1
+    y = b + 1
+    box = Box()
+    box.value = y
+    z = double(x)
+    w = box.value
+    total = z + w
+    unused = 3
+    for i in range(3):
+        total = total + i
+    return total
+
+main(1, 2)
+"""
+
+
+class TestSlicer(unittest.TestCase):
+    def slicer(self, **kwargs):
+        code = compile(SLICED_CODE, "<test>", "exec")
+        table = ActionTable()
+        recorder = Recorder(table, codes=ALL, heap=True, **kwargs)
+        VirtualMachine(recorder=recorder).run_code(code)
+        return Slicer(table)
+
+    def test_backward(self):
+        slicer = self.slicer()
+        # Through the call and the return, and through the box.
+        self.assertEqual(
+            sorted(slicer.backward('total', 15)),
+            [5, 6, 9, 10, 11, 12, 13, 14, 15],
+        )
+        self.assertEqual(sorted(slicer.backward('z', 13)), [5, 6, 9, 13])
+        # A line that only reads a name slices from the stores it read.
+        self.assertEqual(sorted(slicer.backward('w', 15)), [10, 11, 12, 14])
+        self.assertEqual(slicer.backward('unused', 15), frozenset())
+        self.assertEqual(slicer.backward('nothing', 1), frozenset())
+
+    def test_reassigned_parameters(self):
+        code = compile(
+            "def main(x):\n"
+            "    y = 5\n"
+            "    x = y + 1\n"
+            "    z = x * 2\n"
+            "main(1)\n",
+            "<test>", "exec",
+        )
+        table = ActionTable()
+        VirtualMachine(recorder=Recorder(table)).run_code(code)
+        slicer = Slicer(table)
+        self.assertEqual(sorted(slicer.backward('z', 4)), [2, 3, 4])
+        self.assertEqual(sorted(slicer.forward(2)), [2, 3, 4])
+
+    def test_forward(self):
+        slicer = self.slicer()
+        self.assertEqual(
+            sorted(slicer.forward(10)), [10, 12, 14, 15, 18]
+        )
+        self.assertEqual(sorted(slicer.forward(16)), [16])
+
+    def test_loops(self):
+        slicer = self.slicer(loops=True)
+        self.assertEqual(
+            sorted(slicer.backward('total', 18)),
+            [5, 6, 9, 10, 11, 12, 13, 14, 15, 17, 18],
+        )
+
+    def test_any_actions(self):
+        slicer = self.slicer()
+        rebuilt = Slicer(list(slicer.table))
+        self.assertEqual(rebuilt.dependencies, slicer.dependencies)
+        self.assertEqual(rebuilt.users, slicer.users)
+
+    def test_source_lines(self):
+        lines = self.slicer().backward('z', 13)
+        self.assertEqual(source_lines(SLICED_CODE, lines), [
+            (5, "    twice = n * 2"),
+            (6, "    return twice"),
+            (9, "    x = a + 1"),
+            (13, "    z = double(x)"),
+        ])
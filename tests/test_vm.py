@@ -0,0 +1,1041 @@
+"""Tests of the machinery of the Byterun VM itself."""
+
+from __future__ import print_function
+
+import gc
+import io
+import json
+import sys
+import textwrap
+import unittest
+
+import six
+
+from byterun.pycode import instruction_table
+from byterun.recording import (
+    ALL, CALL, RETURN, STORE, Action, ActionTable, BinarySink, GeneratorSink,
+    MIN_SWEEP, HeapShadow, JSONLinesSink, LoopAction, Recorder, read_binary,
+)
+from byterun.sizes import DeepSizer
+from byterun.pyvm2 import (
+    ATTR_INSTANCE, VirtualMachine, VirtualMachineError, quickening_stats,
+)
+
+
+class CountingConstsVM(VirtualMachine):
+    """A VM that counts the constants it loads."""
+    def __init__(self):
+        super(CountingConstsVM, self).__init__()
+        self.consts_loaded = 0
+
+    def byte_LOAD_CONST(self, const):
+        self.consts_loaded += 1
+        super(CountingConstsVM, self).byte_LOAD_CONST(const)
+
+
+class CountingOperatorsVM(VirtualMachine):
+    """A VM that counts the constants and operators it runs."""
+    def __init__(self, **kwargs):
+        super(CountingOperatorsVM, self).__init__(**kwargs)
+        self.consts_loaded = self.operators = self.comparisons = 0
+
+    def byte_LOAD_CONST(self, const):
+        self.consts_loaded += 1
+        super(CountingOperatorsVM, self).byte_LOAD_CONST(const)
+
+    def binaryOperator(self, op):
+        self.operators += 1
+        super(CountingOperatorsVM, self).binaryOperator(op)
+
+    def inplaceOperator(self, op):
+        self.operators += 1
+        super(CountingOperatorsVM, self).inplaceOperator(op)
+
+    def byte_COMPARE_OP(self, opnum):
+        self.comparisons += 1
+        super(CountingOperatorsVM, self).byte_COMPARE_OP(opnum)
+
+
+class TestDispatchTable(unittest.TestCase):
+    def test_subclass_overrides_are_honored(self):
+        vm = CountingConstsVM()
+        vm.run_code(compile("a = 1\nb = 2\n", "<test>", "exec"))
+        # 1, 2, and the implicit None returned by the module.
+        self.assertEqual(vm.consts_loaded, 3)
+
+    def test_overrides_hold_with_fused_and_quickened_instructions(self):
+        code = compile(textwrap.dedent("""\
+            def main():
+                total = 0
+                for i in range(20):
+                    total = total + 1
+                    if total < i * 2:
+                        total += i
+                return total
+            main()
+            """), "<test>", "exec")
+        counts = []
+        for kwargs in [{}, dict(superinstructions=True), dict(quicken=True)]:
+            vm = CountingOperatorsVM(**kwargs)
+            vm.run_code(code)
+            counts.append((vm.consts_loaded, vm.operators, vm.comparisons))
+        self.assertEqual(counts[1], counts[0])
+        self.assertEqual(counts[2], counts[0])
+        self.assertGreater(counts[0][1], 40)
+
+    def test_tables_are_per_class(self):
+        self.assertIsNot(
+            CountingConstsVM.get_dispatch_table(),
+            VirtualMachine.get_dispatch_table(),
+        )
+        self.assertIs(
+            VirtualMachine().dispatch_table,
+            VirtualMachine.get_dispatch_table(),
+        )
+
+
+RECORDED_CODE = """\
+def main(n):
+    total = 0
+    i = 0
+    while i < n:
+        j = i
+        total = total + j
+        i = i + 1
+    return total
+main(5)
+"""
+
+
+class TestRecording(unittest.TestCase):
+    def test_actions_have_source_lines(self):
+        code = compile(RECORDED_CODE, "<test>", "exec")
+        variables, actions = VirtualMachine().run_code(code)
+        self.assertEqual(sorted(variables), ['i', 'j', 'total'])
+        self.assertEqual(actions[:5], [
+            ['total', 2],
+            ['i', 3],
+            ['i', 'i', 'j', 5],
+            ['total', 'j', 'total', 6],
+            ['i', 'i', 7],
+        ])
+        # Each time round the loop stores on the same lines.
+        self.assertEqual(
+            [action[-1] for action in actions[2:]], [5, 6, 7] * 5
+        )
+
+    def record(self, sink, **kwargs):
+        code = compile(RECORDED_CODE, "<test>", "exec")
+        vm = VirtualMachine(recorder=Recorder(sink, **kwargs))
+        return vm.run_code(code)
+
+    def test_json_lines(self):
+        f = six.StringIO()
+        self.record(JSONLinesSink(f))
+        lines = f.getvalue().splitlines()
+        self.assertEqual(len(lines), 17)
+        self.assertEqual(json.loads(lines[2]), {
+            'reads': ['i', 'i'], 'name': 'j', 'line': 5,
+            'size': sys.getsizeof(0), 'frame': 0, 'kind': 'store',
+            'peer': None,
+        })
+
+    def test_binary(self):
+        f = io.BytesIO()
+        variables, _ = self.record(BinarySink(f))
+        f.seek(0)
+        actions = list(read_binary(f))
+        self.assertEqual(len(actions), 17)
+        self.assertEqual(actions[3], Action(
+            ('total', 'j'), 'total', 6, sys.getsizeof(0), 0, STORE, None,
+        ))
+        self.assertEqual(actions[-1].name, 'i')
+        self.assertEqual(variables['total'], sys.getsizeof(10))
+
+    def test_generator(self):
+        names = []
+        def consume():
+            try:
+                while True:
+                    action = yield
+                    names.append(action.name)
+            except GeneratorExit:
+                names.append(None)
+        self.record(GeneratorSink(consume()))
+        self.assertEqual(names[:5], ['total', 'i', 'j', 'total', 'i'])
+        # The generator is closed when the program ends.
+        self.assertEqual(names[-1], None)
+
+    def test_action_table(self):
+        _, table = self.record(ActionTable())
+        _, actions = self.record(None)
+        self.assertEqual([action.as_list() for action in table], actions)
+        self.assertEqual(table[-1], Action(
+            ('i',), 'i', 7, sys.getsizeof(5), 0, STORE, None,
+        ))
+        self.assertEqual(table.writers('total'), [0, 3, 6, 9, 12, 15])
+        self.assertEqual(table.readers('j'), [3, 6, 9, 12, 15])
+        self.assertEqual(table.on_line(5), [2, 5, 8, 11, 14])
+        self.assertEqual(table.writers('n'), [])
+        self.assertEqual(table.on_line(100), [])
+        self.assertEqual(table.in_frame(0), list(range(17)))
+        self.assertEqual(table.symbols, ['total', 'i', 'j'])
+        self.assertLess(table.nbytes(), 17 * 40)
+
+    def test_sizes_are_deep(self):
+        code = compile(textwrap.dedent("""\
+            def main():
+                rows = []
+                for i in range(3):
+                    rows = rows + ['x' * 1000]
+                rows = None
+            main()
+            """), "<test>", "exec")
+        recorder = Recorder()
+        VirtualMachine(recorder=recorder).run_code(code)
+        history = recorder.sizes['rows']
+        self.assertEqual(history.stores, 5)
+        self.assertEqual(history.last, sys.getsizeof(None))
+        self.assertGreater(history.peak, 3000)
+        self.assertEqual(recorder.variables['rows'], history.last)
+        shallow = Recorder(sizer=sys.getsizeof)
+        VirtualMachine(recorder=shallow).run_code(code)
+        self.assertLess(shallow.sizes['rows'].peak, 1000)
+
+    def test_equal_code_objects_keep_their_lines(self):
+        codes = [
+            compile(source, "<test>", "exec") for source in [
+                "def main():\n    x = 1\n    y = x\nmain()\n",
+                "def main():\n    x = 1; y = x\nmain()\n",
+            ]
+        ]
+        self.assertEqual(codes[0].co_consts[0], codes[1].co_consts[0])
+        # One VM, so the second main can reuse the first one's frame.
+        vm = VirtualMachine()
+        self.assertEqual(vm.run_code(codes[0])[1], [['x', 2], ['x', 'y', 3]])
+        self.assertEqual(
+            vm.run_code(codes[1])[1][2:], [['x', 2], ['x', 'y', 2]]
+        )
+
+    def test_reads_are_bounded(self):
+        _, actions = self.record(None, max_reads=1)
+        self.assertEqual(actions[2:5], [['i', 'j', 5],
+                                        ['j', 'total', 6],
+                                        ['i', 'i', 7]])
+
+
+CALLING_CODE = """\
+def double(x):
+    y = x * 2
+    return y
+
+def squares(n):
+    for k in range(n):
+        yield k * k
+
+def main(n):
+    a = double(n)
+    total = 0
+    for s in squares(a):
+        total = total + s
+    return total
+
+main(2)
+"""
+
+
+class TestRecordingFrames(unittest.TestCase):
+    def record(self, **kwargs):
+        code = compile(CALLING_CODE, "<test>", "exec")
+        table = ActionTable()
+        VirtualMachine(recorder=Recorder(table, **kwargs)).run_code(code)
+        return table
+
+    def test_main_function_by_default(self):
+        table = self.record()
+        self.assertEqual(set(table.frames), set([0]))
+        self.assertEqual(set(table.kinds), set([0]))
+        self.assertEqual(table[0].name, 'a')
+
+    def test_calls_and_returns_tie_frames_together(self):
+        table = self.record(codes=ALL)
+        actions = list(table)
+        # main is frame 0, double 1, and the generator 2.  Parameters
+        # aren't dependencies, so double's store of y reads nothing.
+        self.assertEqual(actions[:4], [
+            Action((), 'double', 10, 0, 0, CALL, 1),
+            Action((), 'y', 2, sys.getsizeof(4), 1, STORE, None),
+            Action(('y',), 'double', 3, sys.getsizeof(4), 1, RETURN, 0),
+            Action((), 'a', 10, sys.getsizeof(4), 0, STORE, None),
+        ])
+        # Each resumption of the generator is a call, and each value it
+        # yields, or returns at the end, a return.
+        squares = [action for action in actions if action.name == 'squares']
+        self.assertEqual(
+            [(action.kind, action.frame, action.peer) for action in squares],
+            [(CALL, 0, 2), (RETURN, 2, 0)] * 5,
+        )
+        self.assertEqual(
+            [table[i].kind for i in table.readers('k')], [RETURN] * 4
+        )
+
+    def test_reassigned_parameters_are_dependencies(self):
+        code = compile(textwrap.dedent("""\
+            def main(x):
+                y = x + 5
+                x = y + 1
+                z = x * 2
+            main(1)
+            """), "<test>", "exec")
+        table = ActionTable()
+        VirtualMachine(recorder=Recorder(table)).run_code(code)
+        self.assertEqual(
+            [(action.reads, action.name) for action in table],
+            [((), 'y'), (('y',), 'x'), (('x',), 'z')],
+        )
+
+    def test_opting_in_code(self):
+        code = compile(CALLING_CODE, "<test>", "exec")
+        double = [c for c in code.co_consts if getattr(c, 'co_name', '') ==
+                  'double'][0]
+        recorder = Recorder(ActionTable(), codes=[double])
+        VirtualMachine(recorder=recorder).run_code(code)
+        table = recorder.sink
+        # Only double is tracked, and its caller isn't, so it has no edges.
+        self.assertEqual(list(table), [
+            Action((), 'y', 2, sys.getsizeof(4), 0, STORE, None),
+        ])
+
+    def test_tracked_code_is_not_tiered(self):
+        code = compile(CALLING_CODE + "for _ in range(5):\n    main(2)\n",
+                       "<test>", "exec")
+        table = ActionTable()
+        recorder = Recorder(table, codes=ALL)
+        vm = VirtualMachine(recorder=recorder, hot_threshold=1)
+        vm.run_code(code)
+        self.assertEqual(len(table.writers('y')), 6)
+
+
+HEAP_CODE = """\
+class Point(object):
+    pass
+
+def main(n):
+    p = Point()
+    p.x = n
+    squares = [k * k for k in range(n)]
+    squares[0] = p.x
+    by_name = {'first': squares[1]}
+    total = by_name['first'] + squares[0]
+    return total
+
+main(3)
+"""
+
+
+class TestRecordingHeap(unittest.TestCase):
+    def record(self, **kwargs):
+        code = compile(HEAP_CODE, "<test>", "exec")
+        table = ActionTable()
+        vm = VirtualMachine(recorder=Recorder(table, heap=True), **kwargs)
+        vm.run_code(code)
+        return table
+
+    def stores(self, table):
+        return [(action.reads, action.name) for action in table]
+
+    def test_heap_locations(self):
+        table = self.record()
+        self.assertEqual(self.stores(table), [
+            ((), 'p'),
+            (('p',), 'Point#0.x'),
+            ((), 'k'),
+            (('k', 'k'), 'list#1[0]'),
+            ((), 'k'),
+            (('k', 'k'), 'list#1[1]'),
+            ((), 'k'),
+            (('k', 'k'), 'list#1[2]'),
+            ((), 'squares'),
+            (('p', 'Point#0.x', 'squares'), 'list#1[0]'),
+            (('squares', 'list#1[1]'), "dict#2['first']"),
+            ((), 'by_name'),
+            (('by_name', "dict#2['first']", 'squares', 'list#1[0]'),
+             'total'),
+        ])
+
+    def test_quickened_subscripts(self):
+        code = compile(textwrap.dedent("""\
+            def main():
+                xs = [0, 0]
+                xs[0] = 5
+                total = 0
+                for _ in range(20):
+                    total = total + xs[0]
+            main()
+            """), "<test>", "exec")
+        quickening_stats.clear()
+        table = ActionTable()
+        recorder = Recorder(table, heap=True)
+        VirtualMachine(recorder=recorder, quicken=True).run_code(code)
+        self.assertGreater(quickening_stats['BINARY_SUBSCR(list, int)'][0], 0)
+        self.assertEqual(len(table.readers('list#0[0]')), 20)
+
+    def test_off_by_default(self):
+        code = compile(HEAP_CODE, "<test>", "exec")
+        _, actions = VirtualMachine().run_code(code)
+        self.assertEqual([action[-2] for action in actions],
+                         ['p', 'k', 'k', 'k', 'squares', 'by_name', 'total'])
+
+    def test_dead_objects_are_forgotten(self):
+        class Thing(object):
+            pass
+        shadow = HeapShadow()
+        thing = Thing()
+        label = shadow.label(thing, True)
+        self.assertEqual(label, 'Thing#0')
+        self.assertEqual(shadow.label(thing), label)
+        del thing
+        self.assertEqual(shadow.objects, {})
+        self.assertEqual(shadow.refs, {})
+        # A list can't say when it dies, so it's held until a sweep.
+        items = [1, 2]
+        shadow.label(items, True)
+        kept = []
+        shadow.label(kept, True)
+        del items
+        self.assertEqual(len(shadow.held), 2)
+        shadow.sweep()
+        self.assertEqual(list(shadow.held.values()), [kept])
+        self.assertEqual(list(shadow.objects.values()), [('list#2', list)])
+
+    def test_new_objects_at_dead_ids_get_new_labels(self):
+        code = compile(textwrap.dedent("""\
+            def main():
+                for i in range(3):
+                    d = {}
+                    d['k'] = i
+            main()
+            """), "<test>", "exec")
+        table = ActionTable()
+        recorder = Recorder(table, heap=True)
+        VirtualMachine(recorder=recorder).run_code(code)
+        self.assertEqual(
+            [action.name for action in table if '[' in action.name],
+            ["dict#0['k']", "dict#1['k']", "dict#2['k']"],
+        )
+
+    def test_held_objects_are_swept(self):
+        shadow = HeapShadow()
+        for i in range(10000):
+            shadow.label([i], True)
+        self.assertLess(len(shadow.held), 2 * MIN_SWEEP)
+        self.assertEqual(len(shadow.objects), len(shadow.held))
+
+
+LOOP_CODE = """\
+def main():
+    total = 0
+    for x in range(10):
+        for y in range(3):
+            z = [y] * x
+        if x % 2:
+            total = total + x
+    return total
+
+def fail():
+    while True:
+        n = 1
+        raise ValueError(n)
+
+main()
+try:
+    fail()
+except ValueError:
+    pass
+"""
+
+
+class TestRecordingLoops(unittest.TestCase):
+    def record(self, sink=None, keep_every=None, **kwargs):
+        code = compile(LOOP_CODE, "<test>", "exec")
+        table = ActionTable() if sink is None else sink
+        recorder = Recorder(table, loops=True, keep_every=keep_every)
+        VirtualMachine(recorder=recorder, **kwargs).run_code(code)
+        return table
+
+    def test_loops_are_merged(self):
+        table = self.record()
+        self.assertEqual(table[0], Action(
+            (), 'total', 2, sys.getsizeof(0), 0, STORE, None,
+        ))
+        self.assertEqual([
+            (action.action.name, action.action.reads) + tuple(action[1:4])
+            for action in (table[number] for number in range(1, 6))
+        ], [
+            # Odd x are stored after reading total, which reads x first.
+            ('x', (), 5, 0, 8),
+            ('y', (), 30, 0, 9),
+            ('z', ('y', 'x'), 30, 0, 9),
+            ('x', ('x',), 5, 1, 9),
+            ('total', ('x', 'total', 'x'), 5, 1, 9),
+        ])
+        z = table[3]
+        self.assertEqual(z.min_size, DeepSizer()([]))
+        self.assertEqual(z.max_size, DeepSizer()([2] * 9))
+
+    def test_the_same_with_every_table_and_engine(self):
+        merged = list(self.record())
+        for kwargs in [
+            dict(optimize=True), dict(superinstructions=True),
+            dict(quicken=True), dict(engine='threaded'),
+        ]:
+            self.assertEqual(list(self.record(**kwargs)), merged)
+
+    def test_keeping_iterations(self):
+        table = self.record(keep_every=5)
+        kept = [
+            (action.name, action.line) for action in table
+            if type(action) is Action and action.name in ('x', 'z')
+        ]
+        # Iterations 0 and 5 of the outer loop, and 0 of the inner one.
+        self.assertEqual(kept, [('x', 3), ('z', 5), ('x', 3), ('z', 5)])
+        merged = [
+            action[1:] for action in table if type(action) is LoopAction
+        ]
+        self.assertEqual(merged, [
+            action[1:] for action in self.record()
+            if type(action) is LoopAction
+        ])
+
+    def test_loops_left_by_exceptions(self):
+        table = self.record()
+        self.assertEqual(table[-1][:4], (
+            Action((), 'n', 12, sys.getsizeof(1), 1, STORE, None),
+            1, 0, 0,
+        ))
+
+    def test_sinks(self):
+        f = io.BytesIO()
+        self.record(BinarySink(f))
+        f.seek(0)
+        self.assertEqual(list(read_binary(f)), list(self.record()))
+        f = six.StringIO()
+        self.record(JSONLinesSink(f))
+        line = json.loads(f.getvalue().splitlines()[1])
+        self.assertEqual(line['count'], 5)
+        self.assertEqual(line['action']['name'], 'x')
+
+
+class TestSuperinstructions(unittest.TestCase):
+    def test_recording_is_unchanged(self):
+        code = compile(RECORDED_CODE, "<test>", "exec")
+        plain = VirtualMachine().run_code(code)
+        fused = VirtualMachine(superinstructions=True).run_code(code)
+        self.assertEqual(plain, fused)
+        self.assertTrue(plain[1])
+
+    def test_pairs_are_fused_within_lines(self):
+        from byterun.pycode import fused_instructions, code_info
+        code = compile(RECORDED_CODE, "<test>", "exec").co_consts[0]
+        fused = fused_instructions(code)
+        line_starts = set(code_info(code).line_starts)
+        names = []
+        offset = 0
+        while offset < len(fused):
+            byteCode, byteName, arguments, next_offset = fused[offset]
+            names.append(byteName)
+            for inner in range(offset + 1, next_offset):
+                self.assertNotIn(inner, line_starts)
+            offset = next_offset
+        self.assertIn('COMPARE_OP__POP_JUMP_IF_FALSE', names)
+        self.assertIn('LOAD_FAST__LOAD_FAST', names)
+
+
+class TestOptimizer(unittest.TestCase):
+    def test_recording_is_unchanged(self):
+        code = compile(RECORDED_CODE, "<test>", "exec")
+        plain = VirtualMachine().run_code(code)
+        vm = VirtualMachine(optimize=True)
+        self.assertEqual(plain, vm.run_code(code))
+        self.assertEqual(
+            sorted(c.co_name for c in vm.removed_instructions),
+            ['<module>', 'main'],
+        )
+
+
+CACHED_NAMES_CODE = """\
+def get():
+    return x
+def shadowed():
+    return len('ab')
+def rebind():
+    global x
+    x = 3
+def main():
+    rebind()
+    return get()
+x = 1
+a = get(), shadowed()
+x = 2
+len = lambda s: 42
+b = get(), shadowed()
+del len
+c = main(), shadowed()
+"""
+
+
+class TestInlineCaches(unittest.TestCase):
+    def run_cached(self, **kwargs):
+        code = compile(CACHED_NAMES_CODE, "<test>", "exec")
+        env = {'__builtins__': __builtins__, '__name__': '__main__'}
+        vm = VirtualMachine(inline_caches=True, **kwargs)
+        vm.run_code(code, f_globals=env)
+        return vm, env
+
+    def test_changed_names_are_seen(self):
+        vm, env = self.run_cached()
+        self.assertEqual(env['a'], (1, 2))
+        self.assertEqual(env['b'], (2, 42))
+        self.assertEqual(env['c'], (3, 2))
+
+    def test_changes_by_tiered_functions_are_seen(self):
+        vm, env = self.run_cached(hot_threshold=0)
+        self.assertEqual(env['c'], (3, 2))
+
+    def test_names_are_cached(self):
+        vm, env = self.run_cached()
+        cached = [
+            caches for code, (_, _, caches, _) in vm.cache_slots.items()
+            if code.co_name == 'get'
+        ]
+        self.assertEqual(len(cached), 1)
+        version, seen, value = cached[0][0]
+        self.assertEqual(value, 3)
+
+    def test_configurations_share_code(self):
+        # The optimizer drops the dead LOAD_GLOBALs, so the optimized table
+        # needs fewer slots than the plain one.
+        code = compile(
+            "def f(items):\n"
+            "    for item in items:\n"
+            "        return len\n"
+            "        max\n"
+            "    return abs\n"
+            "result = f(())\n",
+            "<test>", "exec",
+        )
+        for kwargs in [{}, {'optimize': True}, {}, {'quicken': True}]:
+            env = {'__builtins__': __builtins__, '__name__': '__main__'}
+            VirtualMachine(inline_caches=True, **kwargs).run_code(
+                code, f_globals=env,
+            )
+            self.assertIs(env['result'], abs)
+
+
+CACHED_ATTRS_CODE = """\
+class Thing(object):
+    size = 1
+    def meth(self):
+        return 'meth'
+class Other(object):
+    size = 5
+    @property
+    def meth(self):
+        return lambda: 'property'
+def probe(o):
+    return o.size, o.meth()
+def set_size(o, size):
+    o.size = size
+t = Thing()
+results = [probe(t), probe(t)]
+t.meth = lambda: 'shadowed'
+results.append(probe(t))
+del t.meth
+Thing.size = 2
+results.append(probe(t))
+set_size(t, 3)
+set_size(t, 4)
+results.append(probe(t))
+t.__class__ = Other
+results.append(probe(t))
+Other.size = property(lambda self: 'size')
+set_size(Thing(), 6)
+try:
+    set_size(t, 7)
+except AttributeError:
+    results.append('read only')
+"""
+
+
+class TestAttributeCaches(unittest.TestCase):
+    def test_changed_attributes_are_seen(self):
+        code = compile(CACHED_ATTRS_CODE, "<test>", "exec")
+        env = {'__builtins__': __builtins__, '__name__': '__main__'}
+        vm = VirtualMachine(inline_caches=True)
+        vm.run_code(code, f_globals=env)
+        self.assertEqual(env['results'], [
+            (1, 'meth'),
+            (1, 'meth'),
+            (1, 'shadowed'),
+            (2, 'meth'),
+            (4, 'meth'),
+            (4, 'property'),
+            'read only',
+        ])
+        probe_slots = [
+            attrs for code, (_, _, _, attrs) in vm.cache_slots.items()
+            if code.co_name == 'probe'
+        ][0]
+        self.assertIs(probe_slots[0][0], env['Other'])
+        self.assertEqual(probe_slots[0][2], ATTR_INSTANCE)
+
+    def test_instance_attributes_fall_back_to_the_class(self):
+        code = compile(textwrap.dedent("""\
+            class A(object):
+                x = 'class'
+            def get(a):
+                return a.x
+            a = A()
+            a.x = 'instance'
+            results = [get(a), get(a)]
+            del a.x
+            results.append(get(a))
+            a.x = 'again'
+            results.append(get(a))
+            """), "<test>", "exec")
+        env = {'__builtins__': __builtins__, '__name__': '__main__'}
+        VirtualMachine(inline_caches=True).run_code(code, f_globals=env)
+        self.assertEqual(
+            env['results'], ['instance', 'instance', 'class', 'again'],
+        )
+
+    def test_classes_changed_by_builtins_are_seen(self):
+        code = compile(textwrap.dedent("""\
+            class A(object):
+                def m(self):
+                    return 'old'
+            def new(self):
+                return 'new'
+            def main():
+                a = A()
+                results = []
+                for i in range(6):
+                    if i == 3:
+                        setattr(A, 'm', new)
+                    results.append(a.m())
+                delattr(A, 'm')
+                try:
+                    a.m()
+                except AttributeError:
+                    results.append('gone')
+                return results
+            results = main()
+            """), "<test>", "exec")
+        for kwargs in [dict(inline_caches=True), dict(hot_threshold=0)]:
+            env = {'__builtins__': __builtins__, '__name__': '__main__'}
+            VirtualMachine(**kwargs).run_code(code, f_globals=env)
+            self.assertEqual(
+                env['results'], ['old'] * 3 + ['new'] * 3 + ['gone'],
+            )
+
+
+QUICKENED_CODE = """\
+def work(items):
+    total = 0
+    for x in items:
+        total = total + x * 2
+        if x < 3:
+            total -= 1
+    return total
+def main():
+    return work(range(20)), work([1.5] * 20), work([0.5, 7] * 10)
+results = main()
+"""
+
+
+class TestQuickening(unittest.TestCase):
+    def run_quickened(self, **kwargs):
+        code = compile(QUICKENED_CODE, "<test>", "exec")
+        env = {'__builtins__': __builtins__, '__name__': '__main__'}
+        VirtualMachine(quicken=True, **kwargs).run_code(code, f_globals=env)
+        return code, env
+
+    def test_results_are_unchanged(self):
+        code, env = self.run_quickened()
+        six.exec_(code, env)
+        expected = env['results']
+        for kwargs in [{}, {'engine': 'threaded'}]:
+            code, env = self.run_quickened(**kwargs)
+            self.assertEqual(env['results'], expected)
+
+    def test_instructions_are_quickened(self):
+        quickening_stats.clear()
+        code, env = self.run_quickened()
+        work = code.co_consts[0]
+        names = set(
+            i[1] for i in instruction_table(work, quicken=True) if i
+        )
+        self.assertIn('QUICKENED_OPERATOR', names)
+        self.assertNotIn('ADAPTIVE_OPERATOR', names)
+        hits, misses = quickening_stats['BINARY_MULTIPLY(int, int)']
+        self.assertGreater(hits, 0)
+        # The floats miss the guard, and run the generic handler.
+        self.assertGreater(misses, 0)
+
+
+class TestFunctions(unittest.TestCase):
+    def test_functions_share_metadata(self):
+        code = compile(
+            "def make(n):\n"
+            "    return [lambda x=i: x + n for i in range(3)]\n"
+            "fns = make(10)\n"
+            "values = [fn() for fn in fns]\n",
+            "<test>", "exec",
+        )
+        env = {'__builtins__': __builtins__}
+        VirtualMachine().run_code(code, f_globals=env)
+        fns = env['fns']
+        self.assertEqual(env['values'], [10, 11, 12])
+        self.assertIs(fns[0]._info, fns[1]._info)
+        self.assertEqual(fns[2].func_defaults, (2,))
+
+    def test_closures_carry_their_cells(self):
+        code = compile(
+            "def make(n):\n"
+            "    def get():\n"
+            "        return n\n"
+            "    return get\n"
+            "get = make(5)\n"
+            "value = get()\n",
+            "<test>", "exec",
+        )
+        env = {'__builtins__': __builtins__}
+        vm = VirtualMachine()
+        vm.run_code(code, f_globals=env)
+        self.assertEqual(env['value'], 5)
+        cell, = env['get'].func_closure
+        self.assertEqual(cell.contents, 5)
+        # The frame that made the cell has let go of it.
+        make_frame, = vm.frame_pool[id(env['make'].func_code)]
+        self.assertIsNone(make_frame.cells)
+
+
+class TestFramePool(unittest.TestCase):
+    def test_frames_are_reused(self):
+        code = compile(
+            "def fib(n):\n"
+            "    if n < 2:\n"
+            "        return n\n"
+            "    return fib(n - 1) + fib(n - 2)\n"
+            "def gen(n):\n"
+            "    for i in range(n):\n"
+            "        yield fib(i)\n"
+            "result = fib(10), list(gen(5)), list(gen(5))\n",
+            "<test>", "exec",
+        )
+        env = {'__builtins__': __builtins__}
+        vm = VirtualMachine()
+        vm.run_code(code, f_globals=env)
+        self.assertEqual(env['result'], (55, [0, 1, 1, 2, 3], [0, 1, 1, 2, 3]))
+        # One frame for each level of recursion, the module, and each
+        # generator: fib is called 177 times for fib(10), and 19 times for
+        # each generator.
+        self.assertEqual(vm.frames_made, 10 + 1 + 2)
+        self.assertEqual(vm.frames_reused, 177 + 2 * 19 - 10)
+        fib_frames = vm.frame_pool[id(env['fib'].func_code)]
+        self.assertTrue(all(f.fast_locals is None for f in fib_frames))
+
+
+class TestThreadedEngine(unittest.TestCase):
+    def test_recording_is_unchanged(self):
+        code = compile(RECORDED_CODE, "<test>", "exec")
+        classic = VirtualMachine().run_code(code)
+        threaded = VirtualMachine(engine='threaded').run_code(code)
+        self.assertEqual(classic, threaded)
+
+    def test_threaded_code_is_shared(self):
+        # Equal code objects share cache entries, so drop any left over
+        # from other tests before they're collected in the middle of this.
+        gc.collect()
+        code = compile(RECORDED_CODE, "<test>", "exec")
+        VirtualMachine(engine='threaded').run_code(code)
+        codes = VirtualMachine._threaded_codes
+        self.assertIn(code.co_consts[0], codes)
+        compiled = dict(codes[code.co_consts[0]])
+        VirtualMachine(engine='threaded').run_code(code)
+        self.assertEqual(compiled, codes[code.co_consts[0]])
+
+    def test_unknown_engine(self):
+        with self.assertRaises(VirtualMachineError):
+            VirtualMachine(engine='warp')
+
+
+HOOKED_CODE = """\
+def f(x):
+    y = x + 1
+    return y
+def g():
+    try:
+        f(None)
+    except TypeError:
+        pass
+r = f(1)
+g()
+"""
+
+
+class CallHook(object):
+    """A hook that only wants calls and returns."""
+    def __init__(self):
+        self.events = []
+
+    def on_call(self, vm, frame):
+        self.events.append(('call', frame.f_code.co_name))
+
+    def on_return(self, vm, frame, value):
+        self.events.append(('return', frame.f_code.co_name, value))
+
+
+class LineHook(object):
+    """A hook that only wants lines and exceptions."""
+    def __init__(self):
+        self.events = []
+
+    def on_line(self, vm, frame, line):
+        self.events.append((frame.f_code.co_name, line))
+
+    def on_exception(self, vm, frame, exc_info):
+        self.events.append((frame.f_code.co_name, exc_info[0]))
+
+
+class TestHooks(unittest.TestCase):
+    def test_events_go_to_their_hooks(self):
+        code = compile(HOOKED_CODE, "<test>", "exec")
+        calls, lines = CallHook(), LineHook()
+        vm = VirtualMachine(engine='threaded')
+        vm.add_hook(calls)
+        vm.add_hook(lines)
+        vm.run_code(code)
+        self.assertEqual(calls.events, [
+            ('call', '<module>'),
+            ('call', 'f'), ('return', 'f', 2),
+            ('call', 'g'), ('call', 'f'), ('return', 'f', None),
+            ('return', 'g', None),
+            ('return', '<module>', None),
+        ])
+        self.assertEqual(lines.events, [
+            ('<module>', 1), ('<module>', 4), ('<module>', 9),
+            ('f', 2), ('f', 3),
+            ('<module>', 10),
+            ('g', 5), ('g', 6),
+            ('f', 2), ('f', TypeError),
+            ('g', TypeError), ('g', 7), ('g', 8),
+        ])
+
+    def test_no_hooks_no_instrumentation(self):
+        code = compile(HOOKED_CODE, "<test>", "exec")
+        hook = CallHook()
+        vm = VirtualMachine()
+        self.assertFalse(vm.instrumented)
+        vm.add_hook(hook)
+        self.assertTrue(vm.instrumented)
+        vm.remove_hook(hook)
+        self.assertFalse(vm.instrumented)
+        vm.add_hook(object())
+        self.assertFalse(vm.instrumented)
+        vm.run_code(code)
+        self.assertEqual(hook.events, [])
+
+
+TRACED_CODE = """\
+def gen(n):
+    for i in range(n):
+        yield i
+def f(x):
+    total = 0
+    for i in gen(x):
+        total += i
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        total = -total
+    return total
+r = f(3)
+"""
+
+
+class TestTracing(unittest.TestCase):
+    def trace(self, run):
+        """Get the events `run` reports to the trace function it's given."""
+        events = []
+
+        def tracer(frame, event, arg):
+            if frame.f_code.co_filename != "<traced>":
+                return None
+            if event == 'exception':
+                arg = arg[0]
+            events.append((event, frame.f_code.co_name, frame.f_lineno, arg))
+            return tracer
+        run(tracer)
+        return events
+
+    def test_events_are_the_same_as_sys_settrace(self):
+        code = compile(TRACED_CODE, "<traced>", "exec")
+
+        def run_real(tracer):
+            old = sys.gettrace()
+            sys.settrace(tracer)
+            try:
+                six.exec_(code, {})
+            finally:
+                sys.settrace(old)
+
+        def run_vm(tracer):
+            vm = VirtualMachine()
+            vm.settrace(tracer)
+            vm.run_code(code)
+
+        expected = self.trace(run_real)
+        self.assertIn(('exception', 'f', 9, ZeroDivisionError), expected)
+        self.assertEqual(self.trace(run_vm), expected)
+
+    def test_kept_frames_outlive_their_calls(self):
+        code = compile(textwrap.dedent("""\
+            def f(x):
+                y = x * 2
+                return y
+            def main():
+                f(1)
+                f(2)
+            main()
+            """), "<traced>", "exec")
+        frames = []
+
+        def tracer(frame, event, arg):
+            if event == 'call' and frame.f_code.co_name == 'f':
+                frames.append(frame)
+            return None
+        vm = VirtualMachine()
+        vm.settrace(tracer)
+        vm.run_code(code)
+        # The second call ran in the first's pooled frame.
+        self.assertEqual([frame.f_locals for frame in frames], [
+            {'x': 1, 'y': 2}, {'x': 2, 'y': 4},
+        ])
+        self.assertEqual([frame.f_code.co_name for frame in frames], ['f'] * 2)
+
+    def test_errors_stop_tracing(self):
+        code = compile(TRACED_CODE, "<traced>", "exec")
+        calls = []
+
+        def tracer(frame, event, arg):
+            calls.append(event)
+            if frame.f_code.co_name == 'f':
+                raise KeyError('trace')
+        vm = VirtualMachine()
+        vm.settrace(tracer)
+        with self.assertRaises(KeyError):
+            vm.run_code(code)
+        self.assertEqual(calls, ['call', 'call'])
+        self.assertFalse(vm.instrumented)
+        self.assertEqual(vm.frames, [])
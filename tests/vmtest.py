@@ -17,6 +17,22 @@ CAPTURE_STDOUT = ('-s' not in sys.argv)
 # Make this false to see the traceback from a failure inside pyvm2.
 CAPTURE_EXCEPTION = 1
 
+# The keyword arguments for each VirtualMachine the tests run their code in.
+VM_CONFIGS = [
+    {},
+    {'superinstructions': True},
+    {'engine': 'threaded'},
+    {'engine': 'threaded', 'superinstructions': True},
+    {'hot_threshold': 0},
+    {'optimize': True},
+    {'inline_caches': True},
+    {'quicken': True},
+    {
+        'optimize': True, 'superinstructions': True, 'engine': 'threaded',
+        'inline_caches': True, 'quicken': True,
+    },
+]
+
 
 def dis_code(code):
     """Disassemble `code` and all the code it refers to."""
@@ -32,7 +48,11 @@ def dis_code(code):
 class VmTestCase(unittest.TestCase):
 
     def assert_ok(self, code, raises=None):
-        """Run `code` in our VM and in real Python: they behave the same."""
+        """Run `code` in our VM and in real Python: they behave the same.
+
+        The code is run once in the VM for each of the VM_CONFIGS.
+
+        """
 
         code = textwrap.dedent(code)
         code = compile(code, "<%s>" % self.id(), "exec", 0, 1)
@@ -42,40 +62,15 @@ class VmTestCase(unittest.TestCase):
 
         real_stdout = sys.stdout
 
-        # Run the code through our VM.
-
-        vm_stdout = six.StringIO()
-        if CAPTURE_STDOUT:              # pragma: no branch
-            sys.stdout = vm_stdout
-        vm = VirtualMachine()
-
-        vm_value = vm_exc = None
-        try:
-            vm_value = vm.run_code(code)
-        except VirtualMachineError:         # pragma: no cover
-            # If the VM code raises an error, show it.
-            raise
-        except AssertionError:              # pragma: no cover
-            # If test code fails an assert, show it.
-            raise
-        except Exception as e:
-            # Otherwise, keep the exception for comparison later.
-            if not CAPTURE_EXCEPTION:       # pragma: no cover
-                raise
-            vm_exc = e
-        finally:
-            real_stdout.write("-- stdout ----------\n")
-            real_stdout.write(vm_stdout.getvalue())
-
         # Run the code through the real Python interpreter, for comparison.
 
         py_stdout = six.StringIO()
         sys.stdout = py_stdout
 
-        py_value = py_exc = None
+        py_exc = None
         globs = {}
         try:
-            py_value = eval(code, globs, globs)
+            eval(code, globs, globs)
         except AssertionError:              # pragma: no cover
             raise
         except Exception as e:
@@ -83,13 +78,42 @@ class VmTestCase(unittest.TestCase):
 
         sys.stdout = real_stdout
 
-        self.assert_same_exception(vm_exc, py_exc)
-        self.assertEqual(vm_stdout.getvalue(), py_stdout.getvalue())
-        self.assertEqual(vm_value, py_value)
-        if raises:
-            self.assertIsInstance(vm_exc, raises)
-        else:
-            self.assertIsNone(vm_exc)
+        for vm_config in VM_CONFIGS:
+            # Run the code through our VM.
+
+            vm_stdout = six.StringIO()
+            if CAPTURE_STDOUT:              # pragma: no branch
+                sys.stdout = vm_stdout
+            vm = VirtualMachine(**vm_config)
+
+            vm_exc = None
+            try:
+                # run_code returns what the recorder made, not a value: a
+                # module's value is always None, so there's nothing to
+                # compare but stdout and exceptions.
+                vm.run_code(code)
+            except VirtualMachineError:         # pragma: no cover
+                # If the VM code raises an error, show it.
+                raise
+            except AssertionError:              # pragma: no cover
+                # If test code fails an assert, show it.
+                raise
+            except Exception as e:
+                # Otherwise, keep the exception for comparison later.
+                if not CAPTURE_EXCEPTION:       # pragma: no cover
+                    raise
+                vm_exc = e
+            finally:
+                sys.stdout = real_stdout
+                real_stdout.write("-- stdout %r ----------\n" % (vm_config,))
+                real_stdout.write(vm_stdout.getvalue())
+
+            self.assert_same_exception(vm_exc, py_exc)
+            self.assertEqual(vm_stdout.getvalue(), py_stdout.getvalue())
+            if raises:
+                self.assertIsInstance(vm_exc, raises)
+            else:
+                self.assertIsNone(vm_exc)
 
     def assert_same_exception(self, e1, e2):
         """Exceptions don't implement __eq__, check it ourselves."""